@@ -59,6 +59,9 @@ class ModelService():
         if model.rank == 0:
             logger.info(f"Starting model service for {self.model_type} on rank {model.rank}")
 
+            model.batch_limits = model.profile_batch_limits()
+            logger.info(f"Serving {self.model_type} {self.model_variant} with {model.batch_limits}")
+
             #Placeholder static triton config for now
             triton_config = TritonConfig(http_address="0.0.0.0", http_port=self.master_port, log_verbose=4)
             triton_workspace = Path("/tmp") / Path("pytriton") / Path("".join(random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=16)))
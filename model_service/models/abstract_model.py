@@ -1,21 +1,70 @@
 """A module to abstract the models' functionality"""
 import abc
 from enum import Enum
+import json
+import os
+from typing import Dict
+
+import numpy as np
 from pytriton.decorators import batch
+from pytriton.model_config import ModelConfig, Tensor
+
+from .memory_profiler import BatchLimits, DEFAULT_BATCH_LIMITS
+
+
+# Number of model instances bound to Triton per model. Instances handle
+# requests concurrently, so the CPU side of one batch overlaps the GPU work
+# of another
+NUM_INFER_INSTANCES = int(os.environ.get("NUM_INFER_INSTANCES", 4))
 
 
 class AbstractModel(abc.ABC):
     """An abstraction of a generative AI model"""
 
+    # Sized from device memory by profile_batch_limits once the model is loaded
+    batch_limits: BatchLimits = DEFAULT_BATCH_LIMITS
+
     @abc.abstractmethod
     def load(self, model_path):
         """An abstract method for loading a model"""
         pass
 
+    def profile_batch_limits(self) -> BatchLimits:
+        """
+        Size the batch limits of the loaded model from the free device
+        memory. Distributed models size them while loading, since all of
+        their ranks must agree, so by default the limits are kept as is.
+        """
+        return self.batch_limits
+
     @abc.abstractmethod
     def bind(self, triton):
         pass
 
+    def batching_metrics(self) -> Dict[str, float]:
+        """A snapshot of the metrics of the model's batching loop, if it has one"""
+        return {}
+
+    def bind_metrics(self, triton, model_name):
+        """
+        Bind the batching metrics of a model as the `<model_name>-metrics`
+        Triton model, which returns them as a JSON string per request, for
+        the gateway to read next to the model's status.
+        """
+        @batch
+        def infer_metrics(**inputs):
+            metrics = json.dumps(self.batching_metrics()).encode("utf-8")
+            return {"metrics": np.array([[metrics]] * len(inputs["task"]), dtype=np.bytes_)}
+
+        triton.bind(
+            model_name=f"{model_name}-metrics",
+            infer_func=infer_metrics,
+            inputs=[Tensor(name="task", dtype=np.int64, shape=(1,))],
+            outputs=[Tensor(name="metrics", dtype=np.bytes_, shape=(1,))],
+            config=ModelConfig(max_batch_size=8),
+        )
+        return triton
+
     @property
     @abc.abstractmethod
     def rank(self):
@@ -26,6 +75,13 @@ class AbstractModel(abc.ABC):
     def infer(self, **inputs):
         pass
 
+    def infer_funcs(self):
+        """
+        One infer function per model instance. They run concurrently, so all
+        request state must be local to the call.
+        """
+        return [self.infer] * NUM_INFER_INSTANCES
+
     @abc.abstractmethod
     def generate(self, inputs):
         pass
@@ -44,3 +100,4 @@ class Task(Enum):
     GENERATE = 0
     GET_ACTIVATIONS = 1
     EDIT_ACTIVATIONS = 2
+    SWEEP_ACTIVATIONS = 3
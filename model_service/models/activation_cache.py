@@ -0,0 +1,106 @@
+"""Module for caching captured activations on the model services"""
+from collections import OrderedDict
+import os
+import threading
+import time
+from typing import Dict, Optional
+import uuid
+
+import torch
+from torch import Tensor
+
+
+# Bounds of the pinned host memory held by cached activations
+ACTIVATION_CACHE_MAX_BYTES = int(os.environ.get("ACTIVATION_CACHE_MAX_BYTES", 4 * 1024**3))
+ACTIVATION_CACHE_TTL = float(os.environ.get("ACTIVATION_CACHE_TTL", 600))
+
+
+def compact_activation(activation: Tensor) -> Tensor:
+    """Copy an activation into a new tensor holding only its own elements."""
+    compact = torch.empty(
+        activation.shape,
+        dtype=activation.dtype,
+        pin_memory=activation.is_pinned(),
+    )
+    compact.copy_(activation)
+    return compact
+
+
+class ActivationCache:
+    def __init__(
+        self,
+        max_bytes: int = ACTIVATION_CACHE_MAX_BYTES,
+        ttl: float = ACTIVATION_CACHE_TTL,
+    ) -> None:
+        """
+        Bounded cache of captured activations keyed by a request handle, so
+        later edit requests can patch from them without the activations ever
+        leaving the server.
+
+        Entries expire `ttl` seconds after they are added, and the least
+        recently used entries are evicted once the cached activations exceed
+        `max_bytes`.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.num_bytes = 0
+
+        # Handle -> (expiry time, size in bytes, {module name: activation})
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _evict_expired(self, now: float) -> None:
+        for handle in list(self.entries.keys()):
+            if self.entries[handle][0] <= now:
+                self._evict(handle)
+
+    def _evict(self, handle: str) -> None:
+        _, nbytes, _ = self.entries.pop(handle)
+        self.num_bytes -= nbytes
+
+    def put(self, activations: Dict[str, Tensor]) -> Optional[str]:
+        """
+        Cache the activations of one request and return its handle, or None
+        if they could never fit in the cache.
+
+        Captured activations are usually views of larger capture buffers,
+        which would stay alive in full. Each one is copied into a right-sized
+        tensor of its own, pinned like its source, so the cache holds exactly
+        the bytes it counts.
+        """
+        activations = {
+            name: compact_activation(activation) for name, activation in activations.items()
+        }
+        nbytes = sum(
+            activation.nelement() * activation.element_size() for activation in activations.values()
+        )
+        if nbytes > self.max_bytes:
+            return None
+
+        handle = uuid.uuid4().hex
+        with self.lock:
+            now = time.time()
+            self._evict_expired(now)
+            while self.entries and self.num_bytes + nbytes > self.max_bytes:
+                self._evict(next(iter(self.entries)))
+
+            self.entries[handle] = (now + self.ttl, nbytes, activations)
+            self.num_bytes += nbytes
+
+        return handle
+
+    def get(self, handle: str, module_name: str) -> Tensor:
+        """Look up the cached activation of a module for some handle."""
+        with self.lock:
+            self._evict_expired(time.time())
+            if handle not in self.entries:
+                raise Exception(f"Activation cache handle {handle} is unknown " f"or expired")
+
+            self.entries.move_to_end(handle)
+            activations = self.entries[handle][2]
+
+        if module_name not in activations:
+            raise Exception(
+                f"Activation cache handle {handle} holds no " f"activation for module {module_name}"
+            )
+        return activations[module_name]
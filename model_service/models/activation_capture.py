@@ -0,0 +1,697 @@
+"""Module for capturing and editing activations, shared by the model services"""
+from dataclasses import dataclass
+from enum import Enum
+from functools import partial
+from typing import Any, Callable, List, Optional, Sequence, Tuple, Union
+
+import torch
+from torch import Tensor
+
+
+_LayerOutput = Tuple[Any]
+
+# The NCCL backend only implements gather from torch 1.11 on, older versions
+# (the llama2 image pins 1.10.1) gather onto rank0 with point-to-point ops
+NCCL_GATHER = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2]) >= (1, 11)
+
+
+class CapturePolicy(Enum):
+    """
+    Which forward calls of a generation an activation is captured from.
+        PREFILL: Only the prompt. Rows of different prompt lengths are
+            captured up to the longest prompt, over the later forward calls
+            too when generation starts at the shortest one.
+        ALL: Every forward call, concatenated along the sequence dimension.
+        POSITIONS: Only the chosen absolute token positions.
+        NONE: Never, for modules which are only edited.
+    """
+
+    PREFILL = "prefill"
+    ALL = "all"
+    POSITIONS = "positions"
+    NONE = "none"
+
+
+@dataclass
+class ActivationPayload:
+    """
+    Payload object which contains all necessary information for every request
+    relevant to activation manipulation.
+    """
+
+    def __init__(
+        self,
+        module_names_activation_retrieval: Tuple,
+        module_editing_fn_pairs: Optional[dict] = None,
+        capture_policy: Union[CapturePolicy, str] = CapturePolicy.ALL,
+        capture_positions: Optional[Tuple[int]] = None,
+        module_reducer_specs: Optional[dict] = None,
+    ) -> None:
+        self.module_names_activation_retrieval = module_names_activation_retrieval
+
+        if module_editing_fn_pairs is not None:
+            self.module_editing_fn_pairs = module_editing_fn_pairs
+        else:
+            self.module_editing_fn_pairs = {}
+
+        self.capture_policy = CapturePolicy(capture_policy)
+        self.capture_positions = capture_positions
+
+        if module_reducer_specs is not None:
+            self.module_reducer_specs = module_reducer_specs
+        else:
+            self.module_reducer_specs = {}
+
+        if self.capture_policy == CapturePolicy.POSITIONS:
+            assert self.capture_positions, (
+                "Capture policy `positions` " "requires capture positions"
+            )
+
+
+def _get_copy_stream(device: torch.device) -> "torch.cuda.Stream":
+    """
+    Side CUDA stream used for device-to-host activation copies, so they can
+    overlap with the forward pass running on the default stream.
+    """
+    if not hasattr(_get_copy_stream, "_streams"):
+        _get_copy_stream._streams = {}
+    if device not in _get_copy_stream._streams:
+        _get_copy_stream._streams[device] = torch.cuda.Stream(device=device)
+    return _get_copy_stream._streams[device]
+
+
+def synchronize_capture_streams() -> None:
+    """
+    Wait for every pending asynchronous activation copy. Must be called before
+    reading any captured activation on the host.
+    """
+    for stream in getattr(_get_copy_stream, "_streams", {}).values():
+        stream.synchronize()
+
+
+class PendingGather:
+    def __init__(
+        self,
+        layer_output: Optional[_LayerOutput] = None,
+        works: Optional[List[Any]] = None,
+        gather_list: Optional[List[Tensor]] = None,
+        sent: Optional[Tensor] = None,
+    ) -> None:
+        """
+        Handle to a gather of some layer output onto rank0, which may still be
+        in flight. Only rank0 receives the gathered layer output, `wait`
+        returns None on every other rank. A tensor being sent is kept alive
+        until the send completes.
+        """
+        self.layer_output = layer_output
+        self.works = works or []
+        self.gather_list = gather_list
+        self.sent = sent
+
+    def wait(self) -> Optional[_LayerOutput]:
+        for work in self.works:
+            work.wait()
+        self.works = []
+        self.sent = None
+
+        if self.gather_list is not None:
+            self.layer_output = torch.cat(self.gather_list, dim=-1)
+            self.gather_list = None
+
+        return self.layer_output
+
+
+def gather_to_rank0(
+    tensor: Tensor,
+    group: Optional[Any] = None,
+    async_op: bool = True,
+    point_to_point: Optional[bool] = None,
+) -> PendingGather:
+    """
+    Gather some tensor split along the last dimension onto rank0 only, from
+    every rank of a group whose ranks are the global ranks.
+
+    Where the backend can't gather, ie. NCCL before torch 1.11, or if
+    `point_to_point` is set, rank0 instead posts a receive for the shard of
+    every other rank, which sends it to rank0 alone. Either way only rank0
+    receives any data.
+    """
+    world_size = torch.distributed.get_world_size(group=group)
+    if world_size == 1:
+        return PendingGather(layer_output=tensor)
+    if point_to_point is None:
+        point_to_point = not NCCL_GATHER and torch.distributed.get_backend(group) == "nccl"
+
+    tensor = tensor.contiguous()
+    is_rank0 = torch.distributed.get_rank() == 0
+
+    if point_to_point:
+        if is_rank0:
+            gather_list = [tensor] + [torch.empty_like(tensor) for _ in range(world_size - 1)]
+            ops = [
+                torch.distributed.P2POp(torch.distributed.irecv, gather_list[src], src, group)
+                for src in range(1, world_size)
+            ]
+        else:
+            gather_list = None
+            ops = [torch.distributed.P2POp(torch.distributed.isend, tensor, 0, group)]
+        pending = PendingGather(
+            works=torch.distributed.batch_isend_irecv(ops),
+            gather_list=gather_list,
+            sent=tensor,
+        )
+    else:
+        gather_list = None
+        if is_rank0:
+            gather_list = [torch.empty_like(tensor) for _ in range(world_size)]
+        work = torch.distributed.gather(
+            tensor,
+            gather_list,
+            dst=0,
+            group=group,
+            async_op=async_op,
+        )
+        pending = PendingGather(works=[work] if async_op else None, gather_list=gather_list)
+
+    if not async_op:
+        pending.wait()
+    return pending
+
+
+class ActivationCapture:
+    def __init__(
+        self,
+        registered_name: str,
+        policy: CapturePolicy = CapturePolicy.ALL,
+        positions: Optional[Tuple[int]] = None,
+        total_len: Optional[int] = None,
+        is_editing: bool = False,
+        reduce_sequence: bool = False,
+        seq_dim: int = 1,
+        token_mask: Optional[Tensor] = None,
+        prompt_lens: Optional[Sequence[int]] = None,
+    ) -> None:
+        """
+        Tracks the forward calls made on a single module during one generation
+        and captures its activation according to the capture policy.
+
+        Every rank keeps one of these so that all ranks agree on which forward
+        calls need a (collective) gather, and on when the hook can be detached.
+        Only rank0 actually writes into the host buffer.
+
+        Captured activations are written into a pinned host buffer, which is
+        allocated once on the first capture, using non-blocking copies on a
+        side stream. Call `synchronize_capture_streams` before reading
+        `result()`.
+
+        If `reduce_sequence` is set, captured tokens are instead accumulated
+        on-device and only their mean over the sequence is copied to host.
+        `token_mask` is the (batch, length) mask of the tokens counted in that
+        mean, by absolute position, so that the left padding of shorter
+        prompts is left out. Positions past its end are counted.
+
+        `prompt_lens` are the prompt lengths of the rows of a right padded
+        batch whose first forward call only covers the shortest prompt. The
+        prefill is then captured up to the longest prompt, and the positions
+        past the prompt of a row are zeroed, or left out of its mean.
+        """
+        self.registered_name = registered_name
+        self.policy = CapturePolicy(policy)
+        self.positions = sorted(set(positions)) if positions else []
+        self.total_len = total_len
+        self.is_editing = is_editing
+        self.reduce_sequence = reduce_sequence
+        self.seq_dim = seq_dim
+
+        # Absolute position of the first token in the next forward call
+        self.cursor = 0
+        self.num_calls = 0
+        self.buffer = None
+        self.num_filled = 0
+        self.sequence_sum = None
+        self.num_reduced = 0
+        self.token_mask = None if token_mask is None else token_mask.cpu()
+
+        self.prefill_len = None
+        self.prompt_mask = None
+        if self.policy == CapturePolicy.PREFILL and prompt_lens is not None:
+            self.prefill_len = max(prompt_lens)
+            self.prompt_mask = torch.arange(self.prefill_len) < torch.tensor(prompt_lens).unsqueeze(
+                1
+            )
+            if self.token_mask is None:
+                self.token_mask = self.prompt_mask
+
+        # Retrieval-only activation whose gather onto rank0 is in flight
+        self.pending = None
+
+        if self.policy == CapturePolicy.ALL and not self.reduce_sequence:
+            assert self.total_len is not None, (
+                f"Module: {registered_name} capture policy `all` requires the "
+                f"total generation length"
+            )
+
+    def get_seq_len(self, layer_outputs: _LayerOutput) -> int:
+        """Length of the sequence processed in the current forward call."""
+        output = layer_outputs
+        while isinstance(output, tuple):
+            output = output[0]
+        return output.shape[self.seq_dim]
+
+    def should_capture(self, seq_len: int) -> bool:
+        """Whether the forward call covering `seq_len` tokens is captured."""
+        if self.policy == CapturePolicy.PREFILL:
+            if self.prefill_len is not None:
+                return self.cursor < self.prefill_len
+            return self.num_calls == 0
+        elif self.policy == CapturePolicy.POSITIONS:
+            return any(self.cursor <= p < self.cursor + seq_len for p in self.positions)
+        elif self.policy == CapturePolicy.NONE:
+            return False
+        return True
+
+    def is_satisfied(self) -> bool:
+        """Whether no future forward call will be captured."""
+        if self.policy == CapturePolicy.PREFILL:
+            if self.prefill_len is not None:
+                return self.cursor >= self.prefill_len
+            return self.num_calls > 0
+        elif self.policy == CapturePolicy.POSITIONS:
+            return self.cursor > self.positions[-1]
+        elif self.policy == CapturePolicy.NONE:
+            return True
+        return False
+
+    def is_detachable(self) -> bool:
+        """Editing hooks must stay attached for the entire generation."""
+        return not self.is_editing and self.is_satisfied()
+
+    def advance(self, seq_len: int) -> None:
+        self.cursor += seq_len
+        self.num_calls += 1
+
+    def _allocate(self, activation: Tensor, captured_len: int) -> None:
+        shape = list(activation.shape)
+        shape[self.seq_dim] = captured_len
+        self.buffer = torch.empty(
+            shape,
+            dtype=activation.dtype,
+            device="cpu",
+            pin_memory=activation.is_cuda,
+        )
+
+    def capture(self, activation: Tensor, cursor: Optional[int] = None) -> None:
+        """
+        Copy the policy-selected slice of the activation from the forward call
+        starting at `cursor`, by default the current one, into the host buffer.
+        """
+        cursor = self.cursor if cursor is None else cursor
+        seq_len = activation.shape[self.seq_dim]
+
+        positions = range(cursor, cursor + seq_len)
+        if self.policy == CapturePolicy.PREFILL and self.prefill_len is not None:
+            # Only the prompt part of a forward call past the shortest prompt
+            captured_len, dst_start = self.prefill_len, cursor
+            if cursor + seq_len > self.prefill_len:
+                positions = range(cursor, self.prefill_len)
+                activation = activation.narrow(self.seq_dim, 0, len(positions))
+        elif self.policy == CapturePolicy.PREFILL:
+            captured_len, dst_start = seq_len, 0
+        elif self.policy == CapturePolicy.ALL:
+            captured_len, dst_start = self.total_len, cursor
+        else:
+            captured_len = len(self.positions)
+            selected = [
+                (i, p - cursor)
+                for i, p in enumerate(self.positions)
+                if cursor <= p < cursor + seq_len
+            ]
+            dst_start = selected[0][0]
+            positions = [cursor + local_pos for _, local_pos in selected]
+            activation = activation.index_select(
+                self.seq_dim,
+                torch.tensor(
+                    [local_pos for _, local_pos in selected],
+                    device=activation.device,
+                ),
+            )
+
+        if self.reduce_sequence:
+            self._reduce(activation.detach(), positions)
+            return
+
+        if self.buffer is None:
+            self._allocate(activation, captured_len)
+
+        num_tokens = activation.shape[self.seq_dim]
+        dst = self.buffer.narrow(self.seq_dim, dst_start, num_tokens)
+
+        if activation.is_cuda:
+            stream = _get_copy_stream(activation.device)
+            stream.wait_stream(torch.cuda.current_stream(activation.device))
+            with torch.cuda.stream(stream):
+                dst.copy_(activation.detach(), non_blocking=True)
+            # Keep the caching allocator from reusing the activation memory
+            # before the copy has finished
+            activation.record_stream(stream)
+        else:
+            dst.copy_(activation.detach())
+
+        self.num_filled = max(self.num_filled, dst_start + num_tokens)
+
+    def _reduce(self, activation: Tensor, positions: Sequence[int]) -> None:
+        """Accumulate the sum and count of the unmasked tokens at `positions`"""
+        if self.token_mask is None:
+            partial_sum = activation.sum(dim=self.seq_dim, keepdim=True, dtype=torch.float32)
+            num_tokens = activation.shape[self.seq_dim]
+        else:
+            # Broadcast the (batch, tokens) mask over the other dimensions
+            mask = torch.ones(activation.shape[0], len(positions))
+            in_mask = [i for i, p in enumerate(positions) if p < self.token_mask.shape[1]]
+            mask[:, in_mask] = self.token_mask[:, [positions[i] for i in in_mask]].float()
+            shape = [1] * activation.dim()
+            shape[0], shape[self.seq_dim] = mask.shape
+            mask = mask.view(shape).to(activation.device)
+
+            partial_sum = (activation.float() * mask).sum(dim=self.seq_dim, keepdim=True)
+            num_tokens = mask.sum(dim=self.seq_dim, keepdim=True)
+
+        if self.sequence_sum is None:
+            self.sequence_sum = partial_sum
+        else:
+            self.sequence_sum += partial_sum
+        self.num_reduced = self.num_reduced + num_tokens
+
+    def defer(
+        self,
+        activation: Any,
+        reducer_fn: Optional[Callable] = None,
+    ) -> None:
+        """
+        Hold a sharded activation of the llama2 or OPT hooks, whose
+        asynchronous gather onto rank0 was just started, so the communication
+        overlaps the rest of the forward pass.
+        It is captured when the next one is deferred, or on `flush`.
+        """
+        self.flush()
+        self.pending = (activation, reducer_fn, self.cursor)
+
+    def flush(self) -> None:
+        """Wait for the pending gather, if any, and capture its activation."""
+        if self.pending is None:
+            return
+
+        activation, reducer_fn, cursor = self.pending
+        self.pending = None
+
+        activation.wait_gather()
+        if torch.distributed.get_rank() != 0:
+            return
+
+        activation.rearrange()
+        if reducer_fn is not None:
+            self.capture(activation.reduce_activation(reducer_fn), cursor=cursor)
+        else:
+            self.capture(activation.activations, cursor=cursor)
+
+    def result(self) -> Optional[Tensor]:
+        """The captured activation, trimmed to the filled sequence length."""
+        if self.reduce_sequence:
+            if self.sequence_sum is None:
+                return None
+            # Rows whose tokens were all masked average to zero
+            num_reduced = self.num_reduced
+            if isinstance(num_reduced, Tensor):
+                num_reduced = num_reduced.clamp(min=1)
+            return (self.sequence_sum / num_reduced).cpu()
+
+        if self.buffer is None:
+            return None
+        activation = self.buffer.narrow(self.seq_dim, 0, self.num_filled)
+        if self.prompt_mask is not None:
+            # Zero the generated tokens of the rows with shorter prompts
+            prompt_mask = self.prompt_mask[:, : self.num_filled]
+            shape = [1] * activation.dim()
+            shape[0], shape[self.seq_dim] = prompt_mask.shape
+            activation.masked_fill_(~prompt_mask.view(shape), 0)
+        return activation
+
+
+class ReducerFunctions:
+    """
+    Class which holds all implemented activation reducers. Reducers run
+    on-device on the rearranged activation, before it is copied to host.
+    Every reducer keeps the batch and sequence dimensions so that it composes
+    with any capture policy.
+    """
+
+    @staticmethod
+    def identity_reduce(activation: Tensor) -> Tensor:
+        return activation
+
+    @staticmethod
+    def l2_norm_reduce(activation: Tensor) -> Tensor:
+        """Per-token L2 norm over the last dimension."""
+        return activation.float().norm(dim=-1)
+
+    @staticmethod
+    def topk_reduce(activation: Tensor, k: int) -> Tensor:
+        """Per-token indices of the k largest neurons in the last dimension."""
+        return activation.topk(k, dim=-1).indices
+
+    @staticmethod
+    def projection_reduce(activation: Tensor, probes: Tensor) -> Tensor:
+        """Per-token projection onto each of the P x D probe vectors."""
+        return torch.matmul(
+            activation,
+            probes.to(device=activation.device, dtype=activation.dtype).t(),
+        )
+
+
+def get_reducer(reducer_spec: dict) -> Tuple[Callable, bool]:
+    """
+    Build a reducer from a declarative spec, ie. one of:
+        {"name": "mean"}
+        {"name": "l2_norm"}
+        {"name": "topk", "k": 16}
+        {"name": "projection", "probes": [[...], ...]}
+
+    Returns the per-token reducer function, and whether the captured tokens
+    should additionally be averaged over the sequence.
+    """
+    name = reducer_spec["name"]
+    if name == "mean":
+        return ReducerFunctions.identity_reduce, True
+    elif name == "l2_norm":
+        return ReducerFunctions.l2_norm_reduce, False
+    elif name == "topk":
+        return partial(ReducerFunctions.topk_reduce, k=int(reducer_spec["k"])), False
+    elif name == "projection":
+        probes = torch.as_tensor(reducer_spec["probes"], dtype=torch.float32)
+        if probes.dim() == 1:
+            probes = probes.unsqueeze(0)
+        return partial(ReducerFunctions.projection_reduce, probes=probes), False
+    else:
+        raise Exception(f"Reducer: {name} is not implemented")
+
+
+class ShardEditFunctions:
+    """
+    Class which holds all implemented declarative edits. Unlike arbitrary
+    editing functions these are applied by every rank to its own shard of the
+    activation, so they need no gather or scatter. Each edit gets the shard,
+    the edit spec, the offset of the shard in the last dimension of the full
+    activation, and the absolute token positions covered by the shard.
+    """
+
+    @staticmethod
+    def _shard_of(tensor: Tensor, activation: Tensor, shard_start: int) -> Tensor:
+        """Slice a tensor over the full last dimension down to the shard."""
+        shard_size = activation.shape[-1]
+        tensor = tensor.narrow(-1, shard_start, shard_size)
+        return tensor.to(device=activation.device, dtype=activation.dtype)
+
+    @staticmethod
+    def add_edit(activation, edit_spec, shard_start, positions) -> Tensor:
+        """Add alpha times a vector over the last dimension."""
+        vector = ShardEditFunctions._shard_of(edit_spec["vector"], activation, shard_start)
+        return activation + edit_spec.get("alpha", 1.0) * vector
+
+    @staticmethod
+    def subtract_edit(activation, edit_spec, shard_start, positions) -> Tensor:
+        vector = ShardEditFunctions._shard_of(edit_spec["vector"], activation, shard_start)
+        return activation - edit_spec.get("alpha", 1.0) * vector
+
+    @staticmethod
+    def scale_edit(activation, edit_spec, shard_start, positions) -> Tensor:
+        return activation * edit_spec["factor"]
+
+    @staticmethod
+    def zero_edit(activation, edit_spec, shard_start, positions) -> Tensor:
+        """Zero-ablate neurons, given as indices into the full last dimension."""
+        shard_size = activation.shape[-1]
+        local_indices = [
+            i - shard_start
+            for i in edit_spec["indices"]
+            if shard_start <= i < shard_start + shard_size
+        ]
+        if not local_indices:
+            return activation
+
+        edited = activation.clone()
+        edited[..., local_indices] = 0
+        return edited
+
+    @staticmethod
+    def clamp_edit(activation, edit_spec, shard_start, positions) -> Tensor:
+        return activation.clamp(
+            min=edit_spec.get("min", None),
+            max=edit_spec.get("max", None),
+        )
+
+    @staticmethod
+    def patch_edit(activation, edit_spec, shard_start, positions) -> Tensor:
+        """
+        Replace the activation with a stored one of shape
+        (batch, total length, hidden), indexed by absolute token position.
+        """
+        stored = edit_spec["tensor"]
+
+        # Positions are ascending, those past the stored sequence are left
+        # untouched
+        num_patched = sum(p < stored.shape[1] for p in positions)
+        if num_patched == 0:
+            return activation
+
+        patch = ShardEditFunctions._shard_of(
+            stored[:, positions[:num_patched]], activation, shard_start
+        )
+        edited = activation.clone()
+        edited[:, :num_patched] = patch
+        return edited
+
+
+def apply_shard_edit(
+    edit_fn: Callable,
+    edit_spec: dict,
+    activation: Tensor,
+    shard_start: int,
+    cursor: int,
+) -> Tensor:
+    """
+    Apply a shard-local edit to the tokens of the current forward call, which
+    start at absolute position `cursor`. Edits with `positions` only touch
+    those absolute token positions.
+    """
+    seq_len = activation.shape[1]
+    if "positions" not in edit_spec:
+        return edit_fn(
+            activation,
+            edit_spec,
+            shard_start,
+            list(range(cursor, cursor + seq_len)),
+        )
+
+    local_positions = [p - cursor for p in edit_spec["positions"] if cursor <= p < cursor + seq_len]
+    if not local_positions:
+        return activation
+
+    index = torch.tensor(local_positions, device=activation.device)
+    edited = activation.clone()
+    edited[:, index] = edit_fn(
+        activation.index_select(1, index),
+        edit_spec,
+        shard_start,
+        [cursor + p for p in local_positions],
+    )
+    return edited
+
+
+def apply_row_edit(
+    rows: List[int],
+    shard_editing_fn: Callable,
+    activation: Tensor,
+    shard_start: int,
+    cursor: int,
+    inplace: bool = False,
+) -> Tensor:
+    """
+    Apply a shard-local edit to some rows of the batch only, eg. one variant
+    of a patching sweep.
+    """
+    row_index = torch.tensor(rows, device=activation.device)
+    edited = activation if inplace else activation.clone()
+    edited[row_index] = shard_editing_fn(activation.index_select(0, row_index), shard_start, cursor)
+    return edited
+
+
+def compose_shard_edits(
+    shard_editing_fns: List[Callable],
+    activation: Tensor,
+    shard_start: int,
+    cursor: int,
+) -> Tensor:
+    """
+    Apply shard-local edits in order. Row-restricted edits all write into a
+    single copy of the activation.
+    """
+    edited = activation.clone()
+    for shard_editing_fn in shard_editing_fns:
+        if getattr(shard_editing_fn, "func", None) is apply_row_edit:
+            shard_editing_fn(edited, shard_start, cursor, inplace=True)
+        else:
+            edited = shard_editing_fn(edited, shard_start, cursor)
+    return edited
+
+
+def get_shard_edit(edit_spec: Union[dict, List[dict]]) -> Callable:
+    """
+    Build a shard-local editing function from a declarative spec, ie. one of:
+        {"name": "add", "vector": [...], "alpha": 1.0}
+        {"name": "subtract", "vector": [...], "alpha": 1.0}
+        {"name": "scale", "factor": 0.5}
+        {"name": "zero", "indices": [...]}
+        {"name": "clamp", "min": -1.0, "max": 1.0}
+        {"name": "patch", "tensor": Tensor of shape (batch, length, hidden)}
+    Any spec may also restrict the edit to absolute token positions with
+    "positions": [...]. Patches from the activation cache, ie.
+    {"name": "patch", "handle": ..., "module": ...}, are resolved into the
+    cached tensor by the model service before reaching here.
+
+    Specs may be restricted to rows of the batch with "rows": [...], and a
+    list of specs is applied in order.
+
+    Returns a function of (activation, shard_start, cursor).
+    """
+    if isinstance(edit_spec, list):
+        return partial(
+            compose_shard_edits,
+            [get_shard_edit(spec) for spec in edit_spec],
+        )
+
+    name = edit_spec["name"]
+    edit_spec = dict(edit_spec)
+    rows = edit_spec.pop("rows", None)
+
+    if name in ("add", "subtract"):
+        edit_spec["vector"] = torch.as_tensor(edit_spec["vector"], dtype=torch.float32)
+    elif name == "patch":
+        edit_spec["tensor"] = torch.as_tensor(edit_spec["tensor"])
+    elif name == "zero":
+        edit_spec["indices"] = [int(i) for i in edit_spec["indices"]]
+    elif name not in ("scale", "clamp"):
+        raise Exception(f"Edit: {name} is not implemented")
+
+    if "positions" in edit_spec:
+        edit_spec["positions"] = sorted(set(int(p) for p in edit_spec["positions"]))
+
+    edit_fn = getattr(ShardEditFunctions, f"{name}_edit")
+    shard_editing_fn = partial(apply_shard_edit, edit_fn, edit_spec)
+
+    if rows is not None:
+        shard_editing_fn = partial(
+            apply_row_edit,
+            [int(r) for r in rows],
+            shard_editing_fn,
+        )
+    return shard_editing_fn
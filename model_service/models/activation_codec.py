@@ -0,0 +1,248 @@
+"""Module for encoding activations returned by the model services"""
+import codecs
+from collections import defaultdict
+import json
+import os
+import pickle
+from typing import Dict, Optional
+import uuid
+
+import numpy as np
+import torch
+from torch import Tensor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Encoded activations carrying these prefixes are envelopes which the gateway
+# decodes or handles to spilled files, every other activation is a base64
+# encoded pickled tensor
+ENVELOPE_PREFIX = "kscope-activation"
+HANDLE_PREFIX = "kscope-activation-handle"
+PACK_PREFIX = "kscope-activation-pack"
+
+# Shared scratch directory, visible to the gateway, for spilled activations
+ACTIVATION_SPILL_DIR = os.environ.get("ACTIVATION_SPILL_DIR", "")
+
+ACTIVATION_DTYPES = ("float32", "float16", "bfloat16", "int8")
+ACTIVATION_COMPRESSIONS = ("zstd",)
+
+
+def quantize_per_channel(activation: Tensor):
+    """
+    Symmetric int8 quantization with one scale per channel, ie. per element of
+    the last dimension.
+    """
+    activation = activation.float()
+    reduce_dims = tuple(range(activation.dim() - 1))
+    if reduce_dims:
+        absmax = activation.abs().amax(dim=reduce_dims)
+    else:
+        absmax = activation.abs()
+    scales = (absmax / 127.0).clamp(min=1e-8)
+    quantized = torch.round(activation / scales).clamp(-127, 127).to(torch.int8)
+    return quantized, scales
+
+
+def cast_activation(activation: Tensor, activation_dtype: Optional[str] = None):
+    """
+    Cast an activation to the requested dtype on host, returning the numpy
+    data, the int8 per-channel scales if any and the dtype name. Without a
+    requested dtype, and for non floating point activations such as top-k
+    indices, the activation keeps its own dtype.
+    """
+    activation = activation.detach().cpu()
+    if activation_dtype is None or not activation.is_floating_point():
+        activation_dtype = str(activation.dtype).replace("torch.", "")
+    elif activation_dtype not in ACTIVATION_DTYPES:
+        raise ValueError(f"Activation dtype {activation_dtype} not in {ACTIVATION_DTYPES}")
+
+    scales = None
+    if activation_dtype == "int8" and activation.is_floating_point():
+        data, scales = quantize_per_channel(activation)
+        scales = scales.numpy()
+    elif activation_dtype == "bfloat16":
+        # numpy has no bfloat16, so ship the raw bits
+        data = activation.to(torch.bfloat16).view(torch.int16)
+    else:
+        data = activation.to(getattr(torch, activation_dtype))
+
+    return data.contiguous().numpy(), scales, activation_dtype
+
+
+def encode_activation(
+    activation: Tensor,
+    activation_dtype: Optional[str] = None,
+    activation_compression: Optional[str] = None,
+) -> str:
+    """
+    Serialize an activation into a string.
+
+    Without a requested dtype or compression this is the base64 encoded pickled
+    tensor. Otherwise the activation is cast (or int8 quantized with
+    per-channel scales), optionally zstd compressed, and wrapped in an envelope
+    which only needs numpy to be decoded.
+    """
+    if activation_dtype is None and activation_compression is None:
+        return codecs.encode(pickle.dumps(activation), "base64").decode("utf-8")
+
+    if activation_compression is not None and activation_compression not in ACTIVATION_COMPRESSIONS:
+        raise ValueError(
+            f"Activation compression {activation_compression} not in {ACTIVATION_COMPRESSIONS}"
+        )
+
+    data, scales, activation_dtype = cast_activation(activation, activation_dtype)
+    payload = pickle.dumps(
+        {
+            "dtype": activation_dtype,
+            "data": data,
+            "scales": scales,
+        }
+    )
+
+    if activation_compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd activation compression requires the zstandard package")
+        payload = zstandard.ZstdCompressor().compress(payload)
+
+    header = f"{ENVELOPE_PREFIX}:{activation_compression or 'none'}:"
+    return header + codecs.encode(payload, "base64").decode("utf-8")
+
+
+def encode_activation_pack(
+    activations: Dict[str, Tensor],
+    activation_dtype: Optional[str] = None,
+    activation_compression: Optional[str] = None,
+) -> str:
+    """
+    Serialize the activations of several modules into a single envelope in
+    one pass. The payload is the length of a JSON offset table, the table,
+    and then the raw data (and int8 scales) of every module back to back, so
+    it only needs numpy to be decoded.
+    """
+    if activation_compression is not None and activation_compression not in ACTIVATION_COMPRESSIONS:
+        raise ValueError(
+            f"Activation compression {activation_compression} not in {ACTIVATION_COMPRESSIONS}"
+        )
+
+    table = {}
+    chunks = []
+    offset = 0
+
+    def add_chunk(array):
+        nonlocal offset
+        array = np.ascontiguousarray(array)
+        entry = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        chunks.append(array.reshape(-1).view(np.uint8))
+        offset += array.nbytes
+        return entry
+
+    for module_name, activation in activations.items():
+        data, scales, dtype = cast_activation(activation, activation_dtype)
+        table[module_name] = {
+            "dtype": dtype,
+            "data": add_chunk(data),
+            "scales": None if scales is None else add_chunk(scales),
+        }
+
+    header = json.dumps(table).encode("utf-8")
+    payload = b"".join([len(header).to_bytes(8, "little"), header, *chunks])
+
+    if activation_compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd activation compression requires the zstandard package")
+        payload = zstandard.ZstdCompressor().compress(payload)
+
+    prefix = f"{PACK_PREFIX}:{activation_compression or 'none'}:"
+    return prefix + codecs.encode(payload, "base64").decode("utf-8")
+
+
+class PinnedStagingBuffer:
+    """
+    Reusable pinned host buffers, one per dtype, which the activations of
+    every module are copied into at once: they are flattened into one device
+    tensor per dtype, which is moved to host with a single non-blocking
+    transfer. The staged activations are views into the buffers, so they are
+    only valid until the next `stage`.
+    """
+
+    def __init__(self):
+        self.buffers: Dict[torch.dtype, Tensor] = {}
+
+    def get_buffer(self, dtype: torch.dtype, numel: int) -> Tensor:
+        buffer = self.buffers.get(dtype)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, pin_memory=torch.cuda.is_available())
+            self.buffers[dtype] = buffer
+        return buffer[:numel]
+
+    def stage(self, activations: Dict[str, Tensor]) -> Dict[str, Tensor]:
+        names_by_dtype = defaultdict(list)
+        for name, activation in activations.items():
+            names_by_dtype[activation.dtype].append(name)
+
+        staged = {}
+        is_cuda = False
+        for dtype, names in names_by_dtype.items():
+            flat = torch.cat([activations[name].detach().reshape(-1) for name in names])
+            is_cuda = is_cuda or flat.is_cuda
+            buffer = self.get_buffer(dtype, flat.numel())
+            buffer.copy_(flat, non_blocking=True)
+
+            offset = 0
+            for name in names:
+                activation = activations[name]
+                staged[name] = buffer[offset : offset + activation.numel()].view(activation.shape)
+                offset += activation.numel()
+
+        # Wait once for all of the asynchronous copies
+        if is_cuda:
+            torch.cuda.synchronize()
+        return staged
+
+
+def write_npy(array: np.ndarray, spill_dir: str) -> dict:
+    """
+    Write an array to a uniquely named .npy file, and return where its raw data
+    lives inside the file.
+    """
+    file_name = f"{uuid.uuid4().hex}.npy"
+    path = os.path.join(spill_dir, file_name)
+
+    # Write under a temporary name so readers never see a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+    return {
+        "path": file_name,
+        "shape": list(array.shape),
+        "offset": os.path.getsize(path) - array.nbytes,
+        "nbytes": array.nbytes,
+    }
+
+
+def spill_activation(
+    activation: Tensor,
+    activation_dtype: Optional[str] = None,
+    spill_dir: Optional[str] = None,
+) -> str:
+    """
+    Write an activation to the shared scratch directory instead of returning it
+    inline, and return a handle the gateway can serve byte ranges from.
+    """
+    spill_dir = spill_dir or ACTIVATION_SPILL_DIR
+    if not spill_dir:
+        raise ValueError("Set ACTIVATION_SPILL_DIR to spill activations to files")
+    os.makedirs(spill_dir, exist_ok=True)
+
+    data, scales, activation_dtype = cast_activation(activation, activation_dtype)
+    handle = {"dtype": activation_dtype, **write_npy(data, spill_dir)}
+    if scales is not None:
+        handle["scales"] = write_npy(scales, spill_dir)
+
+    return f"{HANDLE_PREFIX}:{json.dumps(handle)}"
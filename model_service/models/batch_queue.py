@@ -0,0 +1,164 @@
+"""Module for queueing work items until they are batched"""
+from collections import Counter, deque
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+
+# Requests waiting longer than this many seconds are batched before anything
+# else, and stop their batch from waiting for more work
+MAX_QUEUE_AGE = float(os.environ.get("MAX_QUEUE_AGE", 2.0))
+
+# The batching loops log their metrics at most once per this many seconds
+METRICS_LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", 60.0))
+
+
+class BatchingMetrics:
+    """Queue depth, queue wait times and batch fill of the batching loop"""
+
+    def __init__(self, window: int = 1024):
+        self.lock = threading.Lock()
+        self.wait_times = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.batch_fills = deque(maxlen=window)
+        self.queue_depth = 0
+        self.num_batches = 0
+        self.num_aged_batches = 0
+        self.last_logged = time.monotonic()
+
+    def record_batch(self, wait_times: List[float], queue_depth: int, aged: bool):
+        with self.lock:
+            self.wait_times.extend(wait_times)
+            self.batch_sizes.append(len(wait_times))
+            self.queue_depth = queue_depth
+            self.num_batches += 1
+            self.num_aged_batches += int(aged)
+
+    def record_fill(self, batch_fill: float):
+        """Fraction of the batch token budget used by a batch"""
+        with self.lock:
+            self.batch_fills.append(batch_fill)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            wait_times = np.array(self.wait_times or [0.0])
+            return {
+                "queue_depth": self.queue_depth,
+                "batches": self.num_batches,
+                "aged_batches": self.num_aged_batches,
+                "wait_time_p50": float(np.percentile(wait_times, 50)),
+                "wait_time_p99": float(np.percentile(wait_times, 99)),
+                "wait_time_max": float(wait_times.max()),
+                "batch_size_mean": float(np.mean(self.batch_sizes or [0])),
+                "batch_fill_mean": float(np.mean(self.batch_fills or [0.0])),
+            }
+
+    def log_due(self, interval: float = METRICS_LOG_INTERVAL) -> bool:
+        """Whether `interval` seconds passed since the metrics were last logged"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_logged < interval:
+                return False
+            self.last_logged = now
+            return True
+
+
+class BatchQueue:
+    """
+    Work items waiting to be batched, keyed by their unbatchable generation
+    args and ordered by cost within a key, like metaseq's
+    PriorityQueueRingShard. The batching loop blocks on a condition variable
+    instead of polling, and items older than `max_queue_age` seconds are
+    batched first so that large requests can't starve. The max queue age of
+    every model service defaults to the MAX_QUEUE_AGE environment variable.
+    """
+
+    def __init__(self, max_queue_age: float = MAX_QUEUE_AGE):
+        self.max_queue_age = max_queue_age
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        # Heaps of (cost, seq) per key, popped entries are dropped lazily
+        self.queues: Dict[Any, List[Tuple[int, int]]] = {}
+        # seq -> (key, item, enqueue time), in arrival order
+        self.pending: Dict[int, Tuple[Any, Any, float]] = {}
+        self.sizes = Counter()
+        self.metrics = BatchingMetrics()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, item):
+        key = item.queue_key()
+        with self.cond:
+            seq = next(self.counter)
+            heapq.heappush(self.queues.setdefault(key, []), (item.cost, seq))
+            self.pending[seq] = (key, item, time.monotonic())
+            self.sizes[key] += 1
+            self.cond.notify()
+
+    def _peek(self, key):
+        """Seq of the cheapest pending item of a key, if any"""
+        heap = self.queues.get(key)
+        while heap and heap[0][1] not in self.pending:
+            heapq.heappop(heap)
+        if not heap:
+            self.queues.pop(key, None)
+            return None
+        return heap[0][1]
+
+    def _pop(self, seq):
+        key, item, enqueue_time = self.pending.pop(seq)
+        self.sizes[key] -= 1
+        if not self.sizes[key]:
+            del self.sizes[key]
+        return item, enqueue_time
+
+    def get_batch(self, fits: Callable[[List, Any], bool], timeout: float) -> List:
+        """
+        Block until work is queued, then accumulate a batch of items sharing a
+        key, cheapest first, while `fits(batch, item)` holds. The key is the
+        one of the oldest item once it reached the max queue age, and
+        otherwise the one with the most items. While no item of the key is
+        queued, the batch waits up to `timeout` seconds for more, but never
+        past the max queue age of its oldest item.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending)
+
+            batch, enqueue_times = [], []
+            oldest_seq = next(iter(self.pending))
+            key, _, oldest_time = self.pending[oldest_seq]
+            aged = time.monotonic() - oldest_time >= self.max_queue_age
+            if aged:
+                item, enqueue_time = self._pop(oldest_seq)
+                batch.append(item)
+                enqueue_times.append(enqueue_time)
+            else:
+                key = max(self.sizes, key=self.sizes.get)
+
+            while True:
+                seq = self._peek(key)
+                if seq is None:
+                    deadline = min(enqueue_times) + self.max_queue_age
+                    wait = min(timeout, deadline - time.monotonic())
+                    if wait <= 0 or not self.cond.wait_for(
+                        lambda: self._peek(key) is not None, wait
+                    ):
+                        break
+                    continue
+
+                item = self.pending[seq][1]
+                if batch and not fits(batch, item):
+                    break
+                item, enqueue_time = self._pop(seq)
+                batch.append(item)
+                enqueue_times.append(enqueue_time)
+
+            now = time.monotonic()
+            self.metrics.record_batch([now - t for t in enqueue_times], len(self.pending), aged)
+            return batch
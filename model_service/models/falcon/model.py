@@ -1,4 +1,5 @@
 """Module for Falcon LLM configurations"""
+import functools
 import logging
 import numpy as np
 import json
@@ -6,14 +7,36 @@ import torch
 import os
 import pathlib
 import pprint
-
-from ..abstract_model import AbstractModel
-
-from pytriton.decorators import batch
+import threading
+
+from ..abstract_model import AbstractModel, Task
+from ..activation_capture import ActivationPayload
+from ..hf_hook_utils import (
+    apply_forward_hook,
+    decode_str,
+    encode_row_activations,
+    get_activation_capture_hook_dict,
+    get_capture_args,
+    index_modules,
+)
+from ..hf_scheduler import LengthBucketScheduler
+from ..memory_profiler import BatchLimits, generation_memory, model_devices, profile_hf_batch_limits
+from ..parameter_schema import ParameterSchema
+from ..pipeline import MicroBatchPipeline, balanced_device_map
+from ..quantization import get_quantization, quantize_model
+from ..sampling import RowSamplingLogitsProcessor, decode_generations, get_row_params
+from ..tokenization import ThreadLocalTokenizer
+
+from pytriton.decorators import batch, group_by_values
 from pytriton.model_config import ModelConfig, Tensor
-from accelerate import init_empty_weights, load_checkpoint_and_dispatch, infer_auto_device_map
-from accelerate.utils.modeling import get_balanced_memory
-from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+from accelerate import dispatch_model, init_empty_weights, load_checkpoint_and_dispatch
+from transformers import (
+    AutoConfig,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    GenerationConfig,
+    LogitsProcessorList,
+)
 
 
 logger = logging.getLogger("kaleidoscope.model_service.falcon")
@@ -36,17 +59,41 @@ class Model(AbstractModel):
         self.tokenizer_class = AutoTokenizer
         self.model = None
         self.tokenizer = None
+        self.thread_tokenizers = None
+        # Model instances run concurrently, but only one of them generates
+        self.gpu_lock = threading.Lock()
+        self.scheduler = None
+        self.pipeline = None
         self.model_cfg = None
         self.tokenizer_cfg = None
         self.device = None
         self.model_cfg_path = str(pathlib.Path(__file__).parent.resolve())
+        self.parameter_schema = ParameterSchema.from_config(
+            os.path.join(self.model_cfg_path, "config.json"))
+        logger.info(pprint.pformat(dict(self.parameter_schema.specs)))
 
 
     def load(self, model_path):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.load_model_cfg(os.path.join(self.model_cfg_path, "model_config.json"))
-
-        if self.model_variant == "40b":
+        quantization = get_quantization(
+            os.path.join(self.model_cfg_path, "config.json"), self.model_variant)
+
+        if quantization == "int8":
+            # Load and quantize on host, so only the int8 weights are ever
+            # moved to the GPUs, then dispatch them like unquantized weights
+            model_cfg = {k: v for k, v in self.model_cfg.items() if k != "device_map"}
+            self.model = self.model_class.from_pretrained(
+                model_path, low_cpu_mem_usage=True, **model_cfg)
+            quantize_model(self.model, self.device)
+            if self.model_variant == "40b" and self.device.type == "cuda":
+                device_map = balanced_device_map(
+                    self.model, no_split_module_classes=["MLP", "DecoderLayer"], dtype=None)
+                self.model = dispatch_model(self.model, device_map=device_map)
+                self.model.hf_device_map = device_map
+            else:
+                self.model.to(self.device)
+        elif self.model_variant == "40b":
             local_rank = int(os.getenv("LOCAL_RANK", "0"))
             world_size = torch.cuda.device_count()
             logger.info(f"Rank: {local_rank}")
@@ -59,12 +106,12 @@ class Model(AbstractModel):
                model = self.model_class.from_config(config, trust_remote_code=self.model_cfg["trust_remote_code"], torch_dtype=self.model_cfg["torch_dtype"])
             model.tie_weights()
 
-            # Configure memory per device and get device map
-            max_memory = {idx: "40GiB" for idx in range(world_size)}
-            max_memory.update({"cpu": "120GiB"})
-            device_map = infer_auto_device_map(model, max_memory, no_split_module_classes=["MLP", "DecoderLayer"])
-            logging.debug(f"Max memory: {max_memory}")
-            logging.debug(f"Device map: {device_map}")
+            # Spread the layers evenly over the free memory of every GPU
+            device_map = balanced_device_map(
+                model,
+                no_split_module_classes=["MLP", "DecoderLayer"],
+                dtype=self.model_cfg["torch_dtype"],
+            )
 
             self.model = load_checkpoint_and_dispatch(
                model, model_path, device_map=device_map, dtype=self.model_cfg["torch_dtype"]) 
@@ -72,11 +119,41 @@ class Model(AbstractModel):
             self.model = self.model_class.from_pretrained(model_path, **self.model_cfg) # TODO: .eval()?
             self.model.to(self.device)
 
+        index_modules(self.model)
         self.tokenizer = self.tokenizer_class.from_pretrained(model_path, **self.tokenizer_cfg)
         self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
+        self.thread_tokenizers = ThreadLocalTokenizer(self.tokenizer)
 
         self.model_path = model_path
 
+        # Models dispatched over several GPUs run their batches as pipelined
+        # micro-batches, so that all of the GPUs are busy
+        if len(model_devices(self.model)) > 1:
+            self.pipeline = MicroBatchPipeline(self.model, self.model.hf_device_map)
+            logger.info(f"Pipelining {self.pipeline.num_micro_batches} micro-batches "
+                        f"over {self.pipeline.num_stages} stages")
+
+        self.scheduler = LengthBucketScheduler(
+            run_batch=self.generate,
+            batch_memory=functools.partial(
+                generation_memory, self.model.config, next(self.model.parameters()).element_size()),
+            devices=model_devices(self.model),
+        )
+
+
+    def profile_batch_limits(self) -> BatchLimits:
+        """Size the batches from a profiling forward pass of the loaded model"""
+        limits = profile_hf_batch_limits(
+            self.model, getattr(self.model.config, "max_position_embeddings", 2048))
+        self.scheduler.max_batch_size = limits.max_batch_size
+        self.scheduler.max_batch_tokens = limits.max_batch_tokens
+        return limits
+
+
+    def get_tokenizer(self):
+        """A copy of the tokenizer for the calling thread"""
+        return self.thread_tokenizers.get()
+
 
     def load_model_cfg(self, cfg_file):
         """Load model and tokenzer config"""
@@ -93,38 +170,35 @@ class Model(AbstractModel):
             logger.error(f"Failed to load model configuration: {err}")
 
 
-    def load_default_args(self, cfg_file, task_name):
-        """Load default generation config"""
-        try:
-            with open(cfg_file, "r") as cfg_f:
-                cfg = json.load(cfg_f)
-            default_args = cfg["parameters"]
-            logger.info(pprint.pformat(default_args))
-            self.default_args = {k: v["default"][task_name] for k, v in default_args.items() if v["default"][task_name] is not None}
-        except Exception as err:
-            logger.error(f"Failed to load model default generation configuration: {err}")
-
-
     def bind(self, triton):
         triton.bind(
             model_name=f"{self.model_type}-{self.model_variant}",
-            infer_func=self.infer,
+            infer_func=self.infer_funcs(),
             inputs=[
                 Tensor(name="task", dtype=np.int64, shape=(1,)),
                 Tensor(name="prompts", dtype=bytes, shape=(1,)),
+                Tensor(name="modules", dtype=bytes, shape=(1,), optional=True),
                 Tensor(name='max_tokens', dtype=np.int64, shape=(1,), optional=True),
                 Tensor(name='min_tokens', dtype=np.int64, shape=(1,), optional=True),
                 Tensor(name='temperature', dtype=np.float64, shape=(1,), optional=True),
                 Tensor(name='top_p', dtype=np.float64, shape=(1,), optional=True),
                 Tensor(name='top_k', dtype=np.int64, shape=(1,), optional=True),
                 Tensor(name='do_sample', dtype=np.bool_, shape=(1,), optional=True),
+                Tensor(name='capture_policy', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='capture_positions', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='reducers', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='edits', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_dtype', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_compression', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_output', dtype=bytes, shape=(1,), optional=True),
             ],
             outputs=[
+                Tensor(name="activations", dtype=np.bytes_, shape=(-1,)),
                 Tensor(name="sequences", dtype=object, shape=(-1,)),
                 Tensor(name="tokens", dtype=object, shape=(-1,)),
-                Tensor(name="logprobs", dtype=np.float64, shape=(-1,)),
+                Tensor(name="logprobs", dtype=object, shape=(-1,)),
             ],
-            config=ModelConfig(max_batch_size=8), # TODO: set based on device memory and model variant
+            config=ModelConfig(max_batch_size=self.batch_limits.max_batch_size),
         )
         return triton
 
@@ -135,82 +209,181 @@ class Model(AbstractModel):
 
 
     @batch
+    @group_by_values("task")
     def infer(self, **inputs):
-        """Generate sequences from a prompt"""
-        self.load_default_args(os.path.join(self.model_cfg_path, "config.json"), "generate")
-        return self.generate(inputs)
+        """Dispatch request to a handler function based on the task"""
+        task = Task(inputs["task"][0][0])
+        if task == Task.GET_ACTIVATIONS:
+            return self.get_activations(inputs)
+        elif task == Task.EDIT_ACTIVATIONS:
+            return self.edit_activations(inputs)
+
+        # Generation requests are batched by the length scheduler
+        prompts = np.char.decode(inputs["prompts"].astype("bytes"), encoding="utf-8")
+        prompts = np.squeeze(prompts, axis=-1).tolist()
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        prompt_lens = [len(input_ids) for input_ids in self.get_tokenizer()(prompts).input_ids]
+        max_tokens = get_row_params(
+            inputs, "max_tokens", self.parameter_schema.defaults("generate")["max_tokens"],
+            len(prompts), np.int64)
+        return self.scheduler.submit(inputs, prompt_lens, max_tokens)
+
+
+    def get_activations(self, inputs):
+        """Retrieve activations for a list of prompts and list of module names"""
+        try:
+            params = self.parameter_schema.resolve("activations", inputs)
+            module_names = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
+            activation_payload = ActivationPayload(
+                module_names_activation_retrieval=[module_names.tolist()],
+                **get_capture_args(params),
+            )
+            response = self.generate(inputs, params, activation_payload)
+
+        # Handle all other errors
+        except Exception as err:
+            response = {}
+            response["activations"] = torch.empty(0)
+            response["error"] = f"Error with activations request: {err}"
+
+        return response
 
 
-    def generate(self, inputs):
+    def edit_activations(self, inputs):
+        """Edit activations for a list of prompts and list of modules"""
+        try:
+            params = self.parameter_schema.resolve("activations", inputs)
+
+            # Extract modules + editing functions from encoded request
+            decoded_modules = {}
+            if "modules" in inputs:
+                encoded_modules = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
+                decoded_modules = decode_str(str(encoded_modules))
+            editing_fns = {
+                module_name: edit_fn for module_name, edit_fn in decoded_modules.items()
+                if edit_fn is not None
+            }
+
+            # Declarative edits can also be given as JSON, eg.
+            # {"transformer.h.0.mlp": {"name": "scale", "factor": 0.0}}
+            module_edit_specs = params.get("edits")
+            if module_edit_specs is not None:
+                editing_fns.update(json.loads(module_edit_specs))
+
+            activation_payload = ActivationPayload(
+                module_names_activation_retrieval=list(
+                    dict.fromkeys([*decoded_modules.keys(), *editing_fns.keys()])
+                ),
+                module_editing_fn_pairs=editing_fns,
+                **get_capture_args(params),
+            )
+            response = self.generate(inputs, params, activation_payload)
+
+        # Handle all other errors
+        except Exception as err:
+            response = {}
+            response["activations"] = torch.empty(0)
+            response["error"] = f"Error with activations request: {err}"
+
+        return response
+
+
+    def generate(self, inputs, params=None, activation_payload=None):
+        """
+        Generate sequences from a batch of prompts, capturing and editing the
+        activations of the payload if any
+        """
+        if params is None:
+            params = self.parameter_schema.resolve("generate", inputs)
+
+        # Hooks see every forward call of the model, so activation requests
+        # are never split into micro-batches
+        with self.gpu_lock:
+            if self.pipeline is None or activation_payload is not None:
+                return self.generate_batch(inputs, params, activation_payload)
+            return self.pipeline.run(functools.partial(self.generate_batch, params=params), inputs)
+
+
+    def generate_batch(self, inputs, params, activation_payload=None):
+        """Generate sequences from one (micro-)batch of prompts"""
         # Encode prompts and get attention mask
         prompts = np.char.decode(inputs.pop("prompts").astype("bytes"), encoding="utf-8")
         prompts = np.squeeze(prompts, axis=-1).tolist()
-        encoded_obj = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        tokenizer = self.get_tokenizer()
+        encoded_obj = tokenizer(prompts, return_tensors="pt", padding=True)
         encoded_prompts = encoded_obj.input_ids
         attn_mask = encoded_obj.attention_mask
         encoded_prompts = encoded_prompts.to(self.device)
         attn_mask = attn_mask.to(self.device)
 
-        # Create generation config: Check the input parameters, and set default values if not present
+        # Every row keeps its own sampling parameters, so requests batched
+        # together by Triton don't need to agree on them. Check the input
+        # parameters, and set default values if not present
+        batch_size = len(prompts)
+        max_tokens = get_row_params(
+            inputs, "max_tokens", params["max_tokens"], batch_size, np.int64)
+        min_tokens = get_row_params(
+            inputs, "min_tokens", params.get("min_tokens", 0), batch_size, np.int64)
+        do_sample = get_row_params(inputs, "do_sample", params["do_sample"], batch_size, np.bool_)
+        temperature = get_row_params(inputs, "temperature", params["temperature"], batch_size)
+        top_p = get_row_params(inputs, "top_p", params["top_p"], batch_size)
+        top_k = get_row_params(inputs, "top_k", params["top_k"], batch_size, np.int64)
+
+        # The per-row processor does all of the sampling warps and stop
+        # lengths, greedy rows in a sampled batch get a temperature of zero
+        input_tokens_size = encoded_prompts.size()[-1]
+        sample = bool(do_sample.any())
+        logits_processor = RowSamplingLogitsProcessor(
+            input_len=input_tokens_size,
+            eos_token_id=self.tokenizer.eos_token_id,
+            max_new_tokens=max_tokens,
+            min_new_tokens=min_tokens,
+            temperature=np.where(do_sample, temperature, 0.0) if sample else None,
+            top_p=top_p,
+            top_k=top_k,
+        )
         gen_cfg = GenerationConfig(
-            min_new_tokens=inputs["min_tokens"][0][0] if "min_tokens" in inputs else self.default_args["min_tokens"],
-            max_new_tokens=inputs["max_tokens"][0][0] if "max_tokens" in inputs else self.default_args["max_tokens"],
-            temperature=inputs["temperature"][0][0] if "temperature" in inputs else self.default_args["temperature"],
-            top_p=inputs["top_p"][0][0] if "top_p" in inputs else self.default_args["top_p"],
-            top_k=int(inputs["top_k"][0][0]) if "top_k" in inputs else self.default_args["top_k"],
-            do_sample=bool(inputs["do_sample"][0][0]) if "do_sample" in inputs else self.default_args["do_sample"]
+            max_new_tokens=int(max_tokens.max()),
+            do_sample=sample,
+            temperature=1.0,
+            top_p=1.0,
+            top_k=0,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
         )
-        
+
         # Run the generation
-        input_tokens_size = encoded_prompts.size()[-1]
         input_ids = encoded_prompts if input_tokens_size != 0 else None
-        outputs = self.model.generate(
-            input_ids, 
-            gen_cfg, 
-            attention_mask=attn_mask, 
-            return_dict_in_generate=True, output_scores=True)
-        transition_scores = self.model.compute_transition_scores(
-            outputs.sequences, outputs.scores, normalize_logits=True)
-        generated_ids = outputs.sequences
-        # remove input tokens
-        generated_ids = generated_ids[:, input_tokens_size:]
-        # replace token_id 0 with a special token so that it is removed while decoding - EOS
-        generated_ids[generated_ids==0] = int(self.tokenizer.eos_token_id)
-        generations = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
-
-        # Get logprobs of generated tokens
-        tokens = []
-        logprobs = []
-        for sequence, probs in zip(generated_ids, transition_scores):
-            sequence_tokens = []
-            sequence_logprobs = []
-            for token, prob in zip(sequence, probs):
-                if token not in self.tokenizer.all_special_ids:
-                    sequence_tokens.append(self.tokenizer.decode(token))
-                    sequence_logprobs.append(prob.item())
-            tokens.append(sequence_tokens)
-            logprobs.append(sequence_logprobs)
+        hook_dict, activation_dict = {}, {}
+        if activation_payload is not None:
+            hook_dict, activation_dict = get_activation_capture_hook_dict(
+                self.model,
+                activation_payload,
+                total_len=input_tokens_size + int(max_tokens.max()),
+                attention_mask=attn_mask,
+            )
+        with apply_forward_hook(self.model, hook_dict, activation_dict):
+            outputs = self.model.generate(
+                input_ids, 
+                gen_cfg, 
+                logits_processor=LogitsProcessorList([logits_processor]),
+                attention_mask=attn_mask, 
+                return_dict_in_generate=True, output_scores=True)
+            transition_scores = self.model.compute_transition_scores(
+                outputs.sequences, outputs.scores, normalize_logits=True)
+        # Remove the input tokens, and replace token_id 0 with a special token
+        # so that it is removed while decoding - EOS
+        generated_ids = outputs.sequences[:, input_tokens_size:]
+        generated_ids[generated_ids == 0] = int(tokenizer.eos_token_id)
+        generations, tokens, logprobs = decode_generations(
+            tokenizer, generated_ids, transition_scores)
 
         return {
+            "activations": encode_row_activations(activation_dict, batch_size, params),
             "sequences": np.array(generations, dtype=object),
-            "tokens": np.array(tokens, dtype=object),
-            "logprobs": np.array(logprobs, dtype=np.float)
+            "tokens": tokens,
+            "logprobs": logprobs,
         }
-
-
-    @batch
-    def get_activations(self, request):
-        """Retrieve intermediate activations from Falcon model"""
-        response = self.generate(request)
-        response["activations"] = torch.empty(0)
-        response["error"] = "Activation retrival not implemented for Falcon model."
-        return response
-
-
-    @batch
-    def edit_activations(self, request):
-        """Edit intermediate activations from Falcon model"""
-        response = self.generate(request)
-        response["activations"] = torch.empty(0)
-        response["error"] = "Activation editing not implemented for Falcon model."
-        return response
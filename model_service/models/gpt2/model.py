@@ -1,21 +1,49 @@
 """Module for GPT2 LLM configurations"""
+import functools
+import json
 import logging
 import numpy as np
-import random
-import re
+import os
+import pathlib
 import sys
+import threading
 import torch
 
-from ..abstract_model import AbstractModel
-
-from pytriton.decorators import batch
+from ..abstract_model import AbstractModel, Task
+from ..activation_capture import ActivationPayload
+from ..hf_hook_utils import (
+    apply_forward_hook,
+    decode_str,
+    encode_row_activations,
+    get_activation_capture_hook_dict,
+    get_capture_args,
+    index_modules,
+)
+from ..hf_scheduler import LengthBucketScheduler
+from ..memory_profiler import BatchLimits, generation_memory, model_devices, profile_hf_batch_limits
+from ..parameter_schema import coerce_str
+from ..quantization import get_quantization, quantize_model
+from ..sampling import RowSamplingLogitsProcessor, get_row_params, split_rows, truncate_at_eos
+
+from pytriton.decorators import batch, group_by_values
 from pytriton.model_config import ModelConfig, Tensor
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from transformers import GPT2LMHeadModel, GPT2Tokenizer, LogitsProcessorList
 
 
 logger = logging.getLogger("kaleidoscope.model_service.gpt2")
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(name)s: %(message)s")
 
+# String inputs of the activation tasks
+ACTIVATION_INPUTS = (
+    "capture_policy",
+    "capture_positions",
+    "reducers",
+    "edits",
+    "activation_dtype",
+    "activation_compression",
+    "activation_output",
+)
+
 
 class Model(AbstractModel):
 
@@ -26,38 +54,73 @@ class Model(AbstractModel):
         self.model_variant = model_variant
         self.tokenizer_class = GPT2Tokenizer
         self.model = None
+        self.tokenizer = None
         self.device = None
+        # Model instances run concurrently, but only one of them generates
+        self.gpu_lock = threading.Lock()
+        self.scheduler = None
 
 
     def load(self, model_path):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model = self.model_class.from_pretrained(model_path)
         self.model_path = model_path
+        # Quantize on host, so only the int8 weights are ever moved to device
+        config_path = os.path.join(pathlib.Path(__file__).parent.resolve(), "config.json")
+        if get_quantization(config_path, self.model_variant) == "int8":
+            quantize_model(self.model, self.device)
         self.model.to(self.device)
+        index_modules(self.model)
+        self.tokenizer = self.tokenizer_class.from_pretrained(model_path)
+        self.tokenizer.padding_side = "left"
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.scheduler = LengthBucketScheduler(
+            run_batch=self.generate,
+            batch_memory=functools.partial(
+                generation_memory, self.model.config, next(self.model.parameters()).element_size()),
+            devices=model_devices(self.model),
+        )
+
+
+    def profile_batch_limits(self) -> BatchLimits:
+        """Size the batches from a profiling forward pass of the loaded model"""
+        limits = profile_hf_batch_limits(self.model, self.model.config.n_positions)
+        self.scheduler.max_batch_size = limits.max_batch_size
+        self.scheduler.max_batch_tokens = limits.max_batch_tokens
+        return limits
 
 
     def bind(self, triton):
         triton.bind(
             model_name=f"{self.model_type}{self.model_variant}",
-            infer_func=self.infer,
+            infer_func=self.infer_funcs(),
             inputs=[
                 Tensor(name="task", dtype=np.int64, shape=(1,)),
                 Tensor(name="prompts", dtype=bytes, shape=(1,)),
+                Tensor(name="modules", dtype=bytes, shape=(1,), optional=True),
                 Tensor(name='max_tokens', dtype=np.int64, shape=(1,), optional=True),
                 Tensor(name='min_tokens', dtype=np.int64, shape=(1,), optional=True),
                 Tensor(name='temperature', dtype=np.float64, shape=(1,), optional=True),
-                Tensor(name='top_p', dtype=np.int64, shape=(1,), optional=True),
+                Tensor(name='top_p', dtype=np.float64, shape=(1,), optional=True),
                 Tensor(name='top_k', dtype=np.int64, shape=(1,), optional=True),
-                Tensor(name='repetition_penalty', dtype=np.float64, shape=(1,), optional=True)
+                Tensor(name='repetition_penalty', dtype=np.float64, shape=(1,), optional=True),
+                *[
+                    Tensor(name=name, dtype=bytes, shape=(1,), optional=True)
+                    for name in ACTIVATION_INPUTS
+                ],
             ],
             outputs=[
+                Tensor(name="activations", dtype=np.bytes_, shape=(-1,)),
                 Tensor(name="sequences", dtype=np.bytes_, shape=(-1,)),
                 Tensor(name="tokens", dtype=object, shape=(-1,)),
                 Tensor(name="logprobs", dtype=object, shape=(-1,)),
             ],
-            config=ModelConfig(max_batch_size=128),
+            config=ModelConfig(max_batch_size=self.batch_limits.max_batch_size),
         )
-        return triton
+        return self.bind_metrics(triton, f"{self.model_type}{self.model_variant}")
+
+    def batching_metrics(self):
+        return self.scheduler.queue.metrics.snapshot()
 
 
     @property
@@ -66,96 +129,180 @@ class Model(AbstractModel):
 
 
     @batch
+    @group_by_values("task")
     def infer(self, **inputs):
-        """Generate sequences from a prompt"""
-        return self.generate(inputs)
+        """Dispatch request to a handler function based on the task"""
+        task = Task(inputs["task"][0][0])
+        if task == Task.GET_ACTIVATIONS:
+            return self.get_activations(inputs)
+        elif task == Task.EDIT_ACTIVATIONS:
+            return self.edit_activations(inputs)
+
+        # Generation requests are batched by the length scheduler
+        prompts = np.char.decode(inputs["prompts"].astype("bytes"), encoding="utf-8")
+        prompts = np.squeeze(prompts, axis=-1).tolist()
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        prompt_lens = [max(1, len(input_ids)) for input_ids in self.tokenizer(prompts).input_ids]
+        batch_size = len(prompts)
+        max_tokens = get_row_params(inputs, "max_tokens", 128, batch_size, np.int64)
+        # The repetition penalty applies to whole batches
+        repetition_penalty = get_row_params(inputs, "repetition_penalty", 1.0, batch_size)
+        return self.scheduler.submit(
+            inputs, prompt_lens, max_tokens, keys=[(penalty,) for penalty in repetition_penalty])
+
+
+    def get_activation_params(self, inputs):
+        """The string parameters of an activation request"""
+        params = {
+            name: coerce_str(inputs[name][0][0]) for name in ACTIVATION_INPUTS if name in inputs
+        }
+        params.setdefault("capture_policy", "all")
+        return params
+
+
+    def get_activations(self, inputs):
+        """Retrieve activations for a list of prompts and list of module names"""
+        try:
+            params = self.get_activation_params(inputs)
+            module_names = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
+            activation_payload = ActivationPayload(
+                module_names_activation_retrieval=[module_names.tolist()],
+                **get_capture_args(params),
+            )
+            response = self.generate(inputs, params, activation_payload)
+
+        # Handle all other errors
+        except Exception as err:
+            response = {}
+            response["activations"] = torch.empty(0)
+            response["error"] = f"Error with activations request: {err}"
+
+        return response
 
 
-    def generate(self, inputs):
+    def edit_activations(self, inputs):
+        """Edit activations for a list of prompts and list of modules"""
+        try:
+            params = self.get_activation_params(inputs)
+
+            # Extract modules + editing functions from encoded request
+            decoded_modules = {}
+            if "modules" in inputs:
+                encoded_modules = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
+                decoded_modules = decode_str(str(encoded_modules))
+            editing_fns = {
+                module_name: edit_fn for module_name, edit_fn in decoded_modules.items()
+                if edit_fn is not None
+            }
+
+            # Declarative edits can also be given as JSON, eg.
+            # {"transformer.h.0.mlp": {"name": "scale", "factor": 0.0}}
+            module_edit_specs = params.get("edits")
+            if module_edit_specs is not None:
+                editing_fns.update(json.loads(module_edit_specs))
+
+            activation_payload = ActivationPayload(
+                module_names_activation_retrieval=list(
+                    dict.fromkeys([*decoded_modules.keys(), *editing_fns.keys()])
+                ),
+                module_editing_fn_pairs=editing_fns,
+                **get_capture_args(params),
+            )
+            response = self.generate(inputs, params, activation_payload)
+
+        # Handle all other errors
+        except Exception as err:
+            response = {}
+            response["activations"] = torch.empty(0)
+            response["error"] = f"Error with activations request: {err}"
 
-        # Check the input parameters, and set default values if not present
-        max_tokens = inputs["max_tokens"][0][0] if "max_tokens" in inputs else 128
-        temperature = inputs["temperature"][0][0] if "temperature" in inputs else 1.0
-        top_p = inputs["top_p"][0][0] if "top_p" in inputs else 0.9
-        top_k = inputs["top_k"][0][0] if "top_k" in inputs else 0
-        repetition_penalty = inputs["repetition_penalty"][0][0] if "repetition_penalty" in inputs else 1.0
+        return response
 
-        # Load the tokenizer and encode prompts
-        tokenizer = self.tokenizer_class.from_pretrained(self.model_path)
+
+    def generate(self, inputs, params=None, activation_payload=None):
+        """
+        Generate sequences from a batch of prompts, capturing and editing the
+        activations of the payload if any
+        """
+        # Encode prompts, left padded so that generation continues every row
+        # from its last prompt token. Empty prompts start from BOS
+        tokenizer = self.tokenizer
         prompts = np.char.decode(inputs.pop("prompts").astype("bytes"), encoding="utf-8")
         prompts = np.squeeze(prompts, axis=-1).tolist()
-        encoded_prompt = tokenizer.encode(
-            prompts, add_special_tokens=False, return_tensors="pt"
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        prompts = [prompt or tokenizer.bos_token for prompt in prompts]
+        encoded_obj = tokenizer(prompts, return_tensors="pt", padding=True)
+        input_ids = encoded_obj.input_ids.to(self.device)
+        attn_mask = encoded_obj.attention_mask.to(self.device)
+        input_tokens_size = input_ids.size()[-1]
+
+        # Check the input parameters, and set default values if not present.
+        # Every row keeps its own sampling parameters
+        batch_size = len(prompts)
+        max_tokens = get_row_params(inputs, "max_tokens", 128, batch_size, np.int64)
+        min_tokens = get_row_params(inputs, "min_tokens", 0, batch_size, np.int64)
+        temperature = get_row_params(inputs, "temperature", 1.0, batch_size)
+        top_p = get_row_params(inputs, "top_p", 0.9, batch_size)
+        top_k = get_row_params(inputs, "top_k", 0, batch_size, np.int64)
+        repetition_penalty = (
+            float(inputs["repetition_penalty"][0][0]) if "repetition_penalty" in inputs else 1.0
         )
-        encoded_prompt = encoded_prompt.to(self.device)
 
-        # Run the generation
-        input_ids = encoded_prompt if encoded_prompt.size()[-1] != 0 else None
-        output_sequences = self.model.generate(
-            input_ids=input_ids,
-            max_length=max_tokens + len(encoded_prompt[0]),
+        # Run one generation over the padded batch, the per-row processor
+        # does the sampling warps and stop lengths
+        logits_processor = RowSamplingLogitsProcessor(
+            input_len=input_tokens_size,
+            eos_token_id=tokenizer.eos_token_id,
+            max_new_tokens=max_tokens,
+            min_new_tokens=min_tokens,
             temperature=temperature,
-            top_k=top_k,
             top_p=top_p,
-            repetition_penalty=repetition_penalty,
-            do_sample=True,
-            num_return_sequences=len(prompts),
+            top_k=top_k,
         )
-
-        # Remove the batch dimension when returning multiple sequences
-        if len(output_sequences.shape) > 2:
-            output_sequences.squeeze_()
+        hook_dict, activation_dict = {}, {}
+        if activation_payload is not None:
+            hook_dict, activation_dict = get_activation_capture_hook_dict(
+                self.model,
+                activation_payload,
+                total_len=input_tokens_size + int(max_tokens.max()),
+                attention_mask=attn_mask,
+            )
+        with self.gpu_lock, apply_forward_hook(self.model, hook_dict, activation_dict):
+            outputs = self.model.generate(
+                input_ids,
+                attention_mask=attn_mask,
+                max_new_tokens=int(max_tokens.max()),
+                temperature=1.0,
+                top_k=0,
+                top_p=1.0,
+                repetition_penalty=repetition_penalty,
+                do_sample=True,
+                logits_processor=LogitsProcessorList([logits_processor]),
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                return_dict_in_generate=True,
+                output_scores=True,
+            )
+            transition_scores = self.model.compute_transition_scores(
+                outputs.sequences, outputs.scores, normalize_logits=True)
+
+        # Remove the input tokens, and everything from the first EOS on
+        generated_ids, logprobs = truncate_at_eos(
+            outputs.sequences[:, input_tokens_size:], transition_scores, tokenizer.eos_token_id)
 
         generated_sequences = []
-        random_logprobs = []
-        random_tokens = []
-
-        logger.info(f"About to loop over output sequences...")
-        for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
-            logger.info(f"=== GENERATED SEQUENCE {generated_sequence_idx + 1} ===")
-            generated_sequence = generated_sequence.tolist()
-
-            # Decode text
-            text = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
-
-            # Remove all text after the stop token
-            #text = text[: text.find(stop_sequence) if stop_sequence else None]
-
-            # Add the prompt at the beginning of the sequence. 
-            # Remove the excess text that was used for pre-processing
-            total_sequence = text[
-                len(tokenizer.decode(encoded_prompt[0], clean_up_tokenization_spaces=True)) :
-            ]
-            generated_sequences.append(total_sequence.encode('utf-8').strip())
-
-            # TODO: Add the real text tokens
-            random_tokens.extend(re.split(r"(\s+)", total_sequence))
-
-            # TODO: Add the real logprobs
-            for _ in range(len(random_tokens)):
-                random_logprobs.append(random.uniform(-3, -0.001))
+        tokens = []
+        for sequence in generated_ids:
+            text = tokenizer.decode(sequence, clean_up_tokenization_spaces=True)
+            generated_sequences.append(text.encode("utf-8").strip())
+            tokens.append(tokenizer.convert_ids_to_tokens(sequence))
 
-        random_tokens = [random_tokens]
-        random_logprobs = [random_logprobs]
         return {
+            "activations": encode_row_activations(activation_dict, batch_size, params or {}),
             "sequences": np.array(generated_sequences, dtype=np.bytes_),
-            "tokens": np.array(random_tokens, dtype=object),
-            "logprobs": np.array(random_logprobs, dtype=object)
+            "tokens": split_rows([t for row in tokens for t in row], [len(row) for row in tokens]),
+            "logprobs": split_rows(
+                [p for row in logprobs for p in row], [len(row) for row in logprobs]),
         }
-
-
-    @batch
-    def get_activations(self, request):
-        """Retrieve intermediate activations from GPT2 model"""
-        response = self.generate(request)
-        response["activations"] = torch.empty(0)
-        response["error"] = "Activation retrival not implemented for GPT2 model."
-        return response
-
-    @batch
-    def edit_activations(self, request):
-        """Edit intermediate activations from GPT2 model"""
-        response = self.generate(request)
-        response["activations"] = torch.empty(0)
-        response["error"] = "Activation editing not implemented for GPT2 model."
-        return response
@@ -0,0 +1,249 @@
+"""Module for activation retrieval and editing on HuggingFace models"""
+import codecs
+from contextlib import contextmanager
+from functools import partial
+import json
+from typing import Any, Callable, Dict, Optional
+
+import cloudpickle
+import numpy as np
+import torch
+from torch import Tensor
+
+from .activation_capture import (
+    ActivationCapture,
+    ActivationPayload,
+    CapturePolicy,
+    get_reducer,
+    get_shard_edit,
+    synchronize_capture_streams,
+)
+from .activation_codec import encode_activation, spill_activation
+
+
+def decode_str(obj_in_str: str) -> Any:
+    """Unserialize an object which was pickled then base64 encoded"""
+    return cloudpickle.loads(codecs.decode(obj_in_str.encode("utf-8"), "base64"))
+
+
+def get_capture_args(params) -> Dict[str, Any]:
+    """
+    Parse the activation capture policy and per-module reducer specs of
+    the request parameters
+    """
+    capture_positions = params.get("capture_positions")
+    if capture_positions is not None:
+        capture_positions = [int(p) for p in capture_positions.split(",")]
+
+    # Reducers are given as JSON, eg. {"transformer.h.0": {"name": "topk", "k": 8}}
+    module_reducer_specs = params.get("reducers")
+    if module_reducer_specs is not None:
+        module_reducer_specs = json.loads(module_reducer_specs)
+
+    return {
+        "capture_policy": params.get("capture_policy") or "all",
+        "capture_positions": capture_positions,
+        "module_reducer_specs": module_reducer_specs,
+    }
+
+
+def index_modules(model: torch.nn.Module) -> Dict[str, torch.nn.Module]:
+    """
+    Build the name to module index of a freshly loaded model, which the
+    hooks of every request then look their modules up in
+    """
+    model.module_index = dict(model.named_modules())
+    return model.module_index
+
+
+def get_module_index(model: torch.nn.Module) -> Dict[str, torch.nn.Module]:
+    """Name to module index of a model, built on first use if not at load time"""
+    module_index = getattr(model, "module_index", None)
+    if module_index is None:
+        module_index = index_modules(model)
+    return module_index
+
+
+def replace_activation(outputs: Any, activation: Tensor) -> Any:
+    """Layer outputs with their activation, ie. their first tensor, replaced"""
+    if isinstance(outputs, tuple):
+        return (replace_activation(outputs[0], activation), *outputs[1:])
+    return activation
+
+
+def hf_forward_hook_fn(
+    registered_name: str,
+    capture: ActivationCapture,
+    editing_fn: Optional[Callable],
+    self: torch.nn.Module,
+    _inputs: Any,
+    outputs: Any,
+    aux: Optional[tuple] = None,
+    reducer_fn: Optional[Callable] = None,
+    shard_editing_fn: Optional[Callable] = None,
+) -> Any:
+    """
+    Forward hook for activation retrieval and editing on HuggingFace models.
+    These are never tensor parallel, but accelerate may dispatch their layers
+    over several GPUs. Everything happens on the device the layer ran on:
+    captures are copied to host straight from it, and edited activations are
+    returned as the new layer outputs, so no activation is moved between
+    devices. The layer outputs are never written in place, as other outputs
+    of the model may alias them.
+
+    Declarative edits see the whole activation as a single shard.
+    """
+    seq_len = capture.get_seq_len(outputs)
+    should_capture = capture.should_capture(seq_len)
+    if not should_capture and editing_fn is None and shard_editing_fn is None:
+        capture.advance(seq_len)
+        return None
+
+    activation = outputs
+    while isinstance(activation, tuple):
+        activation = activation[0]
+
+    edited = activation
+    if shard_editing_fn is not None:
+        edited = shard_editing_fn(edited, 0, capture.cursor)
+    if editing_fn is not None:
+        edited = editing_fn(edited)
+
+    if should_capture:
+        capture.capture(edited if reducer_fn is None else reducer_fn(edited))
+    capture.advance(seq_len)
+
+    if edited is activation:
+        return None
+    return replace_activation(outputs, edited)
+
+
+def get_activation_capture_hook_dict(
+    model: torch.nn.Module,
+    activation_payload: ActivationPayload,
+    total_len: Optional[int] = None,
+    attention_mask: Optional[Tensor] = None,
+):
+    """
+    Build the forward hooks and activation captures of a request on a
+    HuggingFace model. `total_len` is the padded prompt length plus the
+    longest generation, token positions are positions in the padded batch.
+    The attention mask of the prompts keeps their padding out of the `mean`
+    reducer, generated tokens are always counted.
+    """
+    activation_dict, hook_dict = {}, {}
+
+    module_names_activation_retrieval = dict.fromkeys(
+        activation_payload.module_names_activation_retrieval
+    )
+    module_editing_fn_pairs = activation_payload.module_editing_fn_pairs
+    module_names_hooked = dict.fromkeys(
+        [*module_names_activation_retrieval, *module_editing_fn_pairs]
+    )
+
+    module_index = get_module_index(model)
+    for n in module_names_hooked:
+        if n not in module_index:
+            raise ValueError(f"Module {n} not found in model")
+
+        editing_fn = module_editing_fn_pairs.get(n, None)
+
+        # Declarative edits are given as specs rather than callables
+        shard_editing_fn = None
+        if isinstance(editing_fn, (dict, list)):
+            shard_editing_fn = get_shard_edit(editing_fn)
+            editing_fn = None
+
+        reducer_fn, reduce_sequence = None, False
+        if n in activation_payload.module_reducer_specs:
+            reducer_fn, reduce_sequence = get_reducer(activation_payload.module_reducer_specs[n])
+
+        capture_policy = activation_payload.capture_policy
+        if n not in module_names_activation_retrieval:
+            capture_policy = CapturePolicy.NONE
+
+        activation_dict[n] = ActivationCapture(
+            registered_name=n,
+            policy=capture_policy,
+            positions=activation_payload.capture_positions,
+            total_len=total_len,
+            is_editing=editing_fn is not None or shard_editing_fn is not None,
+            reduce_sequence=reduce_sequence,
+            token_mask=attention_mask if reduce_sequence else None,
+        )
+        hook_dict[n] = partial(
+            hf_forward_hook_fn,
+            n,
+            activation_dict[n],
+            editing_fn,
+            reducer_fn=reducer_fn,
+            shard_editing_fn=shard_editing_fn,
+        )
+
+    return hook_dict, activation_dict
+
+
+@contextmanager
+def apply_forward_hook(
+    model: torch.nn.Module,
+    hook_dict: Dict[str, Callable],
+    activation_dict: Dict[str, ActivationCapture],
+):
+    """
+    Register the hooks of a request for the duration of a generation. Hooks
+    whose capture policy is satisfied are detached before the next forward
+    pass of the model.
+    """
+    module_index = get_module_index(model)
+    all_hooks = {
+        n: module_index[n].register_forward_hook(hook_fn) for n, hook_fn in hook_dict.items()
+    }
+
+    def detach_satisfied_hooks(_module, _inputs):
+        for n in list(all_hooks.keys()):
+            if activation_dict[n].is_detachable():
+                all_hooks.pop(n).remove()
+
+    detach_hook = model.register_forward_pre_hook(detach_satisfied_hooks) if all_hooks else None
+    try:
+        yield
+    finally:
+        for h in all_hooks.values():
+            h.remove()
+        if detach_hook is not None:
+            detach_hook.remove()
+
+
+def encode_row_activations(
+    activation_dict: Dict[str, ActivationCapture],
+    batch_size: int,
+    params,
+) -> np.ndarray:
+    """
+    Wait for the captures of a generation, and encode the activations of
+    every row of the batch for its own response
+    """
+    synchronize_capture_streams()
+    activations: Dict[str, Tensor] = {}
+    for n, capture in activation_dict.items():
+        activation = capture.result()
+        if activation is not None:
+            activations[n] = activation
+
+    rows = []
+    for idx in range(batch_size):
+        row = {}
+        for n, activation in activations.items():
+            if params.get("activation_output") == "file":
+                row[n] = spill_activation(
+                    activation[idx : idx + 1],
+                    activation_dtype=params.get("activation_dtype"),
+                )
+            else:
+                row[n] = encode_activation(
+                    activation[idx : idx + 1].clone(),
+                    activation_dtype=params.get("activation_dtype"),
+                    activation_compression=params.get("activation_compression"),
+                )
+        rows.append(str(row))
+    return np.array(rows, dtype=np.bytes_)
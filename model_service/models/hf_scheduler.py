@@ -0,0 +1,165 @@
+"""Module for scheduling the requests of HuggingFace models in length buckets"""
+from concurrent.futures import Future
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+from .batch_queue import BatchQueue
+from .memory_profiler import free_memory
+
+
+logger = logging.getLogger("kaleidoscope.model_service.hf_scheduler")
+
+# Seconds a batch waits for more rows of its bucket before it runs
+BATCH_TIMEOUT = float(os.environ.get("HF_BATCH_TIMEOUT", 0.05))
+# Largest number of rows generated together
+MAX_BATCH_SIZE = int(os.environ.get("HF_MAX_BATCH_SIZE", 64))
+# Fraction of the free device memory a batch may use
+MEMORY_FRACTION = float(os.environ.get("HF_MEMORY_FRACTION", 0.8))
+
+
+def length_bucket(length: int, min_length: int = 16) -> int:
+    """
+    The smallest power of two holding a length, so rows of a bucket are
+    padded to less than twice their length
+    """
+    return max(min_length, 1 << max(0, int(length) - 1).bit_length())
+
+
+class WorkItem:
+    """One row of a request, waiting to be batched"""
+
+    def __init__(self, row: Dict[str, np.ndarray], prompt_len: int, max_new_tokens: int, key=()):
+        self.row = row
+        self.prompt_len = int(prompt_len)
+        self.max_new_tokens = int(max_new_tokens)
+        self.cost = self.prompt_len
+        # Only rows with the same inputs given can be concatenated
+        self.key = (
+            length_bucket(self.prompt_len),
+            length_bucket(self.max_new_tokens),
+            frozenset(row),
+        ) + tuple(key)
+        self.future = Future()
+
+    def queue_key(self):
+        return self.key
+
+
+class LengthBucketScheduler:
+    """
+    Runs the rows of pytriton batches regrouped into batches of similar
+    prompt and generation lengths, rather than the batches Triton happened to
+    form. Rows are bucketed by powers of two of both lengths, so long and
+    short prompts never share a batch. A batch grows while its estimated
+    memory fits in the free memory of the model's GPUs, and its padded
+    tokens within the token budget sized at startup.
+
+    Rows are generated one batch at a time on a single scheduler thread,
+    while the model instances block on their rows' results.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Dict[str, np.ndarray]], Dict[str, np.ndarray]],
+        batch_memory: Callable[[int, int, int], int],
+        devices: Sequence[torch.device],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        timeout: float = BATCH_TIMEOUT,
+        memory_fraction: float = MEMORY_FRACTION,
+        max_batch_tokens: Optional[int] = None,
+    ):
+        self.run_batch = run_batch
+        self.batch_memory = batch_memory
+        self.devices = list(devices)
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.memory_fraction = memory_fraction
+        self.max_batch_tokens = max_batch_tokens
+        self.queue = BatchQueue()
+        self.thread = threading.Thread(
+            target=self.scheduling_loop, name="hf-scheduler", daemon=True
+        )
+        self.thread.start()
+
+    def submit(
+        self,
+        inputs: Dict[str, np.ndarray],
+        prompt_lens: Sequence[int],
+        max_new_tokens: Sequence[int],
+        keys: Optional[Sequence[tuple]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Queue the rows of a pytriton batch, and block until all of them are
+        generated. `keys` are extra values rows must share to be batched
+        together, like arguments which apply to a whole batch.
+        """
+        items = []
+        for idx, (prompt_len, gen_len) in enumerate(zip(prompt_lens, max_new_tokens)):
+            row = {name: value[idx : idx + 1] for name, value in inputs.items()}
+            item = WorkItem(row, prompt_len, gen_len, () if keys is None else keys[idx])
+            self.queue.put(item)
+            items.append(item)
+
+        # Rows are kept as slices, so that object rows like token lists stay
+        # one per row rather than being stacked into a 2-D array
+        rows = [item.future.result() for item in items]
+        return {name: np.concatenate([row[name] for row in rows]) for name in rows[0]}
+
+    def memory_budget(self) -> Optional[int]:
+        free = free_memory(self.devices)
+        return None if free is None else int(free * self.memory_fraction)
+
+    def scheduling_loop(self):
+        while True:
+            budget = None
+
+            def fits(batch: List[WorkItem], item: WorkItem) -> bool:
+                nonlocal budget
+                if len(batch) >= self.max_batch_size:
+                    return False
+                # The first check of a batch only runs once work is queued, so
+                # the free memory is read then, not before blocking for work
+                if len(batch) == 1:
+                    budget = self.memory_budget()
+                # A row alone always runs, however long it is
+                if batch and self.max_batch_tokens is not None:
+                    padded_len = max(x.prompt_len + x.max_new_tokens for x in batch + [item])
+                    if (len(batch) + 1) * padded_len > self.max_batch_tokens:
+                        return False
+                if budget is None:
+                    return True
+                memory = self.batch_memory(
+                    len(batch) + 1,
+                    max(x.prompt_len for x in batch + [item]),
+                    max(x.max_new_tokens for x in batch + [item]),
+                )
+                return memory <= budget
+
+            batch = self.queue.get_batch(fits, self.timeout)
+            logger.debug(
+                f"Running batch of {len(batch)} rows from bucket {batch[0].key[:2]}, "
+                f"{len(self.queue)} rows queued"
+            )
+            if self.queue.metrics.log_due():
+                logger.info(f"Batching metrics: {self.queue.metrics.snapshot()}")
+            try:
+                inputs = {
+                    name: np.concatenate([item.row[name] for item in batch])
+                    for name in batch[0].row
+                }
+                outputs = self.run_batch(inputs)
+            except Exception as err:
+                logger.error(f"Failed to run batch of {len(batch)} rows: {err}")
+                for item in batch:
+                    item.future.set_exception(err)
+                continue
+
+            for idx, item in enumerate(batch):
+                item.future.set_result(
+                    {name: value[idx : idx + 1] for name, value in outputs.items()}
+                )
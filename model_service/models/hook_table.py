@@ -0,0 +1,59 @@
+"""Module for forward hooks which requests switch on and off, shared by the model services"""
+from functools import partial
+from typing import Any, Callable, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+
+class ForwardHookTable:
+    def __init__(self, model: torch.nn.Module, hooked_types: Tuple[type, ...]) -> None:
+        """
+        Index of the model's modules built once at load time, along with a
+        persistent no-op forward hook on every module of the hooked types,
+        eg. those which have layer rules. Requests switch hooks on and off by
+        updating the `active_hooks` lookup table, instead of walking the
+        module tree and registering fresh hooks on every request.
+        """
+        self.module_index = dict(model.named_modules())
+        self.active_hooks = {}
+        self.handles = {}
+
+        for n, m in self.module_index.items():
+            if isinstance(m, hooked_types):
+                self.handles[n] = m.register_forward_hook(partial(self._dispatch, n))
+
+    def _dispatch(
+        self,
+        registered_name: str,
+        module: torch.nn.Module,
+        inputs: Any,
+        outputs: Any,
+    ) -> Optional[Tensor]:
+        hook_fn = self.active_hooks.get(registered_name, None)
+        if hook_fn is None:
+            return None
+        return hook_fn(module, inputs, outputs)
+
+    def enable(self, registered_name: str, hook_fn: Callable) -> "TableHookHandle":
+        """Switch on a hook, returns a handle which switches it off again."""
+        self.active_hooks[registered_name] = hook_fn
+        return TableHookHandle(self, registered_name)
+
+    def remove(self) -> None:
+        for h in self.handles.values():
+            h.remove()
+
+        self.handles.clear()
+        self.active_hooks.clear()
+
+
+class TableHookHandle:
+    """Mirrors `RemovableHandle` for hooks switched on in a `ForwardHookTable`"""
+
+    def __init__(self, table: ForwardHookTable, registered_name: str) -> None:
+        self.table = table
+        self.registered_name = registered_name
+
+    def remove(self) -> None:
+        self.table.active_hooks.pop(self.registered_name, None)
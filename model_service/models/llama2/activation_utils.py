@@ -1,5 +1,4 @@
-from dataclasses import dataclass
-from typing import Tuple, List, Union, Any, Optional
+from typing import Tuple, List, Union, Any, Optional, Callable
 
 from einops import rearrange
 import torch
@@ -16,6 +15,7 @@ from fairscale.nn.model_parallel.mappings import (
 )
 from fairscale.nn.model_parallel.initialize import (
     get_model_parallel_group,
+    get_model_parallel_rank,
 )
 from llama.model import (
     RMSNorm,
@@ -25,6 +25,24 @@ from llama.model import (
     Transformer,
 )
 
+# The capture, reducer and declarative edit machinery is shared with the
+# HuggingFace models, and re-exported here
+from models.activation_capture import (
+    ActivationCapture,
+    ActivationPayload,
+    CapturePolicy,
+    PendingGather,
+    ReducerFunctions,
+    ShardEditFunctions,
+    apply_row_edit,
+    apply_shard_edit,
+    compose_shard_edits,
+    gather_to_rank0,
+    get_reducer,
+    get_shard_edit,
+    synchronize_capture_streams,
+)
+
 
 _LayerOutput = Tuple[Any]
 _Activation = Union[Tensor, Tuple[Tensor]]
@@ -67,23 +85,20 @@ def scatter_from_rank0_to_tensor_model_parallel_region(
     return output
 
 
-@dataclass
-class ActivationPayload:
-    """
-    Payload object which contains all necessary information for every request
-    relevant to activation manipulation.
+def gather_to_rank0_from_model_parallel_region(
+    tensor: Tensor,
+    async_op: bool = True,
+) -> PendingGather:
     """
-    def __init__(
-        self,
-        module_names_activation_retrieval: Tuple,
-        module_editing_fn_pairs: Optional[dict] = None,
-    ) -> None:
-        self.module_names_activation_retrieval = module_names_activation_retrieval
+    Gather some tensor split along the last dimension onto rank0 only, unlike
+    `gather_from_model_parallel_region` which all-gathers it onto every rank.
 
-        if module_editing_fn_pairs is not None:
-            self.module_editing_fn_pairs = module_editing_fn_pairs
-        else:
-            self.module_editing_fn_pairs = {}
+    Note that this will not work for the general case where we have multiple
+    tensor model parallel groups. Where NCCL can't gather, ie. before torch
+    1.11 as pinned by the llama2 image, rank0 receives every other rank's
+    shard point-to-point, so it still moves no more data than a gather.
+    """
+    return gather_to_rank0(tensor, group=get_model_parallel_group(), async_op=async_op)
 
 
 class GatherFunctions:
@@ -162,6 +177,31 @@ class GatherFunctions:
             output = layer_output
         return output
 
+    # Retrieval-only gathers onto rank0, these return a `PendingGather`
+    @staticmethod
+    def unity_gather_to_rank0(
+        registered_name: str,
+        module: nn.Module,
+        layer_output: _LayerOutput,
+        aux: Tuple[Any],
+    ) -> PendingGather:
+        """
+        Layers with no sharded output use this. Every rank already holds the
+        full activation.
+        """
+        return PendingGather(layer_output=layer_output)
+
+    @staticmethod
+    def fairscale_column_parallel_linear_gather_to_rank0(
+        registered_name: str,
+        module: nn.Module,
+        layer_output: _LayerOutput,
+        aux: Tuple[Any],
+    ) -> PendingGather:
+        if not module.gather_output:
+            return gather_to_rank0_from_model_parallel_region(layer_output)
+        return PendingGather(layer_output=layer_output)
+
 
 class ScatterFunctions:
     """Class which holds all implemented scatter functions."""
@@ -564,6 +604,20 @@ class LayerRules:
                 Transformer,
             )
         }
+        self.gather_to_rank0_rules = {
+            self.gather_fns.unity_gather_to_rank0: (
+                RMSNorm,
+                RowParallelLinear,
+                ParallelEmbedding,
+                Attention,
+                FeedForward,
+                TransformerBlock,
+            ),
+            self.gather_fns.fairscale_column_parallel_linear_gather_to_rank0: (
+                ColumnParallelLinear,
+                Transformer,
+            ),
+        }
         self.scatter_rules = {
             self.scatter_fns.column_parallel_linear_scatter: (
             ),
@@ -631,6 +685,7 @@ class LayerRules:
                 for layer_type in layer_tuple
             }
         self.gather_rules = invert_dict(self.gather_rules)
+        self.gather_to_rank0_rules = invert_dict(self.gather_to_rank0_rules)
         self.scatter_rules = invert_dict(self.scatter_rules)
         self.rearrange_rules = invert_dict(self.rearrange_rules)
 
@@ -638,15 +693,39 @@ class LayerRules:
         # gather, scatter, and rearrange functions defined.
         for layer_type in self.defined_layers:
             assert (layer_type in self.gather_rules
+                    and layer_type in self.gather_to_rank0_rules
                     and layer_type in self.scatter_rules
                     and layer_type in self.rearrange_rules), ("{layer_type} missing a rule.")
 
+    def resolve_type(self, module_type):
+        """
+        The layer type a module's rules are defined for, which is a base class
+        of layers swapped to a subclass, like int8 quantized linear layers
+        """
+        for base in module_type.__mro__:
+            if base in self.defined_layers:
+                return base
+        return module_type
+
     def get_gather_function(self, module_type):
         if module_type in self.gather_rules:
             return self.gather_rules[module_type]
         else:
             raise Exception(f"Module: {module_type} missing gather rule")
 
+    def is_output_sharded(self, module: nn.Module) -> bool:
+        """
+        Whether each rank only holds its own slice of the last dimension of
+        the module output, rather than the full output.
+        """
+        return isinstance(module, ColumnParallelLinear) and not module.gather_output
+
+    def get_gather_to_rank0_function(self, module_type):
+        if module_type in self.gather_to_rank0_rules:
+            return self.gather_to_rank0_rules[module_type]
+        else:
+            raise Exception(f"Module: {module_type} missing gather to rank0 rule")
+
     def get_scatter_function(self, module_type):
         if module_type in self.scatter_rules:
             return self.scatter_rules[module_type]
@@ -687,15 +766,19 @@ class ShardedActivation:
         """
         self.registered_name = registered_name
         self.module = module
-        self.module_type = type(module)
+        self.module_type = LAYER_RULES.resolve_type(type(module))
         self.aux = aux
         self.layer_outputs = layer_outputs
         self.activations = None
 
         self.is_gathered = False
+        self.is_gathered_to_rank0 = False
         self.is_rearranged = False
+        self.pending_gather = None
 
         self.gather_fn = LAYER_RULES.get_gather_function(self.module_type)
+        self.gather_to_rank0_fn = LAYER_RULES.get_gather_to_rank0_function(
+            self.module_type)
         self.scatter_fn = LAYER_RULES.get_scatter_function(self.module_type)
         self.rearrange_fn = LAYER_RULES.get_rearrange_function(
             self.module_type)
@@ -719,6 +802,58 @@ class ShardedActivation:
         )
         self.is_gathered = True
 
+    def gather_to_rank0(self):
+        """
+        Retrieval-only alternative to `gather`. Starts an asynchronous gather
+        of the layer_outputs onto rank0 alone, which saves the bandwidth and
+        memory of handing every rank the full activation. Call `wait_gather`
+        before using the layer_outputs on rank0. Activations gathered this way
+        can't be scattered back.
+        """
+        assert not self.is_gathered, (f"Module: {self.registered_name} "
+                                      f"activation is already gathered!")
+
+        self.pending_gather = self.gather_to_rank0_fn(
+            self.registered_name,
+            self.module,
+            self.layer_outputs,
+            self.aux,
+        )
+        self.is_gathered = True
+        self.is_gathered_to_rank0 = True
+
+    def edit_local_shard(self, shard_editing_fn: Callable, cursor: int):
+        """
+        Runs a declarative shard-local editing function on this rank's shard
+        of the activation, without gathering it. `cursor` is the absolute
+        position of the first token in the current forward call.
+        """
+        assert not self.is_gathered, (f"Module: {self.registered_name} "
+                                      f"activation is already gathered!")
+
+        activations, undo_rearrange_fn = self.rearrange_fn(
+            self.registered_name,
+            self.module,
+            self.layer_outputs,
+            self.aux,
+        )
+
+        shard_start = 0
+        if LAYER_RULES.is_output_sharded(self.module):
+            shard_start = get_model_parallel_rank() * activations.shape[-1]
+
+        self.layer_outputs = undo_rearrange_fn(
+            shard_editing_fn(activations, shard_start, cursor)
+        )
+
+    def wait_gather(self):
+        """Wait for the gather started by `gather_to_rank0`."""
+        assert self.is_gathered_to_rank0
+
+        if self.pending_gather is not None:
+            self.layer_outputs = self.pending_gather.wait()
+            self.pending_gather = None
+
     def rearrange(self):
         """
         Rearrange functions take a Tuple of (registered_name, module,
@@ -759,6 +894,15 @@ class ShardedActivation:
                                                      "not pass verification.")
         self.activations = editing_fn(self.activations)
 
+    def reduce_activation(self, reducer_fn: Callable) -> Tensor:
+        """
+        Runs the reducer function on the activation and returns the reduced
+        activation. The activation itself is left untouched so it can still be
+        restored and scattered.
+        """
+        assert self.is_rearranged
+        return reducer_fn(self.activations)
+
     def undo_rearrange(self):
         """
         Undo rearrange functions are defined within the rearrange functions,
@@ -785,6 +929,9 @@ class ShardedActivation:
         """
         assert self.is_gathered, (f"Module: {self.registered_name} activation "
                                   f"is already sharded!")
+        assert not self.is_gathered_to_rank0, (f"Module: {self.registered_name} "
+                                               f"activation was only gathered "
+                                               f"to rank0")
         assert not self.is_rearranged
 
         self.layer_outputs = self.scatter_fn(
@@ -0,0 +1,59 @@
+"""Module for detokenizing the Llama generations of whole batches at once"""
+import typing
+from typing import List
+
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    from llama import Tokenizer
+
+
+class Detokenizer:
+    def __init__(self, tokenizer: "Tokenizer") -> None:
+        """
+        ID to piece lookup tables built once from the SentencePiece model, so
+        whole batches are detokenized with NumPy indexing rather than a
+        tokenizer call per token.
+        """
+        sp_model = tokenizer.sp_model
+        vocab_size = sp_model.vocab_size()
+
+        # Each token decoded on its own
+        self.token_strs = np.array(
+            [sp_model.decode([i]) for i in range(vocab_size)],
+            dtype=object,
+        )
+        # Raw bytes of each token, so that byte fallback tokens join into
+        # valid UTF-8 sequences
+        self.token_bytes = np.array(
+            [self._piece_bytes(sp_model, i) for i in range(vocab_size)],
+            dtype=object,
+        )
+
+    @staticmethod
+    def _piece_bytes(sp_model, token_id: int) -> bytes:
+        if sp_model.is_byte(token_id):
+            # Byte pieces look like <0x0A>
+            return bytes([int(sp_model.id_to_piece(token_id)[3:-1], 16)])
+        elif sp_model.is_control(token_id):
+            return b""
+        elif sp_model.is_unknown(token_id):
+            return " \u2047 ".encode("utf-8")
+        return sp_model.id_to_piece(token_id).replace("\u2581", " ").encode("utf-8")
+
+    def decode_tokens(self, sequences: List[List[int]]) -> List[List[str]]:
+        """Decode every token of every sequence on its own."""
+        return [
+            self.token_strs[np.asarray(sequence, dtype=np.int64)].tolist() for sequence in sequences
+        ]
+
+    def decode(self, sequences: List[List[int]]) -> List[str]:
+        """Decode every sequence into a single string."""
+        texts = []
+        for sequence in sequences:
+            text = b"".join(self.token_bytes[np.asarray(sequence, dtype=np.int64)]).decode(
+                "utf-8", errors="replace"
+            )
+            # SentencePiece drops the whitespace of the leading piece
+            texts.append(text[1:] if text.startswith(" ") else text)
+        return texts
@@ -32,6 +32,8 @@ from llama.model import (
 )
 
 import activation_utils
+from models.hf_hook_utils import hf_forward_hook_fn
+from models.hook_table import ForwardHookTable
 
 logger = logging.getLogger(__name__)
 
@@ -46,31 +48,81 @@ def decode_str(obj_in_str: str) -> Any:
     )
 
 
+def install_forward_hook_table(model: torch.nn.Module) -> ForwardHookTable:
+    """
+    Build the forward hook table of a freshly loaded model, which is then used
+    by `apply_forward_hook` and `get_activation_capture_hook_dict`.
+    """
+    model.forward_hook_table = ForwardHookTable(
+        model, activation_utils.LAYER_RULES.defined_layers)
+    return model.forward_hook_table
+
+
+def get_module_index(model: torch.nn.Module) -> Dict[str, torch.nn.Module]:
+    """Name to module index, precomputed if the model has a hook table."""
+    hook_table = getattr(model, "forward_hook_table", None)
+    if hook_table is not None:
+        return hook_table.module_index
+    return dict(model.named_modules())
+
+
 @contextmanager
 def apply_forward_hook(
     model: torch.nn.Module,
     hook_dict: Dict[str, Callable],
+    activation_dict: Optional[Dict[str, activation_utils.ActivationCapture]] = None,
 ) -> None:
     """
     Hook dict should be names of modules keyed by functions all hooks must
-    have the actual signature as the register forward hook in pytorch
-    """
-    all_hooks = []
+    have the actual signature as the register forward hook in pytorch.
 
+    If the activation captures are given, hooks whose capture policy is
+    satisfied are detached before the next forward pass of the model.
 
-    for n, m in model.named_modules():
-        if n in hook_dict:
-            all_hooks.append(m.register_forward_hook(hook_dict[n]))
+    Models with a forward hook table only have their hooks switched on in the
+    table, other modules get a regular forward hook registered.
+    """
+    all_hooks = {}
+    detach_hook = None
+
+    hook_table = getattr(model, "forward_hook_table", None)
+    module_index = get_module_index(model)
+
+    for n, hook_fn in hook_dict.items():
+        if n not in module_index:
+            continue
+        if hook_table is not None and n in hook_table.handles:
+            all_hooks[n] = hook_table.enable(n, hook_fn)
+        else:
+            all_hooks[n] = module_index[n].register_forward_hook(hook_fn)
+
+    def detach_satisfied_hooks(_module, _inputs):
+        # Hooks can't safely remove themselves while pytorch iterates over
+        # them, so satisfied hooks are removed from the root module instead
+        for n in list(all_hooks.keys()):
+            if activation_dict[n].is_detachable():
+                all_hooks.pop(n).remove()
+
+    if activation_dict is not None:
+        detach_hook = model.register_forward_pre_hook(detach_satisfied_hooks)
 
     try:
         yield
 
     finally:
-        for h in all_hooks:
+        # Capture the activations whose gathers are still in flight
+        if activation_dict is not None:
+            for capture in activation_dict.values():
+                capture.flush()
+
+        for h in all_hooks.values():
             h.remove()
 
         all_hooks.clear()
 
+        if detach_hook is not None:
+            detach_hook.remove()
+
 
 def get_activation_capture_hook_dict(
     model: torch.nn.Module,
@@ -81,6 +133,9 @@ def get_activation_capture_hook_dict(
     """
     Attach the specified hook forward-pass hook functions onto the given
     model. The model types are one of [opt, hf]
+
+    The returned activation dict maps each module name to the
+    `ActivationCapture` holding its captured activation.
     """
     activation_dict, hook_dict = {}, {}
 
@@ -93,31 +148,72 @@ def get_activation_capture_hook_dict(
     else:
         activation_payload = decode_str(encoded_activation_payload)
 
-    module_names_activation_retrieval = set(
+    # Deduplicate while keeping the requested order, which is the same on
+    # every rank. Modules which are only edited get hooks but no captures
+    module_names_activation_retrieval = dict.fromkeys(
         activation_payload.module_names_activation_retrieval
     )
     module_editing_fn_pairs = activation_payload.module_editing_fn_pairs
+    module_names_hooked = dict.fromkeys(
+        [*module_names_activation_retrieval, *module_editing_fn_pairs]
+    )
+
+    # aux is (batch size, total generation length, prompt lengths)
+    total_len = aux[1] if aux is not None and len(aux) > 1 else None
+    prompt_lens = aux[2] if aux is not None and len(aux) > 2 else None
+
+    module_index = get_module_index(model)
+
+    for n in module_names_hooked:
+        if n in module_index:
+            editing_fn = module_editing_fn_pairs.get(n, None)
+
+            # Declarative edits are given as specs rather than callables
+            shard_editing_fn = None
+            if isinstance(editing_fn, (dict, list)):
+                shard_editing_fn = activation_utils.get_shard_edit(editing_fn)
+                editing_fn = None
+
+            reducer_fn, reduce_sequence = None, False
+            if n in activation_payload.module_reducer_specs:
+                reducer_fn, reduce_sequence = activation_utils.get_reducer(
+                    activation_payload.module_reducer_specs[n]
+                )
+
+            capture_policy = activation_payload.capture_policy
+            if n not in module_names_activation_retrieval:
+                capture_policy = activation_utils.CapturePolicy.NONE
 
-    for n, m in model.named_modules():
-        editing_fn = module_editing_fn_pairs.get(n, None)
+            activation_dict[n] = activation_utils.ActivationCapture(
+                registered_name=n,
+                policy=capture_policy,
+                positions=activation_payload.capture_positions,
+                total_len=total_len,
+                is_editing=editing_fn is not None or shard_editing_fn is not None,
+                reduce_sequence=reduce_sequence,
+                prompt_lens=prompt_lens,
+            )
 
-        if n in module_names_activation_retrieval:
             if model_type == "opt":
                 hook_dict[n] = partial(
                     generic_forward_hook_fn,
                     n,
-                    activation_dict,
+                    activation_dict[n],
                     editing_fn,
                     aux=aux,
+                    reducer_fn=reducer_fn,
+                    shard_editing_fn=shard_editing_fn,
                 )
 
             elif model_type == "hf":
                 hook_dict[n] = partial(
                     hf_forward_hook_fn,
                     n,
-                    activation_dict,
+                    activation_dict[n],
                     editing_fn,
                     aux=aux,
+                    reducer_fn=reducer_fn,
+                    shard_editing_fn=shard_editing_fn,
                 )
 
     return hook_dict, activation_dict
@@ -125,20 +221,34 @@ def get_activation_capture_hook_dict(
 
 def generic_forward_hook_fn(
     registered_name: str,
-    save_dict: Dict[str, Tensor],
+    capture: activation_utils.ActivationCapture,
     editing_fn: Callable,
     self: torch.nn.Module,
     _inputs: Any,
     outputs: Any,
     aux: Optional[tuple] = None,
+    reducer_fn: Optional[Callable] = None,
+    shard_editing_fn: Optional[Callable] = None,
 ) -> Optional[Tensor]:
     """
     Generic forward hook function that can be used for activation retrieval,
     editing, etc.
+
+    Arbitrary editing functions run on rank0 on the full activation, while
+    declarative shard editing functions run on every rank on its own shard.
     """
 
     #logger.info(f"Rank {torch.distributed.get_rank()}: Starting layer {registered_name} fwd hook")
 
+    seq_len = capture.get_seq_len(outputs)
+    should_capture = capture.should_capture(seq_len)
+
+    # Every rank agrees on the capture policy, so forward calls which are
+    # neither captured nor edited can skip the collective gather entirely
+    if not should_capture and editing_fn is None and shard_editing_fn is None:
+        capture.advance(seq_len)
+        return
+
     activation = activation_utils.ShardedActivation(
         registered_name=registered_name,
         module=self,
@@ -146,6 +256,22 @@ def generic_forward_hook_fn(
         layer_outputs=outputs,
     )
 
+    # Declarative edits need no collectives, every rank edits its own shard
+    edited_outputs = None
+    if shard_editing_fn is not None:
+        activation.edit_local_shard(shard_editing_fn, capture.cursor)
+        edited_outputs = activation.layer_outputs
+
+    # Retrieval-only activations are gathered onto rank0 alone. The gather is
+    # asynchronous and only waited on once the next one is started (or the
+    # hooks are removed), so it overlaps the rest of the forward pass
+    if editing_fn is None:
+        if should_capture:
+            activation.gather_to_rank0()
+            capture.defer(activation, reducer_fn)
+        capture.advance(seq_len)
+        return edited_outputs
+
     # Gather the full activation using all ranks
     activation.gather()
 
@@ -158,40 +284,24 @@ def generic_forward_hook_fn(
         if editing_fn is not None:
             activation.edit_activation(editing_fn)
 
-        # Bind a copy of output to save dict
-        save_dict[registered_name] = activation.activations.detach().cpu()
+        # Reduce on-device, then asynchronously copy the captured part of the
+        # edited activation to host
+        if should_capture:
+            if reducer_fn is not None:
+                capture.capture(activation.reduce_activation(reducer_fn))
+            else:
+                capture.capture(activation.activations)
 
         # Undo the rearrange to perfectly reconstruct original full activation
         # post-gather
         activation.undo_rearrange()
 
-        if editing_fn is None:
-            return
-
-    # Shed non-rank0 workers if they aren't neede
-    else:
-        if editing_fn is None:
-            return
+    capture.advance(seq_len)
 
-    # If the activation was edited we need to return it. Scatter the edited
+    # The activation was edited so we need to return it. Scatter the edited
     # full activation to all ranks, then return the sharded activation
-    if editing_fn is not None:
-        # Scatter the output to each rank
-        activation.scatter()
+    activation.scatter()
 
     logger.info(f"Rank {torch.distributed.get_rank()}: Finished layer {registered_name} fwd hook")
 
     return activation.layer_outputs
-
-
-def hf_forward_hook_fn(
-    registered_name: str,
-    save_dict: Dict[str, Tensor],
-    editing_fn: Callable,
-    self: torch.nn.Module,
-    _inputs: Any,
-    outputs: Any,
-    aux: Optional[tuple] = None,
-) -> Optional[Tensor]:
-    # TODO
-    pass
@@ -1,10 +1,12 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import logging
 import json
 import os
 import sys
 import time
-from typing import List, Any, Dict, Tuple
+from typing import List, Any, Dict, Optional, Tuple, Union
 import uuid
 from pathlib import Path
 
@@ -13,16 +15,44 @@ import torch
 from torch import Tensor
 from fairscale.nn.model_parallel.initialize import initialize_model_parallel
 from llama import ModelArgs, Transformer, Tokenizer, Llama
+from models.llama2.sizing_utils import checkpoint_files, llama_batch_memory, shard_weight_bytes
+from models.memory_profiler import (
+    BatchLimits,
+    device_free_memory,
+    min_across_ranks,
+    size_batch_limits,
+)
+from models.quantization import quantize_model
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+except ImportError:
+    safe_open = None
+
+
+# Number of threads streaming checkpoint tensors to the device
+LOAD_THREADS = int(os.environ.get("LLAMA_LOAD_THREADS", 8))
 
 
 @dataclass
 class RequestObject:
-    """Request object for generation."""
+    """
+    Request object for generation. Sampling parameters are either one value
+    for the whole batch or a list with one value per prompt.
+    """
     prompts: List[str]
-    max_gen_len: int = 256
-    temperature: float = 0.8
-    top_p: float = 0.95
+    max_gen_len: Union[int, List[int]] = 256
+    temperature: Union[float, List[float]] = 0.8
+    top_p: Union[float, List[float]] = 0.95
+    top_k: Union[int, List[int]] = 0
     encoded_activation_payload: str = None   # TODO: Typehint
+    activation_dtype: str = None
+    activation_compression: str = None
+    activation_output: str = None
+    cache_activations: bool = False
+    # Encode the activations of every row on their own, rather than batched
+    split_activations: bool = False
     _aux: Tuple[Any] = None
 
 
@@ -31,7 +61,8 @@ class ResponseObject:
     """OpenAI API response-like object."""
     generations: List[str]
     logprobs: List[float]
-    activations: Dict[str, Tensor]
+    activations: Union[Dict[str, Tensor], List[Dict[str, Tensor]]]
+    activation_cache_handle: str = None
 
     def __post_init__(self):
         self._response_id = str(uuid.uuid4())
@@ -50,6 +81,7 @@ class ResponseObject:
                     "text": self.generations,
                     "logprobs": self.logprobs,
                     "activations": self.activations,
+                    "activation_cache_handle": self.activation_cache_handle,
                 }
             ]
         }
@@ -82,6 +114,90 @@ def setup_model_parallel() -> Tuple[int, int]:
     return global_rank, global_world_size
 
 
+def convert_checkpoint_to_safetensors(ckpt_path: Path) -> Optional[Path]:
+    """
+    One-time conversion of a .pth checkpoint shard into a .safetensors file
+    next to it, which can then be memory-mapped. Returns None if the
+    checkpoint directory isn't writable.
+    """
+    safetensors_path = ckpt_path.with_suffix(".safetensors")
+    if not os.access(ckpt_path.parent, os.W_OK):
+        return None
+
+    checkpoint = torch.load(ckpt_path, map_location="cpu")
+    # Write under a temporary name so other ranks never see a partial file
+    tmp_path = safetensors_path.with_suffix(".safetensors.tmp")
+    save_file(
+        {k: v.contiguous() for k, v in checkpoint.items()},
+        str(tmp_path),
+        metadata={"format": "pt"},
+    )
+    os.replace(tmp_path, safetensors_path)
+    return safetensors_path
+
+
+def stream_safetensors_to_model(
+    model: torch.nn.Module,
+    safetensors_path: Path,
+    num_threads: int = LOAD_THREADS,
+) -> None:
+    """
+    Copy the tensors of a memory-mapped safetensors checkpoint into the model
+    parameters on device, one transformer layer per task of a thread pool.
+    Only the layers being copied are ever paged into host memory.
+    """
+    state_dict = model.state_dict()
+
+    with safe_open(str(safetensors_path), framework="pt", device="cpu") as f:
+        names = [name for name in f.keys() if name in state_dict]
+
+    # Group the tensors by transformer layer, eg. layers.12.attention.wq
+    layer_names = defaultdict(list)
+    for name in names:
+        parts = name.split(".")
+        layer = ".".join(parts[:2]) if parts[0] == "layers" else parts[0]
+        layer_names[layer].append(name)
+
+    def load_layer(names_in_layer):
+        # Every thread gets its own handle onto the memory map
+        with safe_open(str(safetensors_path), framework="pt", device="cpu") as f:
+            for name in names_in_layer:
+                with torch.no_grad():
+                    state_dict[name].copy_(f.get_tensor(name))
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # Consume the results to surface any exception
+        list(executor.map(load_layer, layer_names.values()))
+
+
+def size_llama_batch_limits(
+    ckpt_dir: str,
+    tokenizer_path: str,
+    local_rank: int,
+    world_size: int,
+    max_seq_len: int,
+    quantization: Optional[str] = None,
+) -> BatchLimits:
+    """
+    Size the KV cache of a model parallel Llama before it is built, as it is
+    allocated up front for the max batch size and sequence length. The
+    memory of a batch is estimated from the model dims, see
+    `llama_batch_memory`. Every rank agrees on the limits of the rank with
+    the least free memory.
+    """
+    logger = build_host_logger()
+    vocab_size = Tokenizer(model_path=tokenizer_path).n_words
+
+    # The weights aren't loaded yet, so take the size of this rank's share
+    weight_bytes = shard_weight_bytes(ckpt_dir, world_size, vocab_size, quantization)
+    free = min_across_ranks(max(0, device_free_memory() - weight_bytes))
+    logger.info(f"Sizing batches of rank {local_rank}/{world_size} for "
+                f"{free} bytes of free memory after {weight_bytes} bytes of "
+                f"weights")
+    batch_memory = llama_batch_memory(ckpt_dir, world_size, vocab_size)
+    return size_batch_limits(batch_memory, free, max_seq_len)
+
+
 def load_llama(
     ckpt_dir: str,
     tokenizer_path: str,
@@ -89,16 +205,34 @@ def load_llama(
     world_size: int,
     max_seq_len: int,
     max_batch_size: int,
+    quantization: Optional[str] = None,
 ) -> Llama:
     logger = build_host_logger()
-    checkpoints = sorted(Path(ckpt_dir).glob("*.pth"))
+    checkpoints = checkpoint_files(ckpt_dir)
     if torch.distributed.is_initialized():
         assert torch.distributed.get_world_size() == len(
             checkpoints
         ), (f"Loading a checkpoint for MP={len(checkpoints)} but world size is "
             f"{world_size}")
     ckpt_path = checkpoints[local_rank]
-    checkpoint = torch.load(ckpt_path, map_location="cpu")
+
+    # Prefer a memory-mapped safetensors shard, converting the .pth once
+    start_time = time.time()
+    safetensors_path = None
+    checkpoint = None
+    if safe_open is not None and ckpt_path.suffix == ".safetensors":
+        safetensors_path = ckpt_path
+    elif safe_open is not None:
+        safetensors_path = ckpt_path.with_suffix(".safetensors")
+        if not safetensors_path.exists():
+            safetensors_path = convert_checkpoint_to_safetensors(ckpt_path)
+            logger.info(f"Converted {ckpt_path} to safetensors in "
+                        f"{time.time() - start_time:.2f} seconds")
+    if safetensors_path is None:
+        checkpoint = torch.load(ckpt_path, map_location="cpu")
+        logger.info(f"Loaded {ckpt_path} in {time.time() - start_time:.2f} "
+                    f"seconds")
+
     with open(Path(ckpt_dir) / "params.json", "r") as f:
         params = json.loads(f.read())
 
@@ -109,11 +243,34 @@ def load_llama(
     logger.info(f"Hosting utils tokenizer: {tokenizer}")
     logger.info(f"Hosting utils dir(tokenizer): {dir(tokenizer)}")
     model_args.vocab_size = tokenizer.n_words
-    torch.set_default_tensor_type(torch.cuda.HalfTensor)
+
+    # Quantized models are built and loaded on host, so only the int8
+    # weights are ever moved to device. The KV caches are always allocated
+    # on device.
+    start_time = time.time()
+    if quantization == "int8":
+        torch.set_default_tensor_type(torch.HalfTensor)
+    else:
+        torch.set_default_tensor_type(torch.cuda.HalfTensor)
     logger.info(f"Hosting utils model_args: {model_args}")
     model = Transformer(model_args)
     torch.set_default_tensor_type(torch.FloatTensor)
-    model.load_state_dict(checkpoint, strict=False)
+    logger.info(f"Built model in {time.time() - start_time:.2f} seconds")
+
+    start_time = time.time()
+    if safetensors_path is not None:
+        stream_safetensors_to_model(model, safetensors_path)
+    else:
+        model.load_state_dict(checkpoint, strict=False)
+        del checkpoint
+    logger.info(f"Loaded weights in {time.time() - start_time:.2f} seconds")
+
+    if quantization == "int8":
+        start_time = time.time()
+        quantize_model(model, torch.device("cuda"))
+        model.cuda()
+        logger.info(f"Quantized and moved weights to device in "
+                    f"{time.time() - start_time:.2f} seconds")
 
     generator = Llama(model, tokenizer)
     return generator
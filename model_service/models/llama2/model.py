@@ -5,6 +5,7 @@ from collections import defaultdict
 import json
 import logging
 import numpy as np
+import os
 import pathlib
 import pickle
 import pprint
@@ -15,9 +16,17 @@ import sys
 import threading
 import time
 import torch
-from typing import Dict, Callable
+import torch.nn.functional as F
+from typing import Dict, Callable, List
 
 from ..abstract_model import AbstractModel, Task
+from ..activation_cache import ActivationCache
+from ..activation_codec import encode_activation, spill_activation
+from ..parameter_schema import ParameterSchema
+from ..quantization import get_quantization
+from ..sampling import get_row_params, sample_per_row
+from ..sweep import run_sweep
+from ..tokenization import TokenizationStage
 from pytriton.decorators import batch, group_by_values
 from pytriton.model_config import ModelConfig, Tensor
 
@@ -27,15 +36,21 @@ sys.path.append(cwd)
 
 from llama import ModelArgs, Transformer, Tokenizer, Llama
 import distributed_utils
+from detokenizer import Detokenizer
 from hosting_utils import (
     RequestObject,
     ResponseObject,
     build_host_logger,
     setup_model_parallel,
     load_llama,
+    size_llama_batch_limits,
 )
-from hook_utils import get_activation_capture_hook_dict, apply_forward_hook
-from activation_utils import ActivationPayload
+from hook_utils import (
+    get_activation_capture_hook_dict,
+    apply_forward_hook,
+    install_forward_hook_table,
+)
+from activation_utils import ActivationPayload, synchronize_capture_streams
 
 
 def encode_obj(obj):
@@ -59,12 +74,101 @@ def get_free_port():
     return sock.getsockname()[1]
 
 
+def per_row(value, batch_size):
+    """One value per row, from either a scalar or a list of values"""
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value] * batch_size
+
+
+def get_total_len(max_seq_len, request_object):
+    """Number of positions generation runs over, given each row's max length"""
+    max_gen_lens = per_row(request_object.max_gen_len, len(request_object.prompts))
+    return min(
+        max_seq_len,
+        max(len(p) + g for p, g in zip(request_object.prompts, max_gen_lens)),
+    )
+
+
+@torch.inference_mode()
+def generate_per_row(generator, request_object):
+    """
+    Mirrors `Llama.generate`, except every row has its own temperature, top-p,
+    top-k and max generation length. All rows are sampled in one vectorized
+    step, and generation stops as soon as every row hit EOS or its own length.
+    """
+    params = generator.model.params
+    tokenizer = generator.tokenizer
+    prompt_tokens = request_object.prompts
+    bsz = len(prompt_tokens)
+    assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
+
+    max_gen_lens = per_row(request_object.max_gen_len, bsz)
+    temperature = torch.tensor(
+        per_row(request_object.temperature, bsz), dtype=torch.float, device="cuda")
+    top_p = torch.tensor(per_row(request_object.top_p, bsz), dtype=torch.float, device="cuda")
+    top_k = torch.tensor(per_row(request_object.top_k, bsz), dtype=torch.long, device="cuda")
+
+    min_prompt_len = min(len(t) for t in prompt_tokens)
+    assert max(len(t) for t in prompt_tokens) <= params.max_seq_len
+    total_len = get_total_len(params.max_seq_len, request_object)
+
+    pad_id = tokenizer.pad_id
+    tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device="cuda")
+    for k, t in enumerate(prompt_tokens):
+        tokens[k, :len(t)] = torch.tensor(t, dtype=torch.long, device="cuda")
+    token_logprobs = torch.zeros_like(tokens, dtype=torch.float)
+
+    # Rows are done once they reach EOS or the end of their own generation
+    stop_pos = torch.tensor(
+        [len(t) + g for t, g in zip(prompt_tokens, max_gen_lens)], device="cuda")
+    prev_pos = 0
+    eos_reached = torch.zeros(bsz, dtype=torch.bool, device="cuda")
+    input_text_mask = tokens != pad_id
+    for cur_pos in range(min_prompt_len, total_len):
+        logits = generator.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+        token_logprobs[:, prev_pos + 1:cur_pos + 1] = -F.cross_entropy(
+            input=logits.transpose(1, 2),
+            target=tokens[:, prev_pos + 1:cur_pos + 1],
+            reduction="none",
+            ignore_index=pad_id,
+        )
+        next_token = sample_per_row(logits[:, -1], temperature, top_p, top_k)
+        next_token = torch.where(input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token)
+        tokens[:, cur_pos] = next_token
+        eos_reached |= (~input_text_mask[:, cur_pos]) & (next_token == tokenizer.eos_id)
+        eos_reached |= stop_pos <= cur_pos + 1
+        prev_pos = cur_pos
+        if eos_reached.all():
+            break
+
+    token_logprobs = token_logprobs.tolist()
+    out_tokens, out_logprobs = [], []
+    for i, toks in enumerate(tokens.tolist()):
+        start = len(prompt_tokens[i])
+        end = start + max_gen_lens[i]
+        toks = toks[start:end]
+        probs = token_logprobs[i][start:end]
+        if tokenizer.eos_id in toks:
+            eos_idx = toks.index(tokenizer.eos_id)
+            toks = toks[:eos_idx]
+            probs = probs[:eos_idx]
+        out_tokens.append(toks)
+        out_logprobs.append(probs)
+    return out_tokens, out_logprobs
+
+
 # global state (mutable!)
 REQUEST_QUEUE = None
-RESPONSE_QUEUE = None
 MAX_REQUESTS = None
 GENERATOR = None
+DETOKENIZER = None
+TOKENIZATION_STAGE = None
+ACTIVATION_CACHE = ActivationCache()
 PORT = get_free_port()
+# Longest prompt plus generation served, shortened at startup if batches of
+# it don't fit in device memory
+MAX_SEQ_LEN = int(os.environ.get("MAX_SEQ_LEN", 4096))
 
 logger = build_host_logger()
 logger = logging.getLogger("kaleidoscope.model_service.llama2")
@@ -79,7 +183,9 @@ class Model(AbstractModel):
         self.model_variant = model_variant
         cwd = str(pathlib.Path(__file__).parent.resolve())
         self.config_path = f"{cwd}/config.json"
-        self.generation_args = {}
+        self.parameter_schema = ParameterSchema.from_config(self.config_path)
+        logger.info(f"Loaded parameter schema from {self.config_path}: "
+                    f"{pprint.pformat(dict(self.parameter_schema.specs))}")
 
 
     def load(self, model_path):
@@ -88,24 +194,10 @@ class Model(AbstractModel):
         self.worker_main()
 
 
-    def load_default_args(self, task_name):
-        """Load model config"""
-        logger.info(f"Loading default args from self.config_path: {self.config_path}")
-        self.generation_args = {}
-        try:
-            with open(self.config_path) as file:
-                json_data = file.read()
-            default_args = json.loads(json_data)["parameters"]
-            logger.info(pprint.pformat(default_args))
-            self.generation_args = {k: v["default"][task_name] for k, v in default_args.items() if v["default"][task_name] is not None}
-        except Exception as err:
-            logger.error(f"Failed to load model {task_name} default configuration: {err}")
-
-
     def bind(self, triton):
         triton.bind(
             model_name=f"{self.model_type}-{self.model_variant}",
-            infer_func=self.infer,
+            infer_func=self.infer_funcs(),
             inputs=[
                 Tensor(name="task", dtype=np.int64, shape=(1,)),
                 Tensor(name="prompts", dtype=bytes, shape=(1,)),
@@ -117,15 +209,25 @@ class Model(AbstractModel):
                 Tensor(name='top_k', dtype=np.int64, shape=(1,), optional=True),
                 Tensor(name='repetition_penalty', dtype=np.float32, shape=(1,), optional=True),
                 Tensor(name='encoded_activation_payload', dtype=bytes, shape=(1,), optional=True),
-                Tensor(name='echo', dtype=np.bool_, shape=(1,), optional=True)
+                Tensor(name='echo', dtype=np.bool_, shape=(1,), optional=True),
+                Tensor(name='capture_policy', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='capture_positions', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='reducers', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='edits', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='variants', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_dtype', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_compression', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_output', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='cache_activations', dtype=np.bool_, shape=(1,), optional=True),
             ],
             outputs=[
                 Tensor(name="activations", dtype=np.bytes_, shape=(-1,)),
                 Tensor(name="sequences", dtype=object, shape=(-1,)),
                 Tensor(name="tokens", dtype=object, shape=(-1,)),
                 Tensor(name="logprobs", dtype=object, shape=(-1,)),
+                Tensor(name="activation_cache_handle", dtype=np.bytes_, shape=(-1,)),
             ],
-            config=ModelConfig(max_batch_size=128),
+            config=ModelConfig(max_batch_size=self.batch_limits.max_batch_size),
         )
 
         return triton
@@ -140,13 +242,13 @@ class Model(AbstractModel):
     @group_by_values("task")
     def infer(self, **inputs):
         """Dispatch request to a handler function based on the task"""
-        self.load_default_args("generate")
-
         task = Task(inputs['task'][0][0])
         if task == Task.GET_ACTIVATIONS:
             response = self.get_activations(inputs)
         elif task == Task.EDIT_ACTIVATIONS:
             response = self.edit_activations(inputs)
+        elif task == Task.SWEEP_ACTIVATIONS:
+            response = self.sweep_activations(inputs)
         else:
             response = self.generate(inputs)
 
@@ -156,15 +258,15 @@ class Model(AbstractModel):
 
     def get_activations(self, inputs):
         """Retrieve activations for a list of prompts and list of module names"""
-        self.load_default_args("activations")
-
         # If the modules are base-64 encoded, this is a manipulation request
         try:
+            params = self.parameter_schema.resolve("activations", inputs)
             module_names = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
             inputs["encoded_activation_payload"] = ActivationPayload(
                 module_names_activation_retrieval=[module_names.tolist()],
+                **self.get_capture_args(params),
             )
-            response = self.generate(inputs)
+            response = self.generate(inputs, params)
 
         # Handle all other errors
         except Exception as err:
@@ -172,33 +274,119 @@ class Model(AbstractModel):
             response["activations"] = torch.empty(0)
             response["error"] = f"Error with activations request: {err}"
 
-        response = self.generate(inputs)
         return response
 
 
+    def get_capture_args(self, params):
+        """
+        Parse the activation capture policy and per-module reducer specs of
+        the request parameters
+        """
+        capture_policy = params.get("capture_policy") or "all"
+
+        capture_positions = params.get("capture_positions")
+        if capture_positions is not None:
+            capture_positions = [int(p) for p in capture_positions.split(",")]
+
+        # Reducers are given as JSON, eg. {"layers.0": {"name": "topk", "k": 8}}
+        module_reducer_specs = params.get("reducers")
+        if module_reducer_specs is not None:
+            module_reducer_specs = json.loads(module_reducer_specs)
+
+        return {
+            "capture_policy": capture_policy,
+            "capture_positions": capture_positions,
+            "module_reducer_specs": module_reducer_specs,
+        }
+
+
     def edit_activations(self, inputs):
         """Edit activations for a list of prompts and list of modules"""
-        self.load_default_args("activations")
-
         # If the modules are base-64 encoded, this is a manipulation request
         try:
+            params = self.parameter_schema.resolve("activations", inputs)
+
             # Extract modules + editing functions from encoded request
-            encoded_modules = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
-            # TODO: This only works for a single module name. Add code to handle multiple modules.
-            decoded_modules = decode_str(str(encoded_modules))
+            decoded_modules = {}
+            if "modules" in inputs:
+                encoded_modules = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
+                # TODO: This only works for a single module name. Add code to
+                # handle multiple modules.
+                decoded_modules = decode_str(str(encoded_modules))
             editing_fns: Dict[str, Callable] = {}
             for module_name, edit_fn in decoded_modules.items():
                 if edit_fn is not None:
                     editing_fns[module_name] = edit_fn
 
+            # Declarative shard-local edits can also be given as JSON, eg.
+            # {"layers.0.attention": {"name": "scale", "factor": 0.0}}
+            module_edit_specs = params.get("edits")
+            if module_edit_specs is not None:
+                editing_fns.update(json.loads(module_edit_specs))
+
+            for module_name, edit_fn in editing_fns.items():
+                if isinstance(edit_fn, dict):
+                    editing_fns[module_name] = self.resolve_cached_patch(module_name, edit_fn)
+
             # Define activation payload
             inputs["encoded_activation_payload"] = encode_obj(
                 ActivationPayload(
-                    module_names_activation_retrieval=list(decoded_modules.keys()),
+                    module_names_activation_retrieval=list(
+                        dict.fromkeys([*decoded_modules.keys(), *editing_fns.keys()])
+                    ),
                     module_editing_fn_pairs=editing_fns,
+                    **self.get_capture_args(params),
                 )
             )
-            response = self.generate(inputs)
+            response = self.generate(inputs, params)
+
+        # Handle all other errors
+        except Exception as err:
+            response = {}
+            response["activations"] = torch.empty(0)
+            response["error"] = f"Error with activations request: {err}"
+
+        return response
+
+
+    def resolve_cached_patch(self, module_name, edit_spec):
+        """
+        Resolve a patch from the activation cache into the cached tensor here
+        on rank0, so the activations never leave the server
+        """
+        if "handle" not in edit_spec:
+            return edit_spec
+
+        edit_spec = dict(edit_spec)
+        edit_spec["tensor"] = ACTIVATION_CACHE.get(
+            edit_spec.pop("handle"),
+            edit_spec.pop("module", module_name),
+        )
+        return edit_spec
+
+
+    def sweep_activations(self, inputs):
+        """
+        Run a patching sweep for every prompt. A prompt is repeated once per
+        edit variant along the batch dimension, and each row only gets the
+        declarative edits of its own variant. Variants are run in as few
+        batched generations as the max batch size allows, and all of them
+        are packed into the prompt's own response row. Sweeps don't cache
+        their activations.
+        """
+        try:
+            rows = []
+            for idx in range(len(inputs["prompts"])):
+                row_inputs = {name: value[idx:idx + 1] for name, value in inputs.items()}
+                rows.append(self.sweep_prompt(row_inputs))
+
+            response = {
+                k: np.array([row[k] for row in rows], dtype=object)
+                for k in ("sequences", "tokens", "logprobs")
+            }
+            response["activations"] = np.array(
+                [row["activations"] for row in rows], dtype=np.bytes_)
+            response["activation_cache_handle"] = np.array([""] * len(rows), dtype=np.bytes_)
 
         # Handle all other errors
         except Exception as err:
@@ -209,10 +397,51 @@ class Model(AbstractModel):
         return response
 
 
-    def generate(self, request):
-        """Generate sequences from a prompt"""
+    def sweep_prompt(self, inputs):
+        """Run the patching sweep of a single prompt"""
+        params = self.parameter_schema.resolve("activations", inputs, cache_activations=False)
+
+        # Variants are given as JSON, eg. [{"layers.0": {"name": "patch",
+        # "handle": "...", "positions": [3]}}, ...]
+        variants = json.loads(params["variants"])
+
+        module_names = []
+        if "modules" in inputs:
+            module_names = [str(np.char.decode(inputs["modules"][0][0], encoding="utf-8"))]
+
+        def run_variants(variants_batch):
+            editing_fns: Dict[str, List[dict]] = {}
+            for row, variant in enumerate(variants_batch):
+                for module_name, edit_spec in variant.items():
+                    edit_spec = self.resolve_cached_patch(module_name, edit_spec)
+                    editing_fns.setdefault(module_name, []).append(
+                        {**edit_spec, "rows": [row]}
+                    )
+
+            batch_inputs = dict(inputs)
+            batch_inputs["prompts"] = np.repeat(inputs["prompts"], len(variants_batch), axis=0)
+            batch_inputs["split_activations"] = True
+            batch_inputs["encoded_activation_payload"] = encode_obj(
+                ActivationPayload(
+                    module_names_activation_retrieval=module_names,
+                    module_editing_fn_pairs=editing_fns,
+                    **self.get_capture_args(params),
+                )
+            )
+            return self.generate(batch_inputs, params)
+
+        return run_sweep(run_variants, variants, GENERATOR.model.params.max_batch_size)
+
+
+    def generate(self, request, params=None):
+        """
+        Generate sequences from a prompt, with the request parameters resolved
+        by the calling task handler if any
+        """
+        if params is None:
+            params = self.parameter_schema.resolve("generate", request)
         logger.info(f"Generate function called with request: {request}")
-        logger.info(f"Self generation args: {self.generation_args}")
+        logger.info(f"Generation parameters: {dict(params)}")
         global GENERATOR
 
         prompts = [
@@ -221,27 +450,41 @@ class Model(AbstractModel):
 
         logger.info(f"Rank{torch.distributed.get_rank()}: completions")
 
-        # Tokenize the prompts (needs to be done manually now)
-        prompt_tokens = [GENERATOR.tokenizer.encode(s=prompt, bos=True, eos=False) for prompt in prompts]
+        # Tokenize the prompts (needs to be done manually now), in parallel
+        prompt_tokens = TOKENIZATION_STAGE.encode(prompts)
         
-        # Recv request and enqueue
+        # Recv request and enqueue. Rows keep their own sampling parameters, so
+        # requests batched together by Triton don't need to agree on them
+        batch_size = len(prompt_tokens)
         request_object = RequestObject(
             prompts=prompt_tokens,
-            max_gen_len=int(request["max_tokens"]) if "max_tokens" in request else int(self.generation_args["max_tokens"]),
-            temperature=float(request["temperature"]) if "temperature" in request else float(self.generation_args["temperature"]),
-            top_p=float(request["top_p"]) if "top_p" in request else float(self.generation_args["top_p"]),
-            encoded_activation_payload=request["encoded_activation_payload"] if "encoded_activation_payload" in request else None
+            max_gen_len=get_row_params(
+                request, "max_tokens", params["max_tokens"], batch_size, np.int64).tolist(),
+            temperature=get_row_params(
+                request, "temperature", params["temperature"], batch_size).tolist(),
+            top_p=get_row_params(request, "top_p", params["top_p"], batch_size).tolist(),
+            top_k=get_row_params(
+                request, "top_k", params.get("top_k", 0), batch_size, np.int64).tolist(),
+            encoded_activation_payload=request.get("encoded_activation_payload"),
+            activation_dtype=params.get("activation_dtype"),
+            activation_compression=params.get("activation_compression"),
+            activation_output=params.get("activation_output"),
+            cache_activations=params.get("cache_activations", False),
+            split_activations=request.get("split_activations", False),
         )
 
         logger.info(f"Rank{torch.distributed.get_rank()}: completions - made "
                     f"RequestObject: {request_object}")
 
-        REQUEST_QUEUE.put(request_object)
+        # Every request waits on its own queue, as several model instances
+        # enqueue concurrently
+        response_queue = queue.Queue(maxsize=1)
+        REQUEST_QUEUE.put((request_object, response_queue))
         logger.info(f"Rank{torch.distributed.get_rank()}: completions - "
                     f"RequestObject enqueued")
 
         # Recv response and parse
-        response_object = RESPONSE_QUEUE.get()
+        response_object = response_queue.get()
 
         logger.info(f"Rank{torch.distributed.get_rank()}: completions - response "
                     f"recv")
@@ -250,17 +493,17 @@ class Model(AbstractModel):
 
         # Compile the results into a structure consistent with other kaleidoscope models
         activations = results["choices"][0]["activations"]
-        generated_sequences = GENERATOR.tokenizer.decode(results["choices"][0]["text"])
-        tokens = []
-        for sequence in results["choices"][0]["text"]:
-            tokens.append([GENERATOR.tokenizer.decode(token) for token in sequence])
+        generated_sequences = DETOKENIZER.decode(results["choices"][0]["text"])
+        tokens = DETOKENIZER.decode_tokens(results["choices"][0]["text"])
         logprobs = results["choices"][0]["logprobs"]
+        activation_cache_handle = results["choices"][0]["activation_cache_handle"]
 
         return_val = {
             "activations": np.array(activations, dtype=np.bytes_),
             "sequences": np.array(generated_sequences, dtype=object),
             "tokens": np.array(tokens, dtype=object),
-            "logprobs": np.array(logprobs, dtype=object)
+            "logprobs": np.array(logprobs, dtype=object),
+            "activation_cache_handle": np.array(activation_cache_handle or "", dtype=np.bytes_),
         }
         logger.info(f"Generate returning return_val: {return_val}")
         return return_val
@@ -271,10 +514,23 @@ class Model(AbstractModel):
         Hosted version of the web UI for generation.
         """
         global REQUEST_QUEUE
-        global RESPONSE_QUEUE
         global GENERATOR
+        global DETOKENIZER
+        global TOKENIZATION_STAGE
 
         rank, world_size = setup_model_parallel()
+        quantization = get_quantization(self.config_path, self.model_variant)
+
+        # The KV cache is allocated for the max batch size and sequence
+        # length, so size them from free memory before building the model
+        self.batch_limits = size_llama_batch_limits(
+            ckpt_dir=f"{self.model_path}",
+            tokenizer_path=f"{self.model_path}/tokenizer.model",
+            local_rank=rank,
+            world_size=world_size,
+            max_seq_len=MAX_SEQ_LEN,
+            quantization=quantization,
+        )
 
         load_fn = load_llama
 
@@ -282,15 +538,20 @@ class Model(AbstractModel):
         GENERATOR = load_fn(
             local_rank=rank,
             world_size=world_size,
-            max_seq_len=512,
-            max_batch_size=32,
+            max_seq_len=self.batch_limits.max_seq_len,
+            max_batch_size=self.batch_limits.max_batch_size,
             ckpt_dir=f"{self.model_path}",
             tokenizer_path=f"{self.model_path}/tokenizer.model",
+            quantization=quantization,
         )
 
         logger.info(f"Rank {torch.distributed.get_rank()} loaded in "
                     f"{time.time() - start_time:.2f} seconds")
 
+        # Index the modules and attach the persistent hooks once, requests
+        # then only toggle hooks in the table
+        install_forward_hook_table(GENERATOR.model)
+
         if torch.distributed.is_initialized():
             request_object = distributed_utils.broadcast_object(
                 None, src_rank=0, group=distributed_utils.get_global_group(),
@@ -301,7 +562,9 @@ class Model(AbstractModel):
         # Rank0 launches server on new thread
         if torch.distributed.get_rank() == 0:
             REQUEST_QUEUE = queue.Queue()
-            RESPONSE_QUEUE = queue.Queue()
+            DETOKENIZER = Detokenizer(GENERATOR.tokenizer)
+            TOKENIZATION_STAGE = TokenizationStage(
+                lambda prompt: GENERATOR.tokenizer.encode(s=prompt, bos=True, eos=False))
             logger.info(f"Worker engaged! {get_my_ip()}:{PORT}")
             thread = threading.Thread(
                 target=self.batching_loop, args=(GENERATOR,), daemon=True,
@@ -326,39 +589,21 @@ class Model(AbstractModel):
 
                     encoded_activation_payload = request_object.encoded_activation_payload
                     act_retrieval_aux = request_object._aux
+                    logger.info(f"Rank{torch.distributed.get_rank()}: Batching "
+                                f"loop - generating on args {request_object}")
                     if encoded_activation_payload is not None:
-                        hook_dict, _ = get_activation_capture_hook_dict(
+                        # Captures are kept on every rank so that hooks are
+                        # detached in lockstep with rank0
+                        hook_dict, activation_dict = get_activation_capture_hook_dict(
                             GENERATOR.model,
                             encoded_activation_payload,
                             aux=act_retrieval_aux,
                         )
 
-                        with apply_forward_hook(GENERATOR.model, hook_dict):
-                            _, _ = GENERATOR.generate(
-                                request_object.prompts,
-                                request_object.max_gen_len,
-                                request_object.temperature,
-                                request_object.top_p,
-                                logprobs=True
-                            )
+                        with apply_forward_hook(GENERATOR.model, hook_dict, activation_dict):
+                            _, _ = generate_per_row(GENERATOR, request_object)
                     else:
-                        _, _ = GENERATOR.generate(
-                            request_object.prompts,
-                            request_object.max_gen_len,
-                            request_object.temperature,
-                            request_object.top_p,
-                            logprobs=True
-                        )
-
-                    logger.info(f"Rank{torch.distributed.get_rank()}: Batching "
-                                f"loop - generating on args {request_object}")
-                    _, _ = GENERATOR.generate(
-                        request_object.prompts,
-                        request_object.max_gen_len,
-                        request_object.temperature,
-                        request_object.top_p,
-                        logprobs=True
-                    )
+                        _, _ = generate_per_row(GENERATOR, request_object)
                 except Exception as err:
                     logger.info(f"Worker main caught exception: {err}")
 
@@ -371,13 +616,19 @@ class Model(AbstractModel):
         """
         logger.info(f"Rank{torch.distributed.get_rank()}: Batching loop")
         while True:
-            request_object = REQUEST_QUEUE.get()
+            request_object, response_queue = REQUEST_QUEUE.get()
             logger.info(f"Rank{torch.distributed.get_rank()}: Batching loop - "
                         f"got RequestObject")
 
-            # aux data needed for act retrieval
+            # aux data needed for act retrieval: batch size, the total
+            # number of positions generate will run over, and the prompt
+            # lengths, as generation starts at the shortest prompt
             # TODO: Surely a better way to impl this?
-            request_object._aux = (len(request_object.prompts),)
+            request_object._aux = (
+                len(request_object.prompts),
+                get_total_len(generator.model.params.max_seq_len, request_object),
+                [len(prompt) for prompt in request_object.prompts],
+            )
 
 
             distributed_utils.broadcast_object(
@@ -402,45 +653,66 @@ class Model(AbstractModel):
                     aux=act_retrieval_aux,
                 )
                 start_time = time.time()
-                with apply_forward_hook(generator.model, hook_dict):
-                    generation, logprobs = generator.generate(
-                        request_object.prompts,
-                        request_object.max_gen_len,
-                        request_object.temperature,
-                        request_object.top_p,
-                        logprobs=True
-                    )
+                with apply_forward_hook(generator.model, hook_dict, activation_dict):
+                    generation, logprobs = generate_per_row(generator, request_object)
 
             else:
                 start_time = time.time()
-                generation, logprobs = generator.generate(
-                    request_object.prompts,
-                    request_object.max_gen_len,
-                    request_object.temperature,
-                    request_object.top_p,
-                    logprobs=True
-                )
+                generation, logprobs = generate_per_row(generator, request_object)
 
             logger.info(f"Rank{torch.distributed.get_rank()}: Generation took "
                         f"{time.time() - start_time} seconds")
 
+            # Wait for the asynchronous device-to-host activation copies
+            synchronize_capture_streams()
+
             ret_dict = {}
-            for k, v in activation_dict.items():
+            def encode(activation):
+                if request_object.activation_output == "file":
+                    # Large results go to the shared scratch dir, only the
+                    # handle travels back through Triton
+                    return spill_activation(
+                        activation,
+                        activation_dtype=request_object.activation_dtype,
+                    )
+                return encode_activation(
+                    activation.clone(),
+                    activation_dtype=request_object.activation_dtype,
+                    activation_compression=request_object.activation_compression,
+                )
+
+            captured_dict = {}
+            for k, capture in activation_dict.items():
+                v = capture.result()
+                if v is None:
+                    continue
+                captured_dict[k] = v
                 logger.info(f"Rank{torch.distributed.get_rank()}: Module "
                             f"{k} activation shape: {v.shape}")
-                ret_dict[k] = codecs.encode(
-                    pickle.dumps(v.clone()),
-                    "base64",
-                ).decode("utf-8")
+                if not request_object.split_activations:
+                    ret_dict[k] = encode(v)
+
+            if request_object.split_activations:
+                ret_dict = [
+                    {k: encode(v[row:row + 1]) for k, v in captured_dict.items()}
+                    for row in range(len(request_object.prompts))
+                ]
+
+            # Keep the captured activations around for later patching
+            activation_cache_handle = None
+            if request_object.cache_activations and captured_dict:
+                activation_cache_handle = ACTIVATION_CACHE.put(captured_dict)
 
             del activation_dict
+            del captured_dict
 
             ret_obj = ResponseObject(
                 generations=generation,
                 logprobs=logprobs,
                 activations=ret_dict,
+                activation_cache_handle=activation_cache_handle,
             )
 
-            RESPONSE_QUEUE.put(ret_obj)
+            response_queue.put(ret_obj)
             logger.info(f"Rank{torch.distributed.get_rank()}: Batching loop - "
                         f"send response")
@@ -0,0 +1,98 @@
+"""Module for sizing the batches of a model parallel Llama from its checkpoint"""
+import json
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from models.quantization import DEQUANTIZED_CACHE_BYTES
+
+
+# Checkpoint formats, by preference: Meta's .pth shards, their safetensors
+# conversions, and .bin files, eg. of checkpoints converted to HuggingFace's
+# format. Only the files of one format are counted, as conversions are
+# written next to the original shards
+CHECKPOINT_SUFFIXES = (".pth", ".safetensors", ".bin")
+
+
+def checkpoint_files(ckpt_dir: str) -> List[Path]:
+    """The checkpoint files of a model, in the first format found"""
+    for suffix in CHECKPOINT_SUFFIXES:
+        files = sorted(Path(ckpt_dir).glob(f"*{suffix}"))
+        if files:
+            return files
+    raise FileNotFoundError(f"No checkpoint files ({', '.join(CHECKPOINT_SUFFIXES)}) in {ckpt_dir}")
+
+
+def read_model_dims(ckpt_dir: str) -> Dict[str, int]:
+    """
+    The dims of a Llama from the params.json of Meta's checkpoints, or the
+    config.json of checkpoints converted to HuggingFace's format
+    """
+    params_path = Path(ckpt_dir) / "params.json"
+    if params_path.exists():
+        with open(params_path, "r") as f:
+            params = json.loads(f.read())
+        n_heads = params["n_heads"]
+        return {
+            "dim": params["dim"],
+            "n_layers": params["n_layers"],
+            "n_heads": n_heads,
+            "n_kv_heads": params.get("n_kv_heads") or n_heads,
+        }
+
+    with open(Path(ckpt_dir) / "config.json", "r") as f:
+        config = json.loads(f.read())
+    n_heads = config["num_attention_heads"]
+    return {
+        "dim": config["hidden_size"],
+        "n_layers": config["num_hidden_layers"],
+        "n_heads": n_heads,
+        "n_kv_heads": config.get("num_key_value_heads") or n_heads,
+    }
+
+
+def shard_weight_bytes(
+    ckpt_dir: str,
+    world_size: int,
+    vocab_size: int,
+    quantization: Optional[str] = None,
+) -> int:
+    """
+    Device memory of the weights of a rank, before they are loaded. Weights
+    are split evenly over the ranks whatever the number of checkpoint files.
+    """
+    weight_bytes = sum(f.stat().st_size for f in checkpoint_files(ckpt_dir)) // world_size
+    if quantization == "int8":
+        # Linear layers hold nearly all of the fp16 weights. Forward passes
+        # also hold the fp16 weight of the largest layer, the output head,
+        # while it is dequantized, and the cached dequantized weights
+        dim = read_model_dims(ckpt_dir)["dim"]
+        weight_bytes //= 2
+        weight_bytes += vocab_size * dim * 2 // world_size + DEQUANTIZED_CACHE_BYTES
+    return weight_bytes
+
+
+def llama_batch_memory(
+    ckpt_dir: str,
+    world_size: int,
+    vocab_size: int,
+) -> Callable[[int, int], int]:
+    """
+    Estimate of the memory of a batch from the model dims: per token, the
+    fp16 KV cache and activations of this rank's shard of every layer, and
+    the fp32 logits and log-probs over the whole vocabulary. Prefill
+    attention scores are quadratic in the sequence length.
+    """
+    dims = read_model_dims(ckpt_dir)
+    dim, n_heads = dims["dim"], dims["n_heads"]
+    head_dim = dim // n_heads
+    token_bytes = (
+        2 * dims["n_layers"] * max(1, dims["n_kv_heads"] // world_size) * head_dim * 2
+        + 16 * dim * 2 // world_size
+        + vocab_size * 8
+    )
+
+    def batch_memory(batch_size: int, seq_len: int) -> int:
+        attention = (n_heads // world_size) * seq_len * seq_len * 4
+        return batch_size * (seq_len * token_bytes + attention)
+
+    return batch_memory
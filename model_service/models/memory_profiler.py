@@ -0,0 +1,220 @@
+"""Module for sizing the batch limits of the model services from device memory"""
+from dataclasses import dataclass
+import logging
+import os
+from typing import Callable, List, Optional, Sequence
+
+import torch
+
+
+logger = logging.getLogger("kaleidoscope.model_service.memory_profiler")
+
+# Fraction of the device memory left free by the weights which batches may use
+BATCH_MEMORY_FRACTION = float(os.environ.get("BATCH_MEMORY_FRACTION", 0.85))
+# Upper bound of the max batch size, also the Triton max batch size
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 128))
+# The max sequence length is halved, down to MIN_SEQ_LEN, until batches of
+# at least MIN_BATCH_SIZE rows fit
+MIN_BATCH_SIZE = int(os.environ.get("MIN_BATCH_SIZE", 8))
+MIN_SEQ_LEN = int(os.environ.get("MIN_SEQ_LEN", 512))
+
+
+@dataclass(frozen=True)
+class BatchLimits:
+    """Batch limits of a model service, sized once at startup"""
+
+    # Rows of a batch, and the Triton max batch size
+    max_batch_size: int
+    # Prompt and generated tokens of a row
+    max_seq_len: int
+    # Tokens of a batch, ie. rows times their padded length
+    max_batch_tokens: int
+
+
+# Limits of models which are never profiled
+DEFAULT_BATCH_LIMITS = BatchLimits(
+    max_batch_size=MAX_BATCH_SIZE, max_seq_len=2048, max_batch_tokens=MAX_BATCH_SIZE * 2048
+)
+
+
+def model_devices(model) -> List[torch.device]:
+    """The GPUs holding a model's layers, or its only device"""
+    device_map = getattr(model, "hf_device_map", None)
+    if not device_map:
+        return [model.device]
+    devices = {
+        torch.device(device) for device in device_map.values() if device not in ("cpu", "disk")
+    }
+    return sorted(devices, key=str) or [torch.device("cpu")]
+
+
+def device_free_memory(device: Optional[torch.device] = None) -> int:
+    """
+    Bytes the driver reports free on a GPU. Older torch releases (the llama2
+    and OPT images pin 1.10.1) lack `torch.cuda.mem_get_info`, so there it's
+    the device's total memory less what PyTorch has reserved, which doesn't
+    see other processes on the GPU.
+    """
+    if hasattr(torch.cuda, "mem_get_info"):
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    if device is None:
+        device = torch.cuda.current_device()
+    total = torch.cuda.get_device_properties(device).total_memory
+    return total - torch.cuda.memory_reserved(device)
+
+
+def free_memory(devices: Sequence[torch.device]) -> Optional[int]:
+    """
+    Bytes left on the fullest of the GPUs, counting memory cached by PyTorch
+    but not allocated, times the number of GPUs. None without GPUs.
+    """
+    devices = [device for device in devices if device.type == "cuda"]
+    if not devices:
+        return None
+    free = []
+    for device in devices:
+        driver_free = device_free_memory(device)
+        cached = torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        free.append(driver_free + cached)
+    return min(free) * len(devices)
+
+
+def generation_memory(
+    config, dtype_bytes: int, batch_size: int, prompt_len: int, gen_len: int
+) -> int:
+    """
+    Upper bound on the bytes a HuggingFace `generate` call allocates on top of
+    the model weights: the KV cache, the prefill activations and attention
+    scores, and the logits, both over the prompt and kept as scores for
+    every step
+    """
+    seq_len = prompt_len + gen_len
+    kv_cache = (
+        2 * config.num_hidden_layers * config.hidden_size * dtype_bytes * batch_size * seq_len
+    )
+    activations = 8 * config.hidden_size * dtype_bytes * batch_size * prompt_len
+    attention = 4 * config.num_attention_heads * batch_size * prompt_len * seq_len
+    logits = 4 * config.vocab_size * batch_size * (prompt_len + gen_len)
+    return kv_cache + activations + attention + logits
+
+
+def min_across_ranks(value: int) -> int:
+    """
+    The smallest value over the ranks of a distributed model, so that every
+    rank sizes its batches the same way
+    """
+    if not torch.distributed.is_initialized():
+        return value
+    device = (
+        torch.device("cuda", torch.cuda.current_device()) if torch.cuda.is_available() else None
+    )
+    tensor = torch.tensor([value], dtype=torch.int64, device=device)
+    torch.distributed.all_reduce(tensor, op=torch.distributed.ReduceOp.MIN)
+    return int(tensor.item())
+
+
+def measure_peak_memory(run: Callable[[], None], devices: Sequence[torch.device]) -> int:
+    """Peak bytes allocated by `run` on top of what was already allocated"""
+    devices = [device for device in devices if device.type == "cuda"]
+    baseline = {}
+    for device in devices:
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline[device] = torch.cuda.memory_allocated(device)
+    run()
+    peak = 0
+    for device in devices:
+        torch.cuda.synchronize(device)
+        peak += torch.cuda.max_memory_allocated(device) - baseline[device]
+    return peak
+
+
+def size_batch_limits(
+    batch_memory: Callable[[int, int], int],
+    free_bytes: Optional[int],
+    max_seq_len: int,
+    memory_fraction: float = BATCH_MEMORY_FRACTION,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    min_seq_len: int = MIN_SEQ_LEN,
+) -> BatchLimits:
+    """
+    The largest batches of rows `max_seq_len` tokens long whose memory,
+    estimated by `batch_memory(batch_size, seq_len)`, fits in a fraction of
+    the free device memory. The sequence length is traded for batch size
+    while fewer than MIN_BATCH_SIZE rows fit. Without GPUs only the upper
+    bounds apply.
+    """
+    if free_bytes is None:
+        limits = BatchLimits(max_batch_size, max_seq_len, max_batch_size * max_seq_len)
+        logger.info(f"No GPU memory to profile, using {limits}")
+        return limits
+
+    budget = int(free_bytes * memory_fraction)
+    seq_len = max_seq_len
+    while True:
+        # Memory grows with the batch size, so binary search the largest one
+        low, high = 0, max_batch_size
+        while low < high:
+            mid = (low + high + 1) // 2
+            if batch_memory(mid, seq_len) <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        batch_size = low
+
+        if batch_size >= min(MIN_BATCH_SIZE, max_batch_size) or seq_len // 2 < min_seq_len:
+            break
+        logger.info(
+            f"Only {batch_size} rows of {seq_len} tokens fit in {budget} bytes, "
+            f"halving the max sequence length"
+        )
+        seq_len //= 2
+
+    if batch_size == 0:
+        raise RuntimeError(
+            f"Not enough free device memory ({budget} bytes) for a single "
+            f"row of {seq_len} tokens"
+        )
+
+    limits = BatchLimits(batch_size, seq_len, batch_size * seq_len)
+    logger.info(
+        f"Sized batch limits for {budget} bytes of free device memory: {limits}, "
+        f"estimated to use {batch_memory(batch_size, seq_len)} bytes"
+    )
+    return limits
+
+
+def profile_hf_batch_limits(model, max_seq_len: int, probe_seq_len: int = 128) -> BatchLimits:
+    """
+    Size the batch limits of a loaded HuggingFace model. The analytic
+    estimate of `generation_memory` is calibrated by a short profiling
+    forward pass, and batches are sized for rows split evenly between the
+    prompt and the generation.
+    """
+    devices = model_devices(model)
+
+    def estimate(batch_size: int, prompt_len: int, gen_len: int) -> int:
+        return generation_memory(
+            model.config, next(model.parameters()).element_size(), batch_size, prompt_len, gen_len
+        )
+
+    scale = 1.0
+    if free_memory(devices) is not None:
+        probe_len = min(probe_seq_len, max_seq_len)
+        input_ids = torch.zeros((1, probe_len), dtype=torch.long, device=devices[0])
+        with torch.no_grad():
+            measured = measure_peak_memory(lambda: model(input_ids), devices)
+        scale = max(1.0, measured / estimate(1, probe_len, 0))
+        logger.info(
+            f"Profiled forward pass of {probe_len} tokens: {measured} bytes, "
+            f"scaling the memory estimate by {scale:.2f}"
+        )
+
+    return size_batch_limits(
+        lambda batch_size, seq_len: int(
+            scale * estimate(batch_size, seq_len // 2, seq_len - seq_len // 2)
+        ),
+        free_memory(devices),
+        max_seq_len,
+    )
@@ -0,0 +1,191 @@
+"""Module for the latency model used to size OPT batches"""
+from collections import deque
+import itertools
+import json
+import logging
+import os
+import threading
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+
+logger = logging.getLogger("kaleidoscope.model_service.opt")
+
+# Batches are only grown while their predicted latency, in seconds, stays
+# under this target
+BATCH_LATENCY_TARGET = float(os.environ.get("OPT_BATCH_LATENCY_TARGET", 10.0))
+
+# Fitted coefficients are persisted here, one file per model variant
+COST_MODEL_DIR = os.environ.get("OPT_COST_MODEL_DIR", os.path.expanduser("~/.cache/kaleidoscope"))
+
+# (batch size, prompt length, generation length) grid profiled at startup
+PROFILE_BATCH_SIZES = (1, 8, 32)
+PROFILE_PROMPT_LENS = (64, 512)
+PROFILE_GEN_LENS = (1, 64)
+
+
+def batch_features(batch_size: int, prompt_len: int, gen_len: int) -> np.ndarray:
+    """
+    Latency features of a batch: a fixed overhead, the prefill tokens, and
+    the decode steps, whose cost grows with the batch and the context length
+    """
+    return np.array(
+        [
+            1.0,
+            batch_size * prompt_len,
+            gen_len,
+            batch_size * gen_len,
+            batch_size * gen_len * (prompt_len + gen_len / 2),
+        ],
+        dtype=np.float64,
+    )
+
+
+def fit_nonnegative(features: np.ndarray, latencies: np.ndarray) -> np.ndarray:
+    """
+    Least squares fit with the coefficients kept non-negative, by dropping
+    the most negative feature until none are left
+    """
+    active = list(range(features.shape[1]))
+    coefficients = np.zeros(features.shape[1])
+    while active:
+        fitted, *_ = np.linalg.lstsq(features[:, active], latencies, rcond=None)
+        if (fitted >= 0).all():
+            coefficients[active] = fitted
+            break
+        del active[int(np.argmin(fitted))]
+    return coefficients
+
+
+class BatchCostModel:
+    """
+    Predicts the latency of a batch from its size, longest prompt and longest
+    generation. It is fitted from a profiling grid at startup and refitted
+    online from the measured latency of every batch.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        latency_target: float = BATCH_LATENCY_TARGET,
+        window: int = 512,
+        refit_every: int = 32,
+    ):
+        self.path = path
+        self.latency_target = latency_target
+        self.refit_every = refit_every
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=window)
+        self.num_new_samples = 0
+        self.coefficients: Optional[np.ndarray] = None
+
+    @property
+    def is_fitted(self):
+        return self.coefficients is not None
+
+    def predict(self, batch_size: int, prompt_len: int, gen_len: int) -> float:
+        return float(batch_features(batch_size, prompt_len, gen_len) @ self.coefficients)
+
+    def observe(self, batch_size: int, prompt_len: int, gen_len: int, latency: float):
+        """Record a measured batch latency, refitting every `refit_every` batches"""
+        with self.lock:
+            self.samples.append((batch_size, prompt_len, gen_len, latency))
+            self.num_new_samples += 1
+            if self.num_new_samples < self.refit_every:
+                return
+            self.num_new_samples = 0
+            self.fit()
+        self.save()
+
+    def fit(self):
+        features = np.stack([batch_features(*s[:3]) for s in self.samples])
+        latencies = np.array([s[3] for s in self.samples])
+        self.coefficients = fit_nonnegative(features, latencies)
+        logger.info(f"Fitted batch cost model on {len(self.samples)} batches: {self.coefficients}")
+
+    def calibrate(
+        self,
+        run_batch: Callable[[int, int, int], float],
+        max_seq_len: int,
+        max_batch_tokens: int,
+        batch_sizes: Sequence[int] = PROFILE_BATCH_SIZES,
+        prompt_lens: Sequence[int] = PROFILE_PROMPT_LENS,
+        gen_lens: Sequence[int] = PROFILE_GEN_LENS,
+    ):
+        """Fit the model on the latencies `run_batch` measures over a grid"""
+        grid = [
+            (b, p, g)
+            for b, p, g in itertools.product(batch_sizes, prompt_lens, gen_lens)
+            if p + g <= max_seq_len and b * (p + g) <= max_batch_tokens
+        ]
+        # Warm up before timing anything
+        run_batch(*grid[0])
+        with self.lock:
+            for batch_size, prompt_len, gen_len in grid:
+                latency = run_batch(batch_size, prompt_len, gen_len)
+                logger.info(
+                    f"Profiled batch size {batch_size}, prompt length "
+                    f"{prompt_len}, gen length {gen_len}: {latency:.3f}s"
+                )
+                self.samples.append((batch_size, prompt_len, gen_len, latency))
+            self.fit()
+        self.save()
+
+    def fits(self, bs_list: List, item) -> bool:
+        """
+        Whether adding a work item to a batch keeps its predicted latency
+        under the target and raises its predicted throughput
+        """
+        if not self.is_fitted:
+            return True
+
+        def latency_and_tokens(items):
+            latency = self.predict(
+                len(items),
+                max(x.prompt_len for x in items),
+                max(x.gen_len for x in items),
+            )
+            return latency, sum(x.prompt_len + x.gen_len for x in items)
+
+        latency, tokens = latency_and_tokens(bs_list + [item])
+        if latency > self.latency_target:
+            return False
+        if not bs_list:
+            return True
+        current_latency, current_tokens = latency_and_tokens(bs_list)
+        return tokens * current_latency >= current_tokens * latency
+
+    def save(self):
+        if self.path is None or not self.is_fitted:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w") as file:
+                json.dump(
+                    {
+                        "coefficients": self.coefficients.tolist(),
+                        "samples": list(self.samples),
+                    },
+                    file,
+                )
+        except OSError as err:
+            logger.warning(f"Failed to save batch cost model to {self.path}: {err}")
+
+    def load(self) -> bool:
+        """
+        Load the persisted coefficients and the samples they were fitted on,
+        returning whether there were any
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path) as file:
+                saved = json.load(file)
+            self.coefficients = np.array(saved["coefficients"], dtype=np.float64)
+            self.samples.extend(tuple(s) for s in saved.get("samples", []))
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning(f"Failed to load batch cost model from {self.path}: {err}")
+            return False
+        logger.info(f"Loaded batch cost model from {self.path}: {self.coefficients}")
+        return True
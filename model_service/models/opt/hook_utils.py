@@ -0,0 +1,119 @@
+"""
+Module for the OPT activation retrieval and editing forward hooks. These
+replace the metaseq_cli hooks, which copied every captured activation to host
+on its own, so that the batching loop can stage all of them at once.
+"""
+import codecs
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Union
+
+import cloudpickle
+import torch
+from torch import Tensor
+from metaseq_cli.activation_utils import ActivationPayload, ShardedActivation
+
+
+def decode_str(obj_in_str: str) -> Any:
+    """
+    Given some object that has been serialized then encoded into a string,
+    decode it and unserialize it back into the original object.
+    """
+    return cloudpickle.loads(codecs.decode(obj_in_str.encode("utf-8"), "base64"))
+
+
+@contextmanager
+def apply_forward_hook(model: torch.nn.Module, hook_dict: Dict[str, Callable]) -> None:
+    """
+    Register the forward hooks of a dict of module names to hook functions for
+    the duration of the context.
+    """
+    all_hooks = []
+    for name, module in model.named_modules():
+        if name in hook_dict:
+            all_hooks.append(module.register_forward_hook(hook_dict[name]))
+
+    try:
+        yield
+    finally:
+        for hook in all_hooks:
+            hook.remove()
+        all_hooks.clear()
+
+
+def get_activation_capture_hook_dict(
+    model: torch.nn.Module,
+    encoded_activation_payload: Union[ActivationPayload, str],
+    aux: Optional[tuple] = None,
+):
+    """
+    Build the forward hooks of the modules an activation payload retrieves,
+    and the dict their full activations are captured into, on rank0 and on
+    device.
+    """
+    activation_dict, hook_dict = {}, {}
+
+    if isinstance(encoded_activation_payload, ActivationPayload):
+        activation_payload = encoded_activation_payload
+    else:
+        activation_payload = decode_str(encoded_activation_payload)
+
+    module_names_activation_retrieval = set(activation_payload.module_names_activation_retrieval)
+    module_editing_fn_pairs = activation_payload.module_editing_fn_pairs
+
+    for name, _ in model.named_modules():
+        if name in module_names_activation_retrieval:
+            hook_dict[name] = partial(
+                forward_hook_fn,
+                name,
+                activation_dict,
+                module_editing_fn_pairs.get(name, None),
+                aux=aux,
+            )
+
+    return hook_dict, activation_dict
+
+
+def forward_hook_fn(
+    registered_name: str,
+    save_dict: Dict[str, Tensor],
+    editing_fn: Optional[Callable],
+    self: torch.nn.Module,
+    _inputs: Any,
+    outputs: Any,
+    aux: Optional[tuple] = None,
+) -> Optional[Tensor]:
+    """
+    Gather the full activation of a module onto rank0, edit it if requested,
+    and capture it. The captured activation stays on device, the batching
+    loop copies those of every module to host at once.
+    """
+    activation = ShardedActivation(
+        registered_name=registered_name,
+        module=self,
+        aux=aux,
+        layer_outputs=outputs,
+    )
+
+    # Gather the full activation using all ranks
+    activation.gather()
+
+    # Only rank0 handles the full activation
+    if torch.distributed.get_rank() == 0:
+        activation.rearrange()
+
+        if editing_fn is not None:
+            activation.edit_activation(editing_fn)
+
+        # A device copy, as later layers may reuse the gathered memory
+        save_dict[registered_name] = activation.activations.detach().clone()
+
+        # Undo the rearrange to reconstruct the original full activation
+        activation.undo_rearrange()
+
+    if editing_fn is None:
+        return None
+
+    # Scatter the edited full activation, and return this rank's shard
+    activation.scatter()
+    return activation.layer_outputs
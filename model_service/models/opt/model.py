@@ -2,7 +2,6 @@
 import cloudpickle
 import codecs
 from collections import defaultdict
-import json
 import logging
 import numpy as np
 import os
@@ -21,7 +20,6 @@ from metaseq.dataclass.configs import MetaseqConfig
 from metaseq.dataclass.utils import convert_namespace_to_omegaconf
 from metaseq.distributed import utils as distributed_utils
 from metaseq.hub_utils import GeneratorInterface
-from metaseq.service.queue import PriorityQueueRingShard
 from metaseq.service.workers import WorkItem
 from metaseq.service.constants import (
     MAX_SEQ_LEN,
@@ -34,9 +32,20 @@ from metaseq.service.constants import (
 from metaseq.service.utils import get_my_ip, encode_fn, build_logger
 from metaseq.service.responses import OAIResponse
 from metaseq_cli.activation_utils import ActivationPayload
-from metaseq_cli.hook_utils import get_activation_capture_hook_dict, apply_forward_hook
 
 from ..abstract_model import AbstractModel, Task
+from ..activation_codec import (
+    PACK_PREFIX,
+    PinnedStagingBuffer,
+    encode_activation_pack,
+    spill_activation,
+)
+from ..batch_queue import BatchQueue
+from ..memory_profiler import free_memory, min_across_ranks, size_batch_limits
+from ..parameter_schema import ParameterSchema
+from ..tokenization import TokenizationStage
+from .cost_model import COST_MODEL_DIR, BatchCostModel
+from .hook_utils import apply_forward_hook, get_activation_capture_hook_dict
 from pytriton.decorators import batch, group_by_values
 from pytriton.model_config import ModelConfig, Tensor
 
@@ -45,7 +54,9 @@ from pytriton.model_config import ModelConfig, Tensor
 cfg = None
 is_model_loaded = False
 logger = build_logger()
-BATCH_QUEUE = PriorityQueueRingShard()
+BATCH_QUEUE = BatchQueue()
+STAGING_BUFFER = PinnedStagingBuffer()
+TOKENIZATION_STAGE = None
 
 logger = logging.getLogger("kaleidoscope.model_service.opt")
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(name)s: %(message)s")
@@ -68,7 +79,8 @@ class Model(AbstractModel):
         cwd = str(pathlib.Path(__file__).parent.resolve())
         logger.info(f"Loading model config from {cwd}/config.json")
         self.config_path = f"{cwd}/config.json"
-        self.generation_args = {}
+        self.parameter_schema = ParameterSchema.from_config(self.config_path)
+        logger.info(pprint.pformat(dict(self.parameter_schema.specs)))
 
     def load(self, model_path):
         """Load model into memory"""
@@ -101,22 +113,11 @@ class Model(AbstractModel):
 
         distributed_utils.call_main(cfg, self.worker_main, namespace_args=args)
 
-    def load_default_args(self, task_name):
-        """Load model task config"""
-        self.generation_args = {}
-        try:
-            with open(self.config_path) as file:
-                json_data = file.read()
-            default_args = json.loads(json_data)["parameters"]
-            logger.info(pprint.pformat(default_args))
-            self.generation_args = {k: v["default"][task_name] for k, v in default_args.items() if v["default"][task_name] is not None}
-        except Exception as err:
-            logger.error(f"Failed to load model {task_name} default configuration: {err}")
-        
+
     def bind(self, triton):
         triton.bind(
             model_name=f"{self.model_type}-{self.model_variant}",
-            infer_func=self.infer,
+            infer_func=self.infer_funcs(),
             inputs=[
                 Tensor(name="task", dtype=np.int64, shape=(1,)),
                 Tensor(name="prompts", dtype=bytes, shape=(1,)),
@@ -127,6 +128,9 @@ class Model(AbstractModel):
                 Tensor(name='top_p', dtype=np.float64, shape=(1,), optional=True),
                 Tensor(name='top_k', dtype=np.int64, shape=(1,), optional=True),
                 Tensor(name='repetition_penalty', dtype=np.float64, shape=(1,), optional=True),
+                Tensor(name='activation_dtype', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_compression', dtype=bytes, shape=(1,), optional=True),
+                Tensor(name='activation_output', dtype=bytes, shape=(1,), optional=True),
             ],
             outputs=[
                 Tensor(name="activations", dtype=np.bytes_, shape=(-1,)),
@@ -134,9 +138,12 @@ class Model(AbstractModel):
                 Tensor(name="tokens", dtype=object, shape=(-1,)),
                 Tensor(name="logprobs", dtype=object, shape=(-1,)),
             ],
-            config=ModelConfig(max_batch_size=128),
+            config=ModelConfig(max_batch_size=self.batch_limits.max_batch_size),
         )
-        return triton
+        return self.bind_metrics(triton, f"{self.model_type}-{self.model_variant}")
+
+    def batching_metrics(self):
+        return BATCH_QUEUE.metrics.snapshot()
 
     @property
     def rank(self):
@@ -146,8 +153,6 @@ class Model(AbstractModel):
     @group_by_values("task")
     def infer(self, **inputs):
         """ Dispatch request to a handler function based on the task """
-        self.load_default_args("generate")
-
         task = Task(inputs['task'][0][0])
         if task == Task.GET_ACTIVATIONS:
             response = self.get_activations(inputs)
@@ -160,14 +165,17 @@ class Model(AbstractModel):
     
     def get_activations(self, inputs):
         """ Retrieve activations for a list of prompts and list of module names """
-        self.load_default_args("activations")
         # If the modules are base-64 encoded, this is a manipulation request
         try:
             module_names = np.char.decode(inputs["modules"][0][0], encoding="utf-8")
-            self.generation_args["encoded_activation_payload"] = ActivationPayload(
-                module_names_activation_retrieval=[module_names.tolist()],
+            params = self.parameter_schema.resolve(
+                "activations",
+                inputs,
+                encoded_activation_payload=ActivationPayload(
+                    module_names_activation_retrieval=[module_names.tolist()],
+                ),
             )
-            response = self.generate(inputs)
+            response = self.generate(inputs, params)
 
         # Handle all other errors
         except Exception as err:
@@ -179,8 +187,6 @@ class Model(AbstractModel):
 
     def edit_activations(self, inputs):
         """ Edit activations for a list of prompts and list of modules """
-        self.load_default_args("activations")
-
         # If the modules are base-64 encoded, this is a manipulation request
         try:
             # Extract modules + editing functions from encoded request
@@ -193,13 +199,17 @@ class Model(AbstractModel):
                     editing_fns[module_name] = edit_fn
 
             # Define activation payload
-            self.generation_args["encoded_activation_payload"] = encode_obj(
+            params = self.parameter_schema.resolve(
+                "activations",
+                inputs,
+                encoded_activation_payload=encode_obj(
                     ActivationPayload(
-                    module_names_activation_retrieval=list(decoded_modules.keys()),
-                    module_editing_fn_pairs=editing_fns,
-                )
+                        module_names_activation_retrieval=list(decoded_modules.keys()),
+                        module_editing_fn_pairs=editing_fns,
+                    )
+                ),
             )
-            response = self.generate(inputs)
+            response = self.generate(inputs, params)
 
         # Handle all other errors
         except Exception as err:
@@ -209,19 +219,25 @@ class Model(AbstractModel):
 
         return response
 
-    def generate(self, inputs):
-        """Generate sequences from a prompt"""
+    def generate(self, inputs, params=None):
+        """
+        Generate sequences from a prompt, with the request parameters resolved
+        by the calling task handler if any
+        """
+        if params is None:
+            params = self.parameter_schema.resolve("generate", inputs)
+
         prompts = np.char.decode(inputs.pop("prompts").astype("bytes"), encoding="utf-8")
         prompts = np.squeeze(prompts, axis=-1).tolist()
 
         if isinstance(prompts, str):
             # single string. tokenize and turn it to the single pre-tokenized case
-            prompts = [encode_fn(generator, prompts)]
+            prompts = TOKENIZATION_STAGE.encode([prompts])
         assert isinstance(prompts, list)
         assert len(prompts) > 0
         if isinstance(prompts[0], str):
-            # multi string
-            prompts = [encode_fn(generator, p) for p in prompts]
+            # multi string, encoded in parallel
+            prompts = TOKENIZATION_STAGE.encode(prompts)
         elif isinstance(prompts[0], int):
             # single pre-tokenized
             prompts = [prompts]
@@ -229,21 +245,14 @@ class Model(AbstractModel):
         # final case: multi pre-tokenized
         assert len(prompts[0]) > 0
 
-        # Check the input parameters, and set default values if not present
-        if "max_tokens" in inputs: self.generation_args['max_tokens'] = int(inputs["max_tokens"][0][0])
-        if "min_tokens" in inputs: self.generation_args['min_tokens'] = int(inputs["min_tokens"][0][0])
-        if "temperature" in inputs: self.generation_args['temperature'] = float(inputs["temperature"][0][0]) 
-        if "top_p" in inputs: self.generation_args['top_p'] = float(inputs["top_p"][0][0]) 
-        if "echo" in inputs: self.generation_args['echo'] = bool(inputs["echo"][0][0])
-
         ret_queue = queue.Queue()
         for i, prompt in enumerate(prompts):
-            gen_len = self.generation_args.get("max_tokens", 0)
+            gen_len = params.get("max_tokens", 0)
             if gen_len + len(prompt) + 1 > MAX_SEQ_LEN:
                 # cut off the prompt to always fit with number of generations we need
                 # +1 to always have the EOS token
                 prompt = prompt[-(MAX_SEQ_LEN - gen_len - 1) :]
-            request_object = {"input": prompt, **self.generation_args}
+            request_object = {"input": prompt, **params}
             BATCH_QUEUE.put(
                 WorkItem(
                     cost=len(prompt) + gen_len,
@@ -296,6 +305,7 @@ class Model(AbstractModel):
         global generator
         global is_model_loaded
         global MODE
+        global TOKENIZATION_STAGE
 
         # make sure generations are stochastic since we have many workers
         torch.manual_seed(6 + torch.distributed.get_rank())
@@ -314,13 +324,20 @@ class Model(AbstractModel):
 
         logger.info(f"loaded model {cfg.distributed_training.distributed_rank}")
 
+        self.batch_limits = self.size_batch_limits(models[0])
+
         request_object = distributed_utils.broadcast_object(
             None, src_rank=0, group=distributed_utils.get_global_group()
         )
 
         if torch.distributed.get_rank() == 0:
+            TOKENIZATION_STAGE = TokenizationStage(lambda prompt: encode_fn(generator, prompt))
             logger.info(f"Worker engaged! {get_my_ip()}")
-            thread = threading.Thread(target=self.batching_loop, daemon=True)
+            thread = threading.Thread(
+                target=self.batching_loop,
+                kwargs={"max_tokens": self.batch_limits.max_batch_tokens},
+                daemon=True,
+            )
             thread.start()
             is_model_loaded = True
             # Now block, and wait
@@ -357,6 +374,31 @@ class Model(AbstractModel):
                     # continue looping for the next generation so we don't lock up
                     logger.error(f"Caught exception: {str(err)}")
 
+    def size_batch_limits(self, model):
+        """
+        Size the token budget of the batching loop from the free memory left
+        by the loaded weights. metaseq grows its KV cache as it generates, so
+        a batch's memory is estimated per token from the model dims: the fp16
+        KV cache and activations of this rank's shard of every layer, and the
+        fp32 logits over the vocabulary. Every rank agrees on the limits of
+        the rank with the least free memory.
+        """
+        decoder = model.decoder
+        model_parallel_size = distributed_utils.get_model_parallel_world_size()
+        token_bytes = (
+            2 * len(decoder.layers) * decoder.embed_dim * 2 // model_parallel_size
+            + 16 * decoder.embed_dim * 2 // model_parallel_size
+            + len(decoder.dictionary) * 4
+        )
+        free = free_memory([torch.device("cuda", torch.cuda.current_device())])
+        # Prompts are capped at MAX_SEQ_LEN by metaseq, so only batch sizes shrink
+        return size_batch_limits(
+            lambda batch_size, seq_len: batch_size * seq_len * token_bytes,
+            min_across_ranks(free),
+            MAX_SEQ_LEN,
+            min_seq_len=MAX_SEQ_LEN,
+        )
+
     def batching_loop(self, timeout=100, max_tokens=MAX_BATCH_TOKENS):
         """
         batching_loop is an infinite loop responsible for executing generations.
@@ -368,8 +410,9 @@ class Model(AbstractModel):
 
         batching_loop also performs dynamic batching, in order to minimize the
         amount of padding by grouping like-sized workloads together. As a result
-        batching loop will provide preferential treatment to smaller workloads.  At
-        the current moment, there is no TTL logic to ensure a maximum wait time.
+        batching loop will provide preferential treatment to smaller workloads,
+        bounded by the max queue age of BATCH_QUEUE: requests waiting longer
+        are batched first. The loop sleeps on the queue while it is empty.
 
         For a rough overview of dynamic batching, see
         https://parl.ai/docs/tutorial_worlds.html#dynamic-batching.
@@ -377,180 +420,220 @@ class Model(AbstractModel):
         param timeout: The max queue time before a non-full batch is launched.
         :param max_tokens: the maximum number of tokens that can be processed
             concurrently. model specific and empirical.
+
+        Within that budget, batch sizes are picked by a latency model of the
+        loaded model, profiled at startup and refined from every batch.
         """
-        global BATCH_QUEUE
+        cost_model = self.load_cost_model(max_tokens)
+
+        def fits(bs_list, item):
+            # accumulate the batch until it gets too big
+            longest = max(x.cost for x in [item] + bs_list)
+            batch_cost = longest * (len(bs_list) + 1)
+            # overflow corresponds to whether max(prompt_len) + gen_len will
+            # fit the max sequence length
+            max_prompt_len = max(x.prompt_len for x in [item] + bs_list)
+            max_gen_len = max(x.gen_len for x in [item] + bs_list)
+            overflow = max_prompt_len + max_gen_len > MAX_SEQ_LEN
+            if batch_cost > max_tokens or overflow:
+                return False
+            # within the token budget, the measured cost model picks the
+            # batch size with the best throughput under the latency target
+            return cost_model.fits(bs_list, item)
 
-        batch_dict = defaultdict(list)
-        target_queue = None
         while True:
-            try:
-                assert len(batch_dict) <= 1
-
-                b_key, bs_list = next(iter(batch_dict.items())) if batch_dict else (None, [])
-                # for now, we only have 1 worker, so can always index to shard 0
-                if target_queue is None:
-                    # TODO: try to process a request with the same arg
-                    target_queue = BATCH_QUEUE.queue_shards[0].get_largest_queue(b_key)
-                if not target_queue:
-                    continue
-                # dynamic batching: group like-sized items to reduce the cost
-                # of padding. See PR#20 for additional context.
-                item = target_queue.get(timeout=timeout / 1000)
-                # accumulate the batch until it gets too big
-                longest = max([item] + bs_list).cost
-                batch_cost = longest * (len(bs_list) + 1)
-                # overflow corresponds to whether max(prompt_len) + gen_len will
-                # fit the max sequence length
-                max_prompt_len = max(x.prompt_len for x in [item] + bs_list)
-                max_gen_len = max(x.gen_len for x in [item] + bs_list)
-
-                # changed this to enable batching
-                overflow = max_prompt_len + max_gen_len > MAX_SEQ_LEN
-
-                # naive impl, as soon as the args are different fire
-                # the previous batch
-                if bs_list and (
-                    batch_cost > max_tokens
-                    or overflow
-                    # if the item is not the same arg, flush out the batch
-                    # and put back the item that doesn't match
-                    or (b_key is not None and b_key != item.queue_key())
-                ):
-                    # we're over budget, put it back in the queue
-                    target_queue.put(item)
-                    raise queue.Empty
-                batch_dict[item.queue_key()].append(item)
-
-            except queue.Empty:
-                target_queue = None
-                if batch_dict:
-                    # because we always flush out the batch as soon as we have a different key
-                    # the length of the batch_dict should always be 1
-
-                    assert len(batch_dict) == 1
-                    (batch,) = batch_dict.values()
-
-                    request_object = {
-                        "inputs": [],
-                        "min_tokens": [],
-                        "max_tokens": [],
-                    }
-
-                    # use this to check for correctness
-                    unique_dict = {}
-
-                    for work_item in batch:
-                        ro = work_item.data
-                        request_object["inputs"].append(ro["input"])
-                        request_object["min_tokens"].append(ro.get("min_tokens", 0))
-                        request_object["max_tokens"].append(ro.get("max_tokens", MAX_SEQ_LEN))
-
-                        for key in UNBATCHED_ARG_DICT:
-                            if key in unique_dict and unique_dict[key] != ro.get(
-                                key, unique_dict[key]
-                            ):
-                                raise ValueError(
-                                    f"the remaining args are not the same, currently \
-                                    {unique_dict}, but want {ro[key]} with key {key}"
-                                )
-
-                            if key in ro:
-                                request_object[key] = ro[key]
-                                unique_dict[key] = ro[key]
-
-                            else:
-                                # if key not in ro then it should take default value
-                                unique_dict[key] = UNBATCHED_ARG_DICT[key]
-
-                    # WARNING: seed will not be deterministic when we batch
-                    # TODO: do we include the seed or not? we can't guarantee the
-                    #   correctness of this parameter anyway
-                    # if "seed" not in request_object:
-                    request_object["seed"] = random.randint(0, 20000)
-
-                    # NOTE: aux is a tuple containing any necessary aux data for
-                    #       activation retrieval (only batch size right now)
-                    # TODO: Is there a better way to do this? Heavily constrained
-                    #       by broadcasting to ranks. Can't nest dicts
-                    request_object["_aux"] = (len(batch),)
-
-                    if torch.distributed.get_rank() == 0:
-                        logger.info(f"request object {request_object}")
-
-                    if torch.distributed.is_initialized():
-                        distributed_utils.broadcast_object(
-                            request_object,
-                            src_rank=0,
-                            group=distributed_utils.get_global_group(),
+            # dynamic batching: group like-sized items with the same args to
+            # reduce the cost of padding. See PR#20 for additional context.
+            batch = BATCH_QUEUE.get_batch(fits, timeout / 1000)
+            BATCH_QUEUE.metrics.record_fill(
+                max(x.cost for x in batch) * len(batch) / max_tokens)
+            logger.debug(f"Running batch of {len(batch)} requests, {len(BATCH_QUEUE)} queued")
+            if BATCH_QUEUE.metrics.log_due():
+                logger.info(f"Batching metrics: {BATCH_QUEUE.metrics.snapshot()}")
+
+            request_object = {
+                "inputs": [],
+                "min_tokens": [],
+                "max_tokens": [],
+            }
+
+            # use this to check for correctness
+            unique_dict = {}
+
+            for work_item in batch:
+                ro = work_item.data
+                request_object["inputs"].append(ro["input"])
+                request_object["min_tokens"].append(ro.get("min_tokens", 0))
+                request_object["max_tokens"].append(ro.get("max_tokens", MAX_SEQ_LEN))
+
+                for key in UNBATCHED_ARG_DICT:
+                    if key in unique_dict and unique_dict[key] != ro.get(
+                        key, unique_dict[key]
+                    ):
+                        raise ValueError(
+                            f"the remaining args are not the same, currently \
+                            {unique_dict}, but want {ro[key]} with key {key}"
                         )
 
-                    activation_dict = {}
+                    if key in ro:
+                        request_object[key] = ro[key]
+                        unique_dict[key] = ro[key]
 
-                    try:
-                        encoded_activation_payload = request_object.pop(
-                            "encoded_activation_payload", None
-                        )
-                        act_retrieval_aux = request_object.pop("_aux", None)
+                    else:
+                        # if key not in ro then it should take default value
+                        unique_dict[key] = UNBATCHED_ARG_DICT[key]
+
+            # WARNING: seed will not be deterministic when we batch
+            # TODO: do we include the seed or not? we can't guarantee the
+            #   correctness of this parameter anyway
+            # if "seed" not in request_object:
+            request_object["seed"] = random.randint(0, 20000)
+
+            # NOTE: aux is a tuple containing any necessary aux data for
+            #       activation retrieval (only batch size right now)
+            # TODO: Is there a better way to do this? Heavily constrained
+            #       by broadcasting to ranks. Can't nest dicts
+            request_object["_aux"] = (len(batch),)
+
+            if torch.distributed.get_rank() == 0:
+                logger.info(f"request object {request_object}")
+
+            if torch.distributed.is_initialized():
+                distributed_utils.broadcast_object(
+                    request_object,
+                    src_rank=0,
+                    group=distributed_utils.get_global_group(),
+                )
 
-                        if encoded_activation_payload:
-                            (hook_dict, activation_dict,) = get_activation_capture_hook_dict(
-                                generator.models[0],
-                                encoded_activation_payload,
-                                aux=act_retrieval_aux,
-                            )
+            activation_dict = {}
+            start_time = time.time()
 
-                            with apply_forward_hook(generator.models[0], hook_dict):
-                                generations = generator.generate(**request_object)
+            try:
+                encoded_activation_payload = request_object.pop(
+                    "encoded_activation_payload", None
+                )
+                act_retrieval_aux = request_object.pop("_aux", None)
+
+                if encoded_activation_payload:
+                    (hook_dict, activation_dict,) = get_activation_capture_hook_dict(
+                        generator.models[0],
+                        encoded_activation_payload,
+                        aux=act_retrieval_aux,
+                    )
+
+                    with apply_forward_hook(generator.models[0], hook_dict):
+                        generations = generator.generate(**request_object)
 
-                        else:
-                            generations = generator.generate(**request_object)
-
-                    except RuntimeError:
-                        # Probably cuda died. Unfortunately, we need to hard crash
-                        # here to kick in our self-healing mechanisms.
-                        raise
-                    except BaseException as err:
-                        # propagate any exceptions to the response so we can report it
-                        generations = [err] * len(batch)
-
-                    # broadcast them back
-                    for i, (work_item, gen) in enumerate(zip(batch, generations)):
-                        if not isinstance(gen, Exception):
-                            assert len(gen) == 1
-                            assert "activations" not in gen
-                            num_real_tokens = len(gen[0]["all_tokens"])
-
-                            # need the clone because otherwise the views are shared
-                            # and will need to be transferred
-                            # this is padded RIGHT
-
-                            # activations should come in as B x S x D
-                            ret_dict = {}
-
-                            for k, v in activation_dict.items():
-                                # attention map
-                                if "self_attn.dropout_module" in k:
-                                    val = v[
-                                        i,
-                                        :,
-                                        1 : num_real_tokens + 1,
-                                        1 : num_real_tokens + 1,
-                                    ].clone()
-                                else:
-                                    # cut off the starting token because metaseq
-                                    # adds. It should take out the pad to reduce bandwidth
-                                    val = v[i, 1 : num_real_tokens + 1].clone()
-                                ret_dict[k] = codecs.encode(
-                                    pickle.dumps(val),
-                                    "base64",
-                                ).decode("utf-8")
-
-                            gen[0]["activations"] = ret_dict
-
-                        work_item.return_queue.put((work_item.uid, gen))
-
-                    activation_dict.clear()
-                    batch_dict.clear()
                 else:
-                    # back to the loop
-                    continue
+                    generations = generator.generate(**request_object)
+
+            except RuntimeError:
+                # Probably cuda died. Unfortunately, we need to hard crash
+                # here to kick in our self-healing mechanisms.
+                raise
+            except BaseException as err:
+                # propagate any exceptions to the response so we can report it
+                generations = [err] * len(batch)
+            else:
+                cost_model.observe(
+                    len(batch),
+                    max(x.prompt_len for x in batch),
+                    max(x.gen_len for x in batch),
+                    time.time() - start_time,
+                )
+
+            # The capture hooks keep every module's batched activation on
+            # device. They are all copied to host at once, into the reused
+            # pinned staging buffer, and every item is then a view into it
+            host_activations = STAGING_BUFFER.stage(activation_dict)
+
+            # broadcast them back
+            for i, (work_item, gen) in enumerate(zip(batch, generations)):
+                if not isinstance(gen, Exception):
+                    assert len(gen) == 1
+                    assert "activations" not in gen
+                    num_real_tokens = len(gen[0]["all_tokens"])
+
+                    # this is padded RIGHT
+                    # activations should come in as B x S x D
+                    views = {}
+                    for k, v in host_activations.items():
+                        # attention map
+                        if "self_attn.dropout_module" in k:
+                            views[k] = v[
+                                i,
+                                :,
+                                1 : num_real_tokens + 1,
+                                1 : num_real_tokens + 1,
+                            ]
+                        else:
+                            # cut off the starting token because metaseq
+                            # adds. It should take out the pad to reduce bandwidth
+                            views[k] = v[i, 1 : num_real_tokens + 1]
+
+                    activation_dtype = work_item.data.get("activation_dtype")
+                    activation_compression = work_item.data.get("activation_compression")
+                    if work_item.data.get("activation_output") == "file":
+                        ret_dict = {
+                            k: spill_activation(val, activation_dtype=activation_dtype)
+                            for k, val in views.items()
+                        }
+                    elif views:
+                        # every module of the item serialized in one pass into
+                        # one envelope, which the gateway expands per module
+                        ret_dict = {
+                            PACK_PREFIX: encode_activation_pack(
+                                views,
+                                activation_dtype=activation_dtype,
+                                activation_compression=activation_compression,
+                            )
+                        }
+                    else:
+                        ret_dict = {}
+
+                    gen[0]["activations"] = ret_dict
+
+                work_item.return_queue.put((work_item.uid, gen))
+
+            activation_dict.clear()
+
+    def load_cost_model(self, max_tokens):
+        """
+        Load the batch cost model persisted for this variant, or profile the
+        loaded model on a grid of dummy batches to fit one
+        """
+        cost_model = BatchCostModel(
+            path=os.path.join(
+                COST_MODEL_DIR, f"{self.model_type}-{self.model_variant}-cost_model.json"),
+        )
+        if cost_model.load():
+            return cost_model
+
+        try:
+            cost_model.calibrate(self.profile_batch, MAX_SEQ_LEN, max_tokens)
+        except Exception as err:
+            logger.error(f"Failed to profile the batch cost model, only "
+                         f"the token budget is used: {err}")
+        return cost_model
+
+    def profile_batch(self, batch_size, prompt_len, gen_len):
+        """Time a generation on dummy prompts, run on every rank like a batch"""
+        request_object = {
+            # skip the special tokens at the start of the dictionary
+            "inputs": [list(range(4, 4 + prompt_len))] * batch_size,
+            "min_tokens": [gen_len] * batch_size,
+            "max_tokens": [gen_len] * batch_size,
+            "seed": 0,
+        }
+        if torch.distributed.is_initialized():
+            distributed_utils.broadcast_object(
+                request_object,
+                src_rank=0,
+                group=distributed_utils.get_global_group(),
+            )
+
+        torch.cuda.synchronize()
+        start_time = time.time()
+        generator.generate(**request_object)
+        torch.cuda.synchronize()
+        return time.time() - start_time
@@ -0,0 +1,142 @@
+"""Module for the typed generation parameter schema of the model services"""
+from dataclasses import dataclass, replace
+import json
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional
+
+
+def coerce_str(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if not isinstance(value, str):
+        raise ValueError(f"{value!r} is not a string")
+    return value
+
+
+def coerce_int(value) -> int:
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    as_float = float(value)
+    if not as_float.is_integer():
+        raise ValueError(f"{value!r} is not an integer")
+    return int(as_float)
+
+
+def coerce_bool(value) -> bool:
+    if isinstance(value, (bytes, str)):
+        value = coerce_str(value).lower()
+        if value in ("true", "1"):
+            return True
+        if value in ("false", "0"):
+            return False
+        raise ValueError(f"{value!r} is not a boolean")
+    return bool(value)
+
+
+# Parameter types used in the config.json files, and how input values are
+# coerced into them
+PARAMETER_TYPES = {
+    "str": coerce_str,
+    "int": coerce_int,
+    "float": float,
+    "bool": coerce_bool,
+}
+
+
+@dataclass(frozen=True)
+class ParameterSpec:
+    """A generation parameter, with its defaults per task"""
+
+    name: str
+    type: str
+    defaults: Mapping[str, Any]
+    description: str = ""
+
+    def coerce(self, value):
+        """Coerce a value into the parameter's type, or raise a ValueError"""
+        try:
+            return PARAMETER_TYPES[self.type](value)
+        except (TypeError, ValueError) as err:
+            raise ValueError(
+                f"Invalid {self.type} value for parameter {self.name}: {value!r}"
+            ) from err
+
+
+class ParameterSchema:
+    """
+    The generation parameters of a model, parsed once at startup from the
+    "parameters" section of its config.json. Nothing here is mutated after
+    construction, so concurrent requests can share it.
+    """
+
+    def __init__(self, specs: Dict[str, ParameterSpec]):
+        self.specs = MappingProxyType(dict(specs))
+
+        task_names = dict.fromkeys(
+            task_name for spec in specs.values() for task_name in spec.defaults
+        )
+        self._task_defaults = MappingProxyType(
+            {
+                task_name: MappingProxyType(
+                    {
+                        name: spec.defaults[task_name]
+                        for name, spec in specs.items()
+                        if spec.defaults.get(task_name) is not None
+                    }
+                )
+                for task_name in task_names
+            }
+        )
+
+    @classmethod
+    def from_config(cls, config_path: str):
+        """Parse and validate the parameter schema of a config.json file"""
+        with open(config_path) as file:
+            parameters = json.load(file)["parameters"]
+
+        specs = {}
+        for name, parameter in parameters.items():
+            if parameter["type"] not in PARAMETER_TYPES:
+                raise ValueError(
+                    f"Parameter {name} has unknown type {parameter['type']}, "
+                    f"expected one of {tuple(PARAMETER_TYPES)}"
+                )
+            spec = ParameterSpec(
+                name=name,
+                type=parameter["type"],
+                defaults={},
+                description=parameter.get("description", ""),
+            )
+            # The defaults are validated like any input
+            specs[name] = replace(
+                spec,
+                defaults=MappingProxyType(
+                    {
+                        task_name: None if default is None else spec.coerce(default)
+                        for task_name, default in parameter["default"].items()
+                    }
+                ),
+            )
+        return cls(specs)
+
+    def defaults(self, task_name: str) -> Mapping[str, Any]:
+        """The frozen default parameters of a task, leaving out unset ones"""
+        return self._task_defaults.get(task_name, MappingProxyType({}))
+
+    def resolve(
+        self,
+        task_name: str,
+        inputs: Optional[Dict[str, Any]] = None,
+        **overrides,
+    ) -> Mapping[str, Any]:
+        """
+        Build the frozen parameters of one request: the task defaults,
+        overridden by the coerced values of the request's input tensors and
+        then by `overrides`, which are taken as is.
+        """
+        params = dict(self.defaults(task_name))
+        for name, spec in self.specs.items():
+            if inputs is not None and name in inputs:
+                params[name] = spec.coerce(inputs[name][0][0])
+        params.update(overrides)
+        return MappingProxyType(params)
@@ -0,0 +1,176 @@
+"""Module for pipelining micro-batches through models dispatched over several GPUs"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+
+from .memory_profiler import device_free_memory
+
+
+logger = logging.getLogger("kaleidoscope.model_service.pipeline")
+
+# Fraction of the free memory of every GPU the weights may use, the rest is
+# left for the KV caches and activations of the micro-batches
+WEIGHT_MEMORY_FRACTION = float(os.environ.get("PIPELINE_WEIGHT_MEMORY_FRACTION", 0.7))
+
+
+def balanced_device_map(
+    model: torch.nn.Module,
+    no_split_module_classes: Sequence[str],
+    dtype: Optional[torch.dtype],
+    weight_memory_fraction: float = WEIGHT_MEMORY_FRACTION,
+) -> Dict[str, Union[int, str]]:
+    """
+    A device map of an empty-weights model spreading its layers evenly over
+    every visible GPU, sized from their actual free memory. Nothing is
+    offloaded to CPU or disk, which would stall every pipeline stage.
+    Without a dtype, layers are sized by the tensors they hold, eg. int8
+    quantized weights.
+    """
+    from accelerate import infer_auto_device_map
+    from accelerate.utils.modeling import get_balanced_memory
+
+    max_memory = {}
+    for idx in range(torch.cuda.device_count()):
+        max_memory[idx] = int(device_free_memory(idx) * weight_memory_fraction)
+    max_memory = get_balanced_memory(
+        model,
+        max_memory=max_memory,
+        no_split_module_classes=no_split_module_classes,
+        dtype=dtype,
+    )
+    device_map = infer_auto_device_map(
+        model,
+        max_memory=max_memory,
+        no_split_module_classes=no_split_module_classes,
+        dtype=dtype,
+    )
+    offloaded = [name for name, device in device_map.items() if device in ("cpu", "disk")]
+    if offloaded:
+        raise RuntimeError(
+            f"Model does not fit in GPU memory {max_memory}, would offload {offloaded}"
+        )
+    logger.info(f"Balanced device map over GPU memory {max_memory}: {device_map}")
+    return device_map
+
+
+class MicroBatchPipeline:
+    """
+    Runs a batch as micro-batches which flow through the stages of a model
+    dispatched over several devices, one stage per device, so that every
+    device works on a different micro-batch at once instead of one device at
+    a time.
+
+    Every micro-batch runs on its own thread. A stage is entered by the
+    forward pre-hooks of its modules, which take the stage's lock after
+    releasing the previous stage's, so each stage serves one micro-batch at a
+    time and stateful layers like rotary embedding caches are never run
+    concurrently. A thread holds at most one stage, so the schedule can't
+    deadlock even when the output head shares the input embedding's device.
+
+    If `trace` is given, (micro-batch, stage, event, time) tuples are
+    appended to it as stages are entered and left.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        device_map: Dict[str, Union[int, str]],
+        num_micro_batches: Optional[int] = None,
+        trace: Optional[List[tuple]] = None,
+    ):
+        # Stages are the devices, in the order they are first used
+        devices = list(dict.fromkeys(device_map.values()))
+        self.num_stages = len(devices)
+        self.num_micro_batches = num_micro_batches or self.num_stages
+        self.stage_locks = [threading.Lock() for _ in devices]
+        self.state = threading.local()
+        self.trace = trace
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.num_micro_batches, thread_name_prefix="pipeline"
+        )
+
+        module_index = dict(model.named_modules())
+        self.handles = []
+        for name, device in device_map.items():
+            module = module_index[name]
+            # Containers are never called, their layers are
+            modules = (
+                module
+                if isinstance(module, (torch.nn.ModuleList, torch.nn.Sequential))
+                else [module]
+            )
+            for module in modules:
+                self.handles.append(
+                    module.register_forward_pre_hook(
+                        partial(self._enter_stage, devices.index(device))
+                    )
+                )
+        self.handles.append(model.register_forward_hook(self._leave_stage))
+
+    def _record(self, stage: int, event: str):
+        if self.trace is not None:
+            self.trace.append((self.state.micro_batch, stage, event, time.perf_counter()))
+
+    def _enter_stage(self, stage: int, _module, _inputs):
+        # Forward calls outside of the pipeline's threads aren't scheduled
+        if getattr(self.state, "micro_batch", None) is None:
+            return
+        if getattr(self.state, "stage", None) == stage:
+            return
+        self._leave_stage()
+        self.stage_locks[stage].acquire()
+        self.state.stage = stage
+        self._record(stage, "enter")
+
+    def _leave_stage(self, *_args):
+        stage = getattr(self.state, "stage", None)
+        if stage is None:
+            return
+        self._record(stage, "leave")
+        self.state.stage = None
+        self.stage_locks[stage].release()
+
+    def _run_micro_batch(self, fn: Callable, micro_batch: int, inputs: Dict[str, np.ndarray]):
+        self.state.micro_batch = micro_batch
+        try:
+            return fn(inputs)
+        finally:
+            self._leave_stage()
+            self.state.micro_batch = None
+
+    def run(
+        self,
+        fn: Callable[[Dict[str, np.ndarray]], Dict[str, np.ndarray]],
+        inputs: Dict[str, np.ndarray],
+    ):
+        """
+        Split the rows of a batch into micro-batches, run `fn` on all of them
+        concurrently, and concatenate their outputs in order. Outputs are
+        concatenated rather than restacked, so ragged object rows stay one
+        list per row.
+        """
+        batch_size = len(next(iter(inputs.values())))
+        bounds = np.linspace(0, batch_size, min(self.num_micro_batches, batch_size) + 1).astype(int)
+        futures = [
+            self.pool.submit(
+                self._run_micro_batch,
+                fn,
+                idx,
+                {name: value[start:end] for name, value in inputs.items()},
+            )
+            for idx, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+        ]
+        outputs = [future.result() for future in futures]
+        return {name: np.concatenate([output[name] for output in outputs]) for name in outputs[0]}
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles.clear()
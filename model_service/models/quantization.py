@@ -0,0 +1,238 @@
+"""Module for serving models with weight-only int8 quantized linear layers"""
+from collections import OrderedDict
+import functools
+import json
+import logging
+import os
+import threading
+from typing import Callable, Optional, Tuple
+
+import torch
+
+try:
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+except ImportError:
+    from torch.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+
+logger = logging.getLogger("kaleidoscope.model_service.quantization")
+
+QUANTIZATION_MODES = ("int8",)
+
+# Layers quantized, by class name, and the dimension of their weight holding
+# the output channels. transformers' Conv1D stores its weight transposed.
+LINEAR_CHANNEL_DIMS = {
+    "Linear": 0,
+    "ColumnParallelLinear": 0,
+    "RowParallelLinear": 0,
+    "Conv1D": 1,
+}
+
+# fairscale's tensor parallel layers, whose forward runs the collectives
+# joining their shards
+TENSOR_PARALLEL_LINEARS = ("ColumnParallelLinear", "RowParallelLinear")
+
+# Bytes of dequantized weights kept on device between forward passes, so
+# that the layers whose weights fit in it skip dequantizing. By default
+# every forward dequantizes its weight again
+DEQUANTIZED_CACHE_BYTES = int(os.environ.get("DEQUANTIZED_CACHE_BYTES", 0))
+
+
+def get_quantization(config_path: str, model_variant: str) -> Optional[str]:
+    """
+    The quantization mode a variant is served with, set by the "quantization"
+    key of its entry in the model's config.json, or at the top level for
+    models without variants. None serves the weights unquantized.
+    """
+    with open(config_path, "r") as config_file:
+        config = json.load(config_file)
+    variants = config.get("variants")
+    options = variants.get(model_variant, {}) if variants else config
+    quantization = options.get("quantization")
+    if quantization is not None and quantization not in QUANTIZATION_MODES:
+        raise ValueError(
+            f"Unsupported quantization {quantization}, expected one of {QUANTIZATION_MODES}"
+        )
+    return quantization
+
+
+def quantize_per_channel(
+    weight: torch.Tensor, channel_dim: int = 0
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric int8 quantization of a weight with one scale per output
+    channel. The scales keep the weight's dtype and broadcast against it.
+    """
+    reduce_dims = [dim for dim in range(weight.dim()) if dim != channel_dim]
+    absmax = weight.detach().float().abs().amax(dim=reduce_dims, keepdim=True)
+    scale = absmax.clamp(min=1e-8) / 127
+    weight_int8 = torch.round(weight.detach().float() / scale).clamp(-127, 127).to(torch.int8)
+    return weight_int8, scale.to(weight.dtype)
+
+
+class DequantizedWeightCache:
+    """
+    Dequantized weights of int8 layers, least recently used first, bounded
+    by their total bytes. Weights larger than the whole cache are never kept.
+    """
+
+    def __init__(self, max_bytes: int = DEQUANTIZED_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+
+    def get(self, module: torch.nn.Module, dequantize: Callable[[], torch.Tensor]) -> torch.Tensor:
+        key = id(module)
+        with self.lock:
+            weight = self.entries.get(key)
+            # Weights moved to another device since are dequantized again
+            if weight is not None and weight.device == module.weight_int8.device:
+                self.entries.move_to_end(key)
+                return weight
+
+        weight = dequantize()
+        num_bytes = weight.numel() * weight.element_size()
+        if num_bytes > self.max_bytes:
+            return weight
+
+        with self.lock:
+            stale = self.entries.pop(key, None)
+            if stale is not None:
+                self.num_bytes -= stale.numel() * stale.element_size()
+            while self.num_bytes + num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= evicted.numel() * evicted.element_size()
+            self.entries[key] = weight
+            self.num_bytes += num_bytes
+        return weight
+
+
+DEQUANTIZED_CACHE = DequantizedWeightCache()
+
+
+class Int8WeightMixin:
+    """
+    Mixed into the class of a linear layer whose weight is stored as int8
+    with per-channel scales. The weight is dequantized to the scales' dtype
+    whenever the layer's own forward reads it, so the layer computes, and its
+    hooks see, outputs in the original dtype, and tensor parallel layers
+    keep their collectives. Only the int8 weights stay resident on device.
+
+    Dequantizing costs a transient copy of the layer's weight in the
+    original dtype, freed once its forward is done, so the peak memory of a
+    forward pass grows by the largest quantized weight of a layer, which the
+    batch limits leave room for. Layers whose dequantized weights fit in the
+    DEQUANTIZED_CACHE_BYTES budget keep them between forward passes instead,
+    trading that memory for the dequantization.
+    """
+
+    def dequantize_weight(self) -> torch.Tensor:
+        return self.weight_int8.to(self.weight_scale.dtype) * self.weight_scale
+
+    @property
+    def weight(self) -> torch.Tensor:
+        if DEQUANTIZED_CACHE.max_bytes <= 0:
+            return self.dequantize_weight()
+        return DEQUANTIZED_CACHE.get(self, self.dequantize_weight)
+
+
+@functools.lru_cache(maxsize=None)
+def int8_weight_class(cls: type) -> type:
+    return type(f"Int8{cls.__name__}", (Int8WeightMixin, cls), {})
+
+
+class DynamicInt8Linear(torch.nn.Module):
+    """
+    A linear layer running on PyTorch's native CPU int8 kernels, fbgemm or
+    qnnpack. Weights are quantized per channel once, activations per batch
+    on the fly. Outputs are cast back to the input dtype.
+    """
+
+    def __init__(self, weight: torch.Tensor, bias: Optional[torch.Tensor]):
+        super().__init__()
+        out_features, in_features = weight.shape
+        weight = weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        qweight = torch.quantize_per_channel(
+            weight,
+            scale.double(),
+            torch.zeros(out_features, dtype=torch.long),
+            axis=0,
+            dtype=torch.qint8,
+        )
+        self.linear = DynamicQuantizedLinear(in_features, out_features, dtype=torch.qint8)
+        self.linear.set_weight_bias(qweight, None if bias is None else bias.detach().float())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.linear(x.float()).to(x.dtype)
+
+
+def model_parallel_world_size() -> int:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_world_size()
+    return 1
+
+
+def is_quantizable(module: torch.nn.Module) -> bool:
+    weight = getattr(module, "weight", None)
+    return (
+        type(module).__name__ in LINEAR_CHANNEL_DIMS
+        and isinstance(weight, torch.nn.Parameter)
+        and weight.dim() == 2
+    )
+
+
+def quantize_model(model: torch.nn.Module, device: torch.device) -> torch.nn.Module:
+    """
+    Quantize the weights of the linear layers of a model in place, before it
+    is moved to `device`. Module names are kept, so activations are still
+    retrieved and edited by name, on the dequantized outputs. Weights tied
+    to another module, like output heads sharing the input embedding, are
+    left as is, since quantizing them would only add a copy.
+
+    On CPU, layers are swapped for native dynamic int8 kernels, elsewhere
+    weights are stored as int8 and dequantized as they are used. Tensor
+    parallel layers of models sharded over several ranks are never swapped,
+    as the int8 kernels would drop the collectives joining their shards, so
+    they are dequantized as they are used on CPU too.
+    """
+    shared = {}
+    for module in model.modules():
+        for param in module._parameters.values():
+            if param is not None:
+                shared[id(param)] = shared.get(id(param), 0) + 1
+
+    # Collect first, as layers are swapped while walking the model otherwise
+    layers = [
+        (name, module)
+        for name, module in model.named_modules()
+        if is_quantizable(module) and shared[id(module.weight)] == 1
+    ]
+    sharded = model_parallel_world_size() > 1
+    weight_bytes, quantized_bytes = 0, 0
+    for name, module in layers:
+        weight = module.weight
+        weight_bytes += weight.numel() * weight.element_size()
+        channel_dim = LINEAR_CHANNEL_DIMS[type(module).__name__]
+        tensor_parallel = sharded and type(module).__name__ in TENSOR_PARALLEL_LINEARS
+
+        if device.type == "cpu" and not tensor_parallel:
+            if channel_dim == 1:
+                weight = weight.t()
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(parent, child_name, DynamicInt8Linear(weight, module.bias))
+        else:
+            weight_int8, weight_scale = quantize_per_channel(weight, channel_dim)
+            del module.weight
+            module.register_buffer("weight_int8", weight_int8)
+            module.register_buffer("weight_scale", weight_scale)
+            module.__class__ = int8_weight_class(type(module))
+        quantized_bytes += weight.numel()
+
+    logger.info(
+        f"Quantized {len(layers)} linear layers to int8 for {device.type}, "
+        f"weights from {weight_bytes} to about {quantized_bytes} bytes"
+    )
+    return model
@@ -0,0 +1,184 @@
+"""Module for sampling with different parameters for every row of a batch"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+def get_row_params(
+    inputs: Dict[str, np.ndarray],
+    name: str,
+    default,
+    batch_size: int,
+    dtype=np.float64,
+) -> np.ndarray:
+    """
+    One value per row of the pytriton batch for some optional input, rather
+    than only the value of the first row. Inputs given once are broadcast to
+    every row.
+    """
+    if name not in inputs:
+        return np.full(batch_size, default, dtype=dtype)
+
+    values = np.asarray(inputs[name], dtype=dtype).reshape(-1)
+    if values.shape[0] == 1:
+        values = np.repeat(values, batch_size)
+    return values
+
+
+def split_rows(values: Sequence, row_lengths: Sequence[int]) -> np.ndarray:
+    """
+    Split the values of all rows, concatenated, into a 1-D object array of
+    one list per row. Rows stop at their own lengths, so they are ragged and
+    never form a 2-D array, even when they happen to have the same length.
+    """
+    rows = np.empty(len(row_lengths), dtype=object)
+    for idx, row in enumerate(
+        np.split(np.asarray(values, dtype=object), np.cumsum(row_lengths)[:-1])
+    ):
+        rows[idx] = row.tolist()
+    return rows
+
+
+def truncate_at_eos(
+    generated_ids: Tensor,
+    transition_scores: Tensor,
+    eos_token_id: int,
+) -> Tuple[List[List[int]], List[List[float]]]:
+    """
+    The generated ids and logprobs of every row up to its first EOS. Rows of
+    a batch which stop early are padded with EOS until the longest one ends,
+    so everything from the first EOS on is dropped.
+    """
+    sequences, logprobs = [], []
+    for sequence, scores in zip(generated_ids.tolist(), transition_scores.tolist()):
+        if eos_token_id in sequence:
+            eos_idx = sequence.index(eos_token_id)
+            sequence, scores = sequence[:eos_idx], scores[:eos_idx]
+        sequences.append(sequence)
+        logprobs.append(scores)
+    return sequences, logprobs
+
+
+def decode_generations(
+    tokenizer,
+    generated_ids: Tensor,
+    transition_scores: Tensor,
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    The text of every generated row, and its tokens and logprobs leaving out
+    special tokens as ragged rows. Special tokens are masked on device, the
+    ids, mask and scores are copied to host once each, and the kept tokens of
+    all rows are decoded in one `batch_decode` call.
+    """
+    special_ids = torch.tensor(tokenizer.all_special_ids, device=generated_ids.device)
+    is_kept = ~torch.isin(generated_ids, special_ids)
+
+    generated_ids = generated_ids.cpu().numpy()
+    is_kept = is_kept.cpu().numpy()
+    transition_scores = transition_scores.float().cpu().numpy()
+    generations = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+
+    row_lengths = is_kept.sum(axis=1)
+    kept_tokens = tokenizer.batch_decode(generated_ids[is_kept][:, None].tolist())
+    tokens = split_rows(kept_tokens, row_lengths)
+    return generations, tokens, split_rows(transition_scores[is_kept], row_lengths)
+
+
+def mask_logits_per_row(
+    logits: Tensor,
+    temperature: Tensor,
+    top_p: Optional[Tensor] = None,
+    top_k: Optional[Tensor] = None,
+) -> Tensor:
+    """
+    Apply per-row temperature scaling, top-k and top-p masks to (batch, vocab)
+    logits in one vectorized pass. A top-k of zero disables it for the row.
+    Rows with a temperature of zero are greedy, so everything but their
+    argmax is masked.
+    """
+    logits = logits.float()
+    greedy = temperature <= 0
+    logits = logits / torch.where(greedy, torch.ones_like(temperature), temperature).unsqueeze(-1)
+
+    sorted_logits, sorted_idx = torch.sort(logits, dim=-1, descending=True)
+    ranks = torch.arange(logits.shape[-1], device=logits.device).unsqueeze(0)
+
+    remove = greedy.unsqueeze(-1) & (ranks >= 1)
+    if top_k is not None:
+        remove |= (top_k.unsqueeze(-1) > 0) & (ranks >= top_k.unsqueeze(-1))
+    if top_p is not None:
+        # Same rule as LLaMA: drop tokens once the mass before them exceeds p
+        probs = torch.softmax(sorted_logits.masked_fill(remove, float("-inf")), dim=-1)
+        remove |= torch.cumsum(probs, dim=-1) - probs > top_p.unsqueeze(-1)
+
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    return torch.empty_like(logits).scatter_(-1, sorted_idx, sorted_logits)
+
+
+def sample_per_row(
+    logits: Tensor,
+    temperature: Tensor,
+    top_p: Optional[Tensor] = None,
+    top_k: Optional[Tensor] = None,
+) -> Tensor:
+    """Sample one token per row of (batch, vocab) logits."""
+    probs = torch.softmax(mask_logits_per_row(logits, temperature, top_p, top_k), dim=-1)
+    return torch.multinomial(probs, num_samples=1).reshape(-1)
+
+
+class RowSamplingLogitsProcessor:
+    def __init__(
+        self,
+        input_len: int,
+        eos_token_id: int,
+        max_new_tokens: np.ndarray,
+        min_new_tokens: Optional[np.ndarray] = None,
+        temperature: Optional[np.ndarray] = None,
+        top_p: Optional[np.ndarray] = None,
+        top_k: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        HuggingFace logits processor applying per-row sampling parameters, so
+        rows with different settings share one `generate` call. Generate must
+        then sample with temperature 1 and no top-k or top-p of its own.
+        Without temperatures only the per-row stop lengths are applied, which
+        also works for greedy generation.
+
+        Rows stop at their own length by forcing EOS once they reach
+        `max_new_tokens`, and can't stop before `min_new_tokens`.
+        """
+        self.input_len = input_len
+        self.eos_token_id = eos_token_id
+        self.max_new_tokens = torch.as_tensor(max_new_tokens)
+        self.min_new_tokens = None if min_new_tokens is None else torch.as_tensor(min_new_tokens)
+        self.temperature = (
+            None if temperature is None else torch.as_tensor(temperature, dtype=torch.float32)
+        )
+        self.top_p = None if top_p is None else torch.as_tensor(top_p, dtype=torch.float32)
+        self.top_k = None if top_k is None else torch.as_tensor(top_k)
+
+    def __call__(self, input_ids: Tensor, scores: Tensor) -> Tensor:
+        device = scores.device
+        num_generated = input_ids.shape[-1] - self.input_len
+
+        if self.min_new_tokens is not None:
+            ban_eos = (num_generated < self.min_new_tokens).to(device)
+            scores[:, self.eos_token_id] = scores[:, self.eos_token_id].masked_fill(
+                ban_eos, float("-inf")
+            )
+
+        if self.temperature is not None:
+            scores = mask_logits_per_row(
+                scores,
+                self.temperature.to(device),
+                None if self.top_p is None else self.top_p.to(device),
+                None if self.top_k is None else self.top_k.to(device),
+            )
+
+        force_eos = (num_generated >= self.max_new_tokens).to(device)
+        if force_eos.any():
+            scores = scores.masked_fill(force_eos.unsqueeze(-1), float("-inf"))
+            scores[:, self.eos_token_id] = scores[:, self.eos_token_id].masked_fill(force_eos, 0.0)
+        return scores
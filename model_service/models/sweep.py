@@ -0,0 +1,40 @@
+"""Module for running activation patching sweeps, one response row per prompt"""
+import ast
+import json
+from typing import Callable, Dict, List
+
+import numpy as np
+
+
+def run_sweep(
+    run_variants: Callable[[List[dict]], Dict[str, np.ndarray]],
+    variants: List[dict],
+    max_batch_size: int,
+) -> Dict[str, str]:
+    """
+    Run every edit variant of one prompt's sweep, in batches of at most
+    `max_batch_size` variants. `run_variants` generates one row per variant
+    of a batch, with the activations of every row encoded on their own.
+
+    All variants are packed into the prompt's single response row, in the
+    order they were given: the sequences, tokens and logprobs as JSON lists
+    with one entry per variant, and the activations as a dict keyed by
+    variant index.
+    """
+    sequences, tokens, logprobs, activations = [], [], [], {}
+    for start in range(0, len(variants), max_batch_size):
+        response = run_variants(variants[start : start + max_batch_size])
+        sequences.extend(str(sequence) for sequence in response["sequences"].tolist())
+        tokens.extend(response["tokens"].tolist())
+        logprobs.extend(response["logprobs"].tolist())
+        for idx, row in enumerate(response["activations"].tolist()):
+            if isinstance(row, bytes):
+                row = row.decode("utf-8")
+            activations[start + idx] = ast.literal_eval(row)
+
+    return {
+        "sequences": json.dumps(sequences),
+        "tokens": json.dumps(tokens),
+        "logprobs": json.dumps(logprobs),
+        "activations": str(activations),
+    }
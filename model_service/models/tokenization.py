@@ -0,0 +1,99 @@
+"""Module for encoding prompts ahead of the GPU batching loops"""
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
+import os
+import threading
+from typing import Callable, List, Sequence
+
+import numpy as np
+
+
+# Number of threads encoding prompts in parallel
+TOKENIZER_THREADS = int(os.environ.get("TOKENIZER_THREADS", 4))
+# Total number of tokens kept in the prompt cache
+TOKENIZER_CACHE_TOKENS = int(os.environ.get("TOKENIZER_CACHE_TOKENS", 4_000_000))
+
+
+class TokenCache:
+    """LRU cache of prompt -> token ids, bounded by the total number of tokens"""
+
+    def __init__(self, max_tokens: int = TOKENIZER_CACHE_TOKENS):
+        self.max_tokens = max_tokens
+        self.num_tokens = 0
+        self.entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, prompt: str):
+        with self.lock:
+            token_ids = self.entries.get(prompt)
+            if token_ids is not None:
+                self.entries.move_to_end(prompt)
+            return token_ids
+
+    def put(self, prompt: str, token_ids: np.ndarray):
+        if len(token_ids) > self.max_tokens:
+            return
+        with self.lock:
+            if prompt in self.entries:
+                return
+            self.entries[prompt] = token_ids
+            self.num_tokens += len(token_ids)
+            while self.num_tokens > self.max_tokens:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_tokens -= len(evicted)
+
+
+class ThreadLocalTokenizer:
+    """
+    One copy of a tokenizer per calling thread. Fast tokenizers can't be
+    shared by the model instances, which run concurrently, as padding
+    mutates them
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.local = threading.local()
+
+    def get(self):
+        tokenizer = getattr(self.local, "tokenizer", None)
+        if tokenizer is None:
+            tokenizer = copy.deepcopy(self.tokenizer)
+            self.local.tokenizer = tokenizer
+        return tokenizer
+
+
+class TokenizationStage:
+    """
+    Encodes the prompts of a request on a pool of worker threads, so that
+    long prompts are tokenized in parallel and off the GPU batching loop.
+    Repeated prompts are served from an LRU cache.
+
+    Tokenizers which release the GIL, like SentencePiece, run truly in
+    parallel. Pure Python ones still overlap with GPU work.
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[[str], List[int]],
+        num_threads: int = TOKENIZER_THREADS,
+        cache_tokens: int = TOKENIZER_CACHE_TOKENS,
+    ):
+        self.encode_fn = encode_fn
+        self.pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="tokenizer")
+        self.cache = TokenCache(cache_tokens)
+
+    def encode_one(self, prompt: str) -> List[int]:
+        token_ids = self.cache.get(prompt)
+        if token_ids is None:
+            token_ids = np.asarray(self.encode_fn(prompt), dtype=np.int32)
+            self.cache.put(prompt, token_ids)
+        return token_ids.tolist()
+
+    def submit(self, prompts: Sequence[str]) -> List[Future]:
+        """Start encoding prompts, returning one future per prompt"""
+        return [self.pool.submit(self.encode_one, prompt) for prompt in prompts]
+
+    def encode(self, prompts: Sequence[str]) -> List[List[int]]:
+        """Encode prompts in parallel, in order"""
+        return [future.result() for future in self.submit(prompts)]
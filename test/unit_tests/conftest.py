@@ -0,0 +1,11 @@
+"""Shared setup of the unit tests"""
+import importlib
+import os
+import sys
+
+# The model service modules are imported as `models.<module>`, like the
+# services themselves do
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../model_service")))
+# Bind `models` to the model service package now, before the gateway tests
+# put web/, and its own models module, on the path
+importlib.import_module("models")
@@ -0,0 +1,23 @@
+"""Unit tests for the abstraction of the models"""
+import pytest
+
+pytest.importorskip("pytriton")
+
+from models import abstract_model
+from models.abstract_model import AbstractModel
+
+
+class Model(AbstractModel):
+    rank = 0
+    load = bind = generate = get_activations = edit_activations = None
+
+    def infer(self, **inputs):
+        return inputs
+
+
+def test_one_infer_func_per_instance(monkeypatch):
+    monkeypatch.setattr(abstract_model, "NUM_INFER_INSTANCES", 3)
+    model = Model()
+    infer_funcs = model.infer_funcs()
+    assert len(infer_funcs) == 3
+    assert all(infer_func == model.infer for infer_func in infer_funcs)
@@ -0,0 +1,76 @@
+"""Unit tests for the cache of captured activations on the model services"""
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.activation_cache import ActivationCache
+
+# Every activation is 4 float32 elements
+NBYTES = 16
+
+
+def activation(value):
+    return torch.full((1, 4), float(value))
+
+
+def test_put_and_get():
+    cache = ActivationCache(max_bytes=10 * NBYTES, ttl=60)
+    handle = cache.put({"layers.0": activation(1), "layers.1": activation(2)})
+    assert cache.num_bytes == 2 * NBYTES
+    assert torch.equal(cache.get(handle, "layers.1"), activation(2))
+
+    with pytest.raises(Exception, match="no activation for module"):
+        cache.get(handle, "layers.2")
+    with pytest.raises(Exception, match="unknown or expired"):
+        cache.get("missing", "layers.0")
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ActivationCache(max_bytes=2 * NBYTES, ttl=60)
+    first = cache.put({"layer": activation(1)})
+    second = cache.put({"layer": activation(2)})
+
+    # Reading the first entry makes the second one the least recently used
+    cache.get(first, "layer")
+    third = cache.put({"layer": activation(3)})
+
+    assert cache.num_bytes == 2 * NBYTES
+    assert torch.equal(cache.get(first, "layer"), activation(1))
+    assert torch.equal(cache.get(third, "layer"), activation(3))
+    with pytest.raises(Exception, match="unknown or expired"):
+        cache.get(second, "layer")
+
+
+def test_entries_expire_after_their_ttl():
+    cache = ActivationCache(max_bytes=10 * NBYTES, ttl=0.05)
+    handle = cache.put({"layer": activation(1)})
+    time.sleep(0.1)
+
+    with pytest.raises(Exception, match="unknown or expired"):
+        cache.get(handle, "layer")
+    assert cache.num_bytes == 0
+
+
+def test_activations_larger_than_the_cache_are_not_cached():
+    cache = ActivationCache(max_bytes=NBYTES, ttl=60)
+    assert cache.put({"a": activation(1), "b": activation(2)}) is None
+    assert cache.num_bytes == 0
+
+
+def test_views_are_copied_out_of_their_capture_buffer():
+    # Like a capture buffer allocated for the whole generation, of which only
+    # the first tokens were filled
+    buffer = torch.zeros(1, 100, 4)
+    view = buffer.narrow(1, 0, 2)
+    view.fill_(1.0)
+
+    cache = ActivationCache(max_bytes=10 * NBYTES, ttl=60)
+    handle = cache.put({"layer": view})
+    cached = cache.get(handle, "layer")
+
+    assert cache.num_bytes == 2 * NBYTES
+    assert torch.equal(cached, view)
+    assert cached.untyped_storage().nbytes() == 2 * NBYTES
+    assert cached.untyped_storage().data_ptr() != buffer.untyped_storage().data_ptr()
@@ -0,0 +1,274 @@
+"""Unit tests for capturing and editing activations, shared by the model services"""
+import os
+import socket
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+mp = pytest.importorskip("torch.multiprocessing")
+
+from models.activation_capture import (
+    ActivationCapture,
+    gather_to_rank0,
+    get_reducer,
+    get_shard_edit,
+)
+
+WORLD_SIZE = 3
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Every combination of (point_to_point, async_op)
+GATHER_MODES = [(False, True), (False, False), (True, True), (True, False)]
+
+
+def gather_worker(rank, port, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=WORLD_SIZE)
+    try:
+        for point_to_point, async_op in GATHER_MODES:
+            # Every rank holds its shard of the last dimension
+            shard = torch.full((2, 3, 2), float(rank))
+            pending = gather_to_rank0(shard, async_op=async_op, point_to_point=point_to_point)
+            gathered = pending.wait()
+            results[(rank, point_to_point, async_op)] = (
+                None if gathered is None else gathered.tolist()
+            )
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+@pytest.mark.skipif(not torch.distributed.is_available(), reason="no torch.distributed")
+def test_gather_to_rank0(monkeypatch):
+    # The workers import this module again, from the path of this process.
+    # The model services' `models` is a namespace package, so the gateway's
+    # `models` module must not be on that path
+    monkeypatch.setattr(
+        sys,
+        "path",
+        [path for path in sys.path if not os.path.isfile(os.path.join(path, "models.py"))],
+    )
+    results = mp.Manager().dict()
+    mp.spawn(gather_worker, args=(free_port(), results), nprocs=WORLD_SIZE)
+
+    expected = torch.cat(
+        [torch.full((2, 3, 2), float(rank)) for rank in range(WORLD_SIZE)], dim=-1
+    ).tolist()
+    for point_to_point, async_op in GATHER_MODES:
+        assert results[(0, point_to_point, async_op)] == expected
+        # Only rank0 receives the gathered tensor
+        for rank in range(1, WORLD_SIZE):
+            assert results[(rank, point_to_point, async_op)] is None
+
+
+def test_gather_to_rank0_without_other_ranks(monkeypatch):
+    monkeypatch.setattr(torch.distributed, "get_world_size", lambda group=None: 1)
+    shard = torch.ones(2, 3)
+    assert gather_to_rank0(shard).wait() is shard
+
+
+def generate_right_padded(capture, activation, prompt_lens, reducer_fn=None):
+    """
+    Run captures over the forward calls of a right padded generation: all
+    rows up to the shortest prompt, then one token at a time
+    """
+    bounds = [0, min(prompt_lens)] + list(range(min(prompt_lens) + 1, activation.shape[1] + 1))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if capture.is_detachable():
+            break
+        if capture.should_capture(end - start):
+            chunk = activation[:, start:end]
+            capture.capture(chunk if reducer_fn is None else reducer_fn(chunk))
+        capture.advance(end - start)
+    return capture.result()
+
+
+@pytest.fixture
+def positions_activation():
+    # The activation of every token is its position, over 2 channels
+    return torch.arange(6.0).view(1, 6, 1).expand(3, 6, 2).contiguous()
+
+
+def test_prefill_covers_prompts_of_different_lengths(positions_activation):
+    prompt_lens = [2, 4, 3]
+    capture = ActivationCapture("layers.0", policy="prefill", prompt_lens=prompt_lens)
+    captured = generate_right_padded(capture, positions_activation, prompt_lens)
+
+    assert captured.shape == (3, 4, 2)
+    for row, prompt_len in enumerate(prompt_lens):
+        assert captured[row, :prompt_len, 0].tolist() == list(range(prompt_len))
+        # Generated tokens of the shorter prompts are zeroed
+        assert (captured[row, prompt_len:] == 0).all()
+    # The hook is detached once the longest prompt is captured
+    assert capture.cursor == 4
+
+
+def test_prefill_mean_of_prompts_of_different_lengths(positions_activation):
+    prompt_lens = [2, 4, 3]
+    reducer_fn, reduce_sequence = get_reducer({"name": "mean"})
+    capture = ActivationCapture(
+        "layers.0", policy="prefill", prompt_lens=prompt_lens, reduce_sequence=reduce_sequence
+    )
+    captured = generate_right_padded(capture, positions_activation, prompt_lens, reducer_fn)
+
+    assert captured.shape == (3, 1, 2)
+    assert captured[:, 0, 0].tolist() == [0.5, 1.5, 1.0]
+
+
+def test_prefill_of_prompts_of_the_same_length(positions_activation):
+    capture = ActivationCapture("layers.0", policy="prefill")
+    captured = generate_right_padded(capture, positions_activation, [3, 3, 3])
+    assert torch.equal(captured, positions_activation[:, :3])
+
+
+def test_all_is_captured_into_one_buffer(positions_activation):
+    capture = ActivationCapture("layers.0", policy="all", total_len=6)
+    captured = generate_right_padded(capture, positions_activation, [2, 2, 2])
+    assert torch.equal(captured, positions_activation)
+    # Every forward call lands in the same preallocated host buffer
+    assert captured.data_ptr() == capture.buffer.data_ptr()
+    assert not capture.is_detachable()
+
+
+def test_all_of_an_early_stopped_generation_is_trimmed(positions_activation):
+    capture = ActivationCapture("layers.0", policy="all", total_len=6)
+    captured = generate_right_padded(capture, positions_activation[:, :4], [2, 2, 2])
+    assert captured.shape == (3, 4, 2)
+
+
+def test_positions_are_captured_from_their_forward_calls(positions_activation):
+    capture = ActivationCapture("layers.0", policy="positions", positions=(4, 1, 3))
+    captured = generate_right_padded(capture, positions_activation, [2, 2, 2])
+    assert captured[0, :, 0].tolist() == [1, 3, 4]
+    # Detached once the last position went by
+    assert capture.cursor == 5
+
+
+def test_modules_which_are_only_edited_never_capture():
+    capture = ActivationCapture("layers.0", policy="none", is_editing=True)
+    assert not capture.should_capture(4)
+    assert capture.is_satisfied() and not capture.is_detachable()
+    assert capture.result() is None
+
+
+def test_all_requires_the_total_length():
+    with pytest.raises(AssertionError, match="total generation length"):
+        ActivationCapture("layers.0", policy="all")
+
+
+def test_reducers_keep_the_batch_and_sequence_dimensions():
+    activation = torch.randn(2, 3, 8, generator=torch.Generator().manual_seed(0))
+
+    l2_norm, reduce_sequence = get_reducer({"name": "l2_norm"})
+    assert not reduce_sequence
+    assert torch.allclose(l2_norm(activation), activation.norm(dim=-1))
+
+    topk, _ = get_reducer({"name": "topk", "k": 2})
+    indices = topk(activation)
+    assert indices.shape == (2, 3, 2)
+    assert torch.equal(indices, activation.topk(2, dim=-1).indices)
+
+    probes = [[1.0] + [0.0] * 7, [0.0] * 7 + [2.0]]
+    projection, _ = get_reducer({"name": "projection", "probes": probes})
+    projected = projection(activation)
+    assert projected.shape == (2, 3, 2)
+    assert torch.allclose(projected[..., 0], activation[..., 0])
+    assert torch.allclose(projected[..., 1], 2 * activation[..., 7])
+
+    # A single probe vector is one probe
+    projection, _ = get_reducer({"name": "projection", "probes": probes[0]})
+    assert projection(activation).shape == (2, 3, 1)
+
+
+def test_mean_reducer_averages_over_every_captured_call(positions_activation):
+    reducer_fn, reduce_sequence = get_reducer({"name": "mean"})
+    assert reduce_sequence
+    capture = ActivationCapture("layers.0", policy="all", reduce_sequence=True)
+    captured = generate_right_padded(capture, positions_activation, [2, 2, 2], reducer_fn)
+    assert captured.shape == (3, 1, 2)
+    assert (captured == 2.5).all()
+
+
+def test_unknown_reducer():
+    with pytest.raises(Exception, match="Reducer: median is not implemented"):
+        get_reducer({"name": "median"})
+
+
+@pytest.fixture
+def hidden():
+    # Rows are 1 and 2, over 4 tokens and 6 channels
+    return torch.arange(1.0, 3.0).view(2, 1, 1).expand(2, 4, 6).contiguous()
+
+
+def shard_edits(edit_spec, activation, num_shards, cursor=0):
+    """Apply an edit to every shard of the last dimension on its own, as every rank does"""
+    shard_size = activation.shape[-1] // num_shards
+    edit = get_shard_edit(edit_spec)
+    return torch.cat(
+        [
+            edit(shard, rank * shard_size, cursor)
+            for rank, shard in enumerate(activation.split(shard_size, dim=-1))
+        ],
+        dim=-1,
+    )
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 3])
+def test_shard_edits_match_the_edit_of_the_full_activation(hidden, num_shards):
+    vector = list(range(6))
+    edits = [
+        ({"name": "add", "vector": vector, "alpha": 2.0}, hidden + 2 * torch.arange(6.0)),
+        ({"name": "subtract", "vector": vector}, hidden - torch.arange(6.0)),
+        ({"name": "scale", "factor": 0.5}, hidden * 0.5),
+        ({"name": "clamp", "max": 1.5}, hidden.clamp(max=1.5)),
+    ]
+    for edit_spec, expected in edits:
+        assert torch.equal(shard_edits(edit_spec, hidden, num_shards), expected)
+
+    # Indices are into the full last dimension, whichever shard holds them
+    zeroed = shard_edits({"name": "zero", "indices": [1, 4]}, hidden, num_shards)
+    assert (zeroed[..., [1, 4]] == 0).all()
+    assert torch.equal(zeroed[..., [0, 2, 3, 5]], hidden[..., [0, 2, 3, 5]])
+
+
+def test_edits_only_touch_their_positions(hidden):
+    edit_spec = {"name": "scale", "factor": 0.0, "positions": [1, 5]}
+    # The forward call at cursor 4 covers positions 4 to 7
+    edited = shard_edits(edit_spec, hidden, 2, cursor=4)
+    assert (edited[:, 1] == 0).all()
+    assert torch.equal(edited[:, [0, 2, 3]], hidden[:, [0, 2, 3]])
+    # Calls without any of the positions are left as they are
+    assert torch.equal(shard_edits(edit_spec, hidden, 2, cursor=8), hidden)
+
+
+def test_patches_are_indexed_by_absolute_position(hidden):
+    stored = torch.arange(5.0).view(1, 5, 1).expand(2, 5, 6)
+    edited = shard_edits({"name": "patch", "tensor": stored}, hidden[:, :2], 3, cursor=3)
+    assert edited[0, :, 0].tolist() == [3.0, 4.0]
+    # Positions past the stored sequence are left as they are
+    edited = shard_edits({"name": "patch", "tensor": stored}, hidden[:, :2], 3, cursor=4)
+    assert edited[0, :, 0].tolist() == [4.0, 1.0]
+
+
+def test_row_edits_and_lists_of_edits(hidden):
+    edit_spec = [
+        {"name": "scale", "factor": 10.0, "rows": [1]},
+        {"name": "add", "vector": [1.0] * 6},
+    ]
+    edited = shard_edits(edit_spec, hidden, 2)
+    assert (edited[0] == 2).all()
+    assert (edited[1] == 21).all()
+    # The activation itself is never edited in place
+    assert (hidden[1] == 2).all()
+
+
+def test_unknown_edit():
+    with pytest.raises(Exception, match="Edit: shift is not implemented"):
+        get_shard_edit({"name": "shift"})
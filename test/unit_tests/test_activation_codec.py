@@ -0,0 +1,196 @@
+"""
+Unit tests for encoding activations on the model services and decoding them
+on the gateway
+"""
+import codecs
+import importlib.util
+import json
+import os
+import pickle
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from models.activation_codec import (
+    ENVELOPE_PREFIX,
+    HANDLE_PREFIX,
+    PACK_PREFIX,
+    PinnedStagingBuffer,
+    encode_activation,
+    encode_activation_pack,
+    spill_activation,
+)
+
+# The gateway has its own top level `models` package, so its codec is loaded
+# from its file
+spec = importlib.util.spec_from_file_location(
+    "gateway_activation_codec",
+    os.path.join(os.path.dirname(__file__), "../../web/utils/activation_codec.py"),
+)
+gateway_codec = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(gateway_codec)
+
+
+def unpickle(encoded):
+    return pickle.loads(codecs.decode(encoded.encode("utf-8"), "base64"))
+
+
+@pytest.fixture
+def activation():
+    return torch.randn(2, 5, 8, generator=torch.Generator().manual_seed(0))
+
+
+def test_default_encoding_is_a_pickled_tensor(activation):
+    encoded = encode_activation(activation)
+    assert not encoded.startswith(ENVELOPE_PREFIX)
+    assert torch.equal(unpickle(encoded), activation)
+    # The gateway passes it through untouched
+    assert gateway_codec.decode_activation(encoded) == encoded
+
+
+@pytest.mark.parametrize(
+    "activation_dtype, atol",
+    [
+        ("float32", 0),
+        ("float16", 1e-2),
+        ("bfloat16", 5e-2),
+    ],
+)
+def test_float_dtypes_round_trip(activation, activation_dtype, atol):
+    encoded = encode_activation(activation, activation_dtype=activation_dtype)
+    assert encoded.startswith(f"{ENVELOPE_PREFIX}:none:")
+    decoded = unpickle(gateway_codec.decode_activation(encoded))
+    assert decoded.shape == (2, 5, 8)
+    assert np.allclose(decoded.astype(np.float32), activation.numpy(), atol=atol, rtol=atol)
+
+
+def test_int8_is_within_half_a_step_per_channel(activation):
+    encoded = encode_activation(activation, activation_dtype="int8")
+    decoded = unpickle(gateway_codec.decode_activation(encoded))
+
+    # Every channel, ie. element of the last dimension, has its own scale
+    step = activation.abs().amax(dim=(0, 1)).numpy() / 127
+    assert decoded.dtype == np.float32
+    assert (np.abs(decoded - activation.numpy()) <= step / 2 + 1e-6).all()
+
+
+def test_integer_activations_keep_their_dtype():
+    indices = torch.tensor([[3, 1, 4]])
+    encoded = encode_activation(indices, activation_dtype="int8")
+    decoded = unpickle(gateway_codec.decode_activation(encoded))
+    assert decoded.dtype == np.int64
+    assert decoded.tolist() == [[3, 1, 4]]
+
+
+def test_zstd_compression(activation):
+    pytest.importorskip("zstandard")
+    zeros = torch.zeros(64, 64)
+    compressed = encode_activation(zeros, "float32", "zstd")
+    assert compressed.startswith(f"{ENVELOPE_PREFIX}:zstd:")
+    assert len(compressed) < len(encode_activation(zeros, "float32"))
+    assert np.array_equal(unpickle(gateway_codec.decode_activation(compressed)), zeros.numpy())
+
+    encoded = encode_activation(activation, "float16", "zstd")
+    decoded = unpickle(gateway_codec.decode_activation(encoded))
+    assert np.allclose(decoded, activation.numpy(), atol=1e-2)
+
+
+def test_invalid_dtype_and_compression(activation):
+    with pytest.raises(ValueError, match="dtype"):
+        encode_activation(activation, activation_dtype="float64")
+    with pytest.raises(ValueError, match="compression"):
+        encode_activation(activation, activation_compression="gzip")
+
+
+@pytest.mark.parametrize("activation_compression", [None, "zstd"])
+def test_pack_expands_into_every_module(activation, activation_compression):
+    if activation_compression:
+        pytest.importorskip("zstandard")
+    activations = {
+        "layers.0": activation,
+        "layers.1.attention": activation[:, :, :3] * 10,
+        "top_k": torch.tensor([[7, 2]]),
+    }
+    encoded = encode_activation_pack(activations, "int8", activation_compression)
+    assert encoded.startswith(f"{PACK_PREFIX}:{activation_compression or 'none'}:")
+
+    decoded = gateway_codec.decode_activations({PACK_PREFIX: encoded})
+    assert list(decoded) == list(activations)
+    for name in ("layers.0", "layers.1.attention"):
+        original = activations[name].numpy()
+        step = np.abs(original).max(axis=(0, 1)) / 127
+        assert (np.abs(unpickle(decoded[name]) - original) <= step / 2 + 1e-6).all()
+    assert unpickle(decoded["top_k"]).tolist() == [[7, 2]]
+
+
+def test_decode_activations_mixes_formats(activation):
+    plain = encode_activation(activation)
+    decoded = gateway_codec.decode_activations(
+        {
+            "plain": plain,
+            "envelope": encode_activation(activation, "float32"),
+        }
+    )
+    assert decoded["plain"] == plain
+    assert np.array_equal(unpickle(decoded["envelope"]), activation.numpy())
+
+
+def test_spilled_activations_are_handles_to_npy_files(activation, tmp_path):
+    encoded = spill_activation(activation, "int8", spill_dir=str(tmp_path))
+    assert encoded.startswith(f"{HANDLE_PREFIX}:")
+
+    handle = gateway_codec.decode_activation(encoded)
+    assert handle == json.loads(encoded[len(HANDLE_PREFIX) + 1 :])
+    assert handle["dtype"] == "int8"
+
+    data = np.load(tmp_path / handle["path"])
+    assert data.dtype == np.int8 and list(data.shape) == handle["shape"]
+    # The handle points at the raw data inside the file
+    with open(tmp_path / handle["path"], "rb") as f:
+        f.seek(handle["offset"])
+        assert f.read(handle["nbytes"]) == data.tobytes()
+    scales = np.load(tmp_path / handle["scales"]["path"])
+    assert np.allclose(data * scales, activation.numpy(), atol=scales.max())
+
+
+def test_staging_copies_every_module_into_one_buffer_per_dtype():
+    staging = PinnedStagingBuffer()
+    activations = {
+        "layers.0": torch.randn(2, 4, 8),
+        "layers.1": torch.randn(2, 4, 3),
+        "attention": torch.randn(2, 2, 4, 4).to(torch.bfloat16),
+    }
+    staged = staging.stage(activations)
+
+    for name, activation in activations.items():
+        assert torch.equal(staged[name], activation)
+    # Modules of a dtype are views into the same buffer, back to back
+    float_buffer = staging.buffers[torch.float32]
+    assert staged["layers.0"].data_ptr() == float_buffer.data_ptr()
+    assert staged["layers.1"].data_ptr() == float_buffer[2 * 4 * 8 :].data_ptr()
+    assert staging.buffers[torch.bfloat16].numel() == 2 * 2 * 4 * 4
+
+    # Smaller batches reuse the buffers
+    staged = staging.stage({"layers.0": torch.ones(1, 4, 8)})
+    assert staging.buffers[torch.float32] is float_buffer
+    assert torch.equal(staged["layers.0"], torch.ones(1, 4, 8))
+
+
+def test_staged_item_slices_pack_in_their_own_dtype():
+    staged = PinnedStagingBuffer().stage(
+        {
+            "layers.0": torch.randn(3, 5, 8),
+            "attention": torch.rand(3, 2, 5, 5).to(torch.bfloat16),
+        }
+    )
+    # Every item of the batch is packed from views into the staging buffer
+    for i in range(3):
+        views = {
+            "layers.0": staged["layers.0"][i, 1:4],
+            "attention": staged["attention"][i, :, 1:4, 1:4],
+        }
+        decoded = gateway_codec.decode_activations({PACK_PREFIX: encode_activation_pack(views)})
+        assert np.array_equal(unpickle(decoded["layers.0"]), views["layers.0"].numpy())
+        assert np.array_equal(unpickle(decoded["attention"]), views["attention"].float().numpy())
@@ -0,0 +1,88 @@
+"""Unit tests for serving activations spilled to the shared scratch directory"""
+import json
+import os
+import sys
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from models.activation_codec import HANDLE_PREFIX, spill_activation
+
+WEB_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../web"))
+
+# The gateway config reads its settings from the environment when imported
+with open(os.path.join(WEB_DIR, ".env-example")) as env_file:
+    for line in env_file:
+        name, sep, value = line.partition("=")
+        if sep:
+            os.environ.setdefault(name.strip(), value.strip().strip("'\""))
+os.environ.setdefault("TRITON_INFERENCE_TIMEOUT", "60")
+sys.path.insert(0, WEB_DIR)
+
+from config import Config
+from utils.activation_files import (
+    cleanup_activation_files,
+    get_activation_file_path,
+    read_activation_file,
+)
+
+
+@pytest.fixture
+def spill_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "ACTIVATION_SPILL_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.parametrize(
+    "file_name",
+    [
+        "../secrets.npy",
+        "nested/activation.npy",
+        "/etc/passwd",
+        "activation.txt",
+    ],
+)
+def test_only_bare_npy_file_names_are_served(spill_dir, file_name):
+    with pytest.raises(FileNotFoundError, match="Invalid activation file name"):
+        get_activation_file_path(file_name)
+
+
+def test_files_are_resolved_in_the_spill_dir(spill_dir):
+    assert get_activation_file_path("a.npy") == os.path.join(str(spill_dir), "a.npy")
+
+
+def test_nothing_is_served_without_a_spill_dir(monkeypatch):
+    monkeypatch.setattr(Config, "ACTIVATION_SPILL_DIR", "")
+    with pytest.raises(FileNotFoundError, match="not configured"):
+        get_activation_file_path("a.npy")
+
+
+def test_handles_point_at_the_served_byte_range(spill_dir):
+    activation = torch.randn(2, 3, 4)
+    encoded = spill_activation(activation, spill_dir=str(spill_dir))
+    handle = json.loads(encoded[len(HANDLE_PREFIX) + 1 :])
+
+    data = read_activation_file(handle["path"], offset=handle["offset"], length=handle["nbytes"])
+    served = np.frombuffer(data, dtype=handle["dtype"]).reshape(handle["shape"])
+    assert np.array_equal(served, activation.numpy())
+
+    # Ranges past the end of the file are cut short
+    tail = read_activation_file(
+        handle["path"], offset=handle["offset"] + handle["nbytes"] - 4, length=100
+    )
+    assert tail == data[-4:]
+
+
+def test_cleanup_removes_expired_files_only(spill_dir):
+    expired, fresh = spill_dir / "expired.npy", spill_dir / "fresh.npy"
+    expired.write_bytes(b"0")
+    fresh.write_bytes(b"0")
+    past_ttl = time.time() - Config.ACTIVATION_SPILL_TTL.total_seconds() - 60
+    os.utime(expired, (past_ttl, past_ttl))
+
+    cleanup_activation_files()
+    assert not expired.exists()
+    assert fresh.exists()
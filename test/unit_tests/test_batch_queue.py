@@ -0,0 +1,117 @@
+"""Unit tests for the queue of work items waiting to be batched"""
+from dataclasses import dataclass
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from models.batch_queue import BatchQueue
+
+
+@dataclass
+class Item:
+    name: str
+    cost: int
+    key: str = "greedy"
+
+    def queue_key(self):
+        return self.key
+
+
+def always_fits(batch, item):
+    return True
+
+
+def names(batch):
+    return [item.name for item in batch]
+
+
+def test_the_key_with_most_items_is_batched_cheapest_first():
+    queue = BatchQueue(max_queue_age=60)
+    queue.put(Item("lone", 1, key="sampled"))
+    queue.put(Item("long", 30))
+    queue.put(Item("short", 10))
+    queue.put(Item("medium", 20))
+
+    assert names(queue.get_batch(always_fits, timeout=0)) == ["short", "medium", "long"]
+    assert names(queue.get_batch(always_fits, timeout=0)) == ["lone"]
+    assert len(queue) == 0
+
+
+def test_batches_stop_once_an_item_does_not_fit():
+    queue = BatchQueue(max_queue_age=60)
+    for idx in range(5):
+        queue.put(Item(f"item{idx}", idx))
+
+    def fits(batch, item):
+        return len(batch) < 2
+
+    assert names(queue.get_batch(fits, timeout=0)) == ["item0", "item1"]
+    assert names(queue.get_batch(fits, timeout=0)) == ["item2", "item3"]
+    assert names(queue.get_batch(fits, timeout=0)) == ["item4"]
+
+
+def test_aged_items_are_batched_first():
+    queue = BatchQueue(max_queue_age=0.05)
+    queue.put(Item("old", 100, key="sampled"))
+    time.sleep(0.1)
+    for idx in range(3):
+        queue.put(Item(f"new{idx}", idx))
+
+    # The oldest item's key wins over the key with the most items
+    batch = queue.get_batch(always_fits, timeout=0)
+    assert names(batch) == ["old"]
+    assert queue.metrics.snapshot()["aged_batches"] == 1
+
+
+def test_batches_wait_for_more_items_of_their_key():
+    queue = BatchQueue(max_queue_age=60)
+    queue.put(Item("first", 1))
+
+    def put_later():
+        time.sleep(0.05)
+        queue.put(Item("other", 1, key="sampled"))
+        queue.put(Item("second", 2))
+
+    thread = threading.Thread(target=put_later)
+    thread.start()
+    batch = queue.get_batch(always_fits, timeout=1.0)
+    thread.join()
+
+    assert names(batch) == ["first", "second"]
+    assert len(queue) == 1
+
+
+def test_waiting_stops_at_the_max_queue_age():
+    queue = BatchQueue(max_queue_age=0.1)
+    queue.put(Item("only", 1))
+
+    start = time.monotonic()
+    assert names(queue.get_batch(always_fits, timeout=10)) == ["only"]
+    assert time.monotonic() - start < 1
+
+
+def test_metrics():
+    queue = BatchQueue(max_queue_age=60)
+    queue.put(Item("a", 1))
+    queue.put(Item("b", 1, key="sampled"))
+    queue.get_batch(always_fits, timeout=0)
+    queue.metrics.record_fill(0.5)
+
+    snapshot = queue.metrics.snapshot()
+    assert snapshot["batches"] == 1
+    assert snapshot["queue_depth"] == 1
+    assert snapshot["batch_size_mean"] == 1
+    assert snapshot["batch_fill_mean"] == 0.5
+    assert snapshot["aged_batches"] == 0
+
+
+def test_metrics_are_logged_once_per_interval():
+    metrics = BatchQueue().metrics
+    assert not metrics.log_due(interval=60)
+    assert metrics.log_due(interval=0)
+    metrics.last_logged -= 61
+    assert metrics.log_due(interval=60)
+    assert not metrics.log_due(interval=60)
@@ -0,0 +1,114 @@
+"""Unit tests for the latency model used to size OPT batches"""
+from dataclasses import dataclass
+import itertools
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from models.opt.cost_model import BatchCostModel, batch_features, fit_nonnegative
+
+# Overhead, prefill, decode step, per row decode step, attention
+COEFFICIENTS = np.array([0.05, 1e-4, 2e-3, 1e-3, 1e-6])
+GRID = list(itertools.product((1, 4, 16), (32, 256), (1, 16, 64)))
+
+
+def latency(batch_size, prompt_len, gen_len):
+    return float(batch_features(batch_size, prompt_len, gen_len) @ COEFFICIENTS)
+
+
+@dataclass
+class Item:
+    prompt_len: int
+    gen_len: int
+
+
+def test_fit_recovers_the_coefficients():
+    features = np.stack([batch_features(*shape) for shape in GRID])
+    latencies = np.array([latency(*shape) for shape in GRID])
+    assert np.allclose(fit_nonnegative(features, latencies), COEFFICIENTS, rtol=1e-6)
+
+
+def test_fit_keeps_coefficients_nonnegative():
+    # Latencies falling with the second feature would need a negative weight
+    features = np.array([[1.0, 0.0], [1.0, 1.0], [1.0, 2.0], [1.0, 3.0]])
+    latencies = np.array([4.0, 3.0, 2.0, 1.0])
+    coefficients = fit_nonnegative(features, latencies)
+    assert (coefficients >= 0).all()
+    assert coefficients[1] == 0
+    assert coefficients[0] == pytest.approx(latencies.mean())
+
+
+def test_calibrate_fits_the_profiling_grid_within_the_limits():
+    shapes = []
+
+    def run_batch(*shape):
+        shapes.append(shape)
+        return latency(*shape)
+
+    model = BatchCostModel()
+    model.calibrate(run_batch, max_seq_len=2048, max_batch_tokens=2**20)
+    assert model.predict(8, 100, 20) == pytest.approx(latency(8, 100, 20))
+
+    # The first shape is run once more as a warm up
+    assert len(shapes) == 13
+    assert shapes[0] == shapes[1]
+
+    shapes.clear()
+    BatchCostModel().calibrate(run_batch, max_seq_len=512, max_batch_tokens=4096)
+    assert all(b * (p + g) <= 4096 and p + g <= 512 for b, p, g in shapes)
+
+
+def test_observe_refits_every_few_batches():
+    model = BatchCostModel(refit_every=len(GRID))
+    for shape in GRID[:-1]:
+        model.observe(*shape, latency(*shape))
+    assert not model.is_fitted
+
+    model.observe(*GRID[-1], latency(*GRID[-1]))
+    assert model.is_fitted
+    assert np.allclose(model.coefficients, COEFFICIENTS, rtol=1e-6)
+
+
+def test_fits_bounds_latency_and_throughput():
+    model = BatchCostModel()
+    # Unfitted models batch everything
+    assert model.fits([Item(10, 10)] * 100, Item(10, 10))
+
+    model.coefficients = COEFFICIENTS
+    model.latency_target = latency(4, 256, 64)
+    assert model.fits([], Item(256, 64))
+    assert model.fits([Item(256, 64)] * 3, Item(256, 64))
+    assert not model.fits([Item(256, 64)] * 4, Item(256, 64))
+
+    # A long generation added to short ones costs more than the tokens it adds
+    model.latency_target = float("inf")
+    assert not model.fits([Item(32, 1)] * 4, Item(32, 2048))
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "cost_models" / "opt-6.7b.json")
+    model = BatchCostModel(path=path, refit_every=len(GRID))
+    for shape in GRID:
+        model.observe(*shape, latency(*shape))
+
+    with open(path) as file:
+        saved = json.load(file)
+    assert len(saved["samples"]) == len(GRID)
+
+    loaded = BatchCostModel(path=path)
+    assert loaded.load()
+    assert np.allclose(loaded.coefficients, model.coefficients)
+    assert list(loaded.samples) == list(model.samples)
+
+
+def test_load_without_a_usable_file(tmp_path):
+    assert not BatchCostModel().load()
+    assert not BatchCostModel(path=str(tmp_path / "missing.json")).load()
+
+    corrupt = tmp_path / "corrupt.json"
+    corrupt.write_text('{"samples": []}')
+    model = BatchCostModel(path=str(corrupt))
+    assert not model.load()
+    assert not model.is_fitted
@@ -0,0 +1,54 @@
+"""Unit tests for detokenizing the Llama generations of whole batches at once"""
+import io
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("numpy")
+spm = pytest.importorskip("sentencepiece")
+
+from models.llama2.detokenizer import Detokenizer
+
+CORPUS = ["hello world", "the quick brown fox jumps over the lazy dog"]
+
+
+@pytest.fixture(scope="module")
+def sp_model():
+    # A small model which, like Llama's, falls back to bytes for unseen text
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(CORPUS * 50),
+        model_writer=model,
+        vocab_size=300,
+        model_type="bpe",
+        byte_fallback=True,
+        minloglevel=2,
+    )
+    return spm.SentencePieceProcessor(model_proto=model.getvalue())
+
+
+@pytest.fixture(scope="module")
+def detokenizer(sp_model):
+    return Detokenizer(SimpleNamespace(sp_model=sp_model))
+
+
+def test_byte_fallback_tokens_join_into_utf8(sp_model, detokenizer):
+    texts = ["héllo ☃ world", "the lazy dog", "naïve\nfox"]
+    sequences = [sp_model.encode(text) for text in texts]
+    # Characters outside the vocabulary are split into several byte tokens
+    assert len(sequences[0]) > len(sp_model.encode("hello x world"))
+    assert detokenizer.decode(sequences) == [sp_model.decode(seq) for seq in sequences]
+    assert detokenizer.decode(sequences)[0] == "héllo ☃ world"
+
+
+def test_every_token_is_decoded_on_its_own(sp_model, detokenizer):
+    sequences = [sp_model.encode("the quick ☃"), sp_model.encode("fox")]
+    assert detokenizer.decode_tokens(sequences) == [
+        [sp_model.decode([token]) for token in seq] for seq in sequences
+    ]
+
+
+def test_control_tokens_are_dropped(sp_model, detokenizer):
+    sequence = [sp_model.bos_id()] + sp_model.encode("hello world") + [sp_model.eos_id()]
+    assert detokenizer.decode([sequence]) == ["hello world"]
+    assert detokenizer.decode([[]]) == [""]
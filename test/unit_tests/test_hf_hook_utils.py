@@ -0,0 +1,108 @@
+"""Unit tests for activation retrieval and editing on HuggingFace models"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("cloudpickle")
+
+from models.activation_capture import ActivationPayload
+from models.hf_hook_utils import (
+    apply_forward_hook,
+    get_activation_capture_hook_dict,
+    index_modules,
+)
+
+
+class Block(torch.nn.Module):
+    """A layer whose outputs alias its activation, like a cached hidden state"""
+
+    def __init__(self, hidden=4):
+        super().__init__()
+        self.linear = torch.nn.Linear(hidden, hidden)
+
+    def forward(self, x):
+        h = self.linear(x)
+        return h, h
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.block = Block()
+
+    def forward(self, x):
+        h, aliased = self.block(x)
+        return h, aliased
+
+
+def run(model, payload, x, attention_mask=None):
+    hook_dict, activation_dict = get_activation_capture_hook_dict(
+        model, payload, total_len=x.shape[1], attention_mask=attention_mask
+    )
+    with torch.no_grad(), apply_forward_hook(model, hook_dict, activation_dict):
+        outputs = model(x)
+    return outputs, {n: capture.result() for n, capture in activation_dict.items()}
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return Model()
+
+
+def test_edits_are_returned_rather_than_written_in_place(model):
+    x = torch.randn(2, 3, 4)
+    with torch.no_grad():
+        h, _ = model(x)
+
+    payload = ActivationPayload(
+        module_names_activation_retrieval=("block",),
+        module_editing_fn_pairs={"block": {"name": "scale", "factor": 0.0}},
+    )
+    (edited, aliased), captured = run(model, payload, x)
+    assert torch.equal(edited, torch.zeros_like(h))
+    # The layer output itself, which the second output aliases, is untouched
+    assert torch.allclose(aliased, h)
+    assert torch.equal(captured["block"], torch.zeros_like(h))
+
+
+def test_retrieval_leaves_the_outputs_as_they_are(model):
+    x = torch.randn(2, 3, 4)
+    with torch.no_grad():
+        h, _ = model(x)
+    payload = ActivationPayload(module_names_activation_retrieval=("block",))
+    (output, _), captured = run(model, payload, x)
+    assert torch.equal(output, h)
+    assert torch.equal(captured["block"], h)
+
+
+def test_mean_reducer_leaves_out_left_padding(model):
+    x = torch.randn(2, 3, 4)
+    # The first row is left padded by two tokens
+    attention_mask = torch.tensor([[0, 0, 1], [1, 1, 1]])
+    payload = ActivationPayload(
+        module_names_activation_retrieval=("block",),
+        module_reducer_specs={"block": {"name": "mean"}},
+    )
+    (h, _), captured = run(model, payload, x, attention_mask=attention_mask)
+
+    assert captured["block"].shape == (2, 1, 4)
+    assert torch.allclose(captured["block"][0, 0], h[0, 2], atol=1e-6)
+    assert torch.allclose(captured["block"][1, 0], h[1].mean(dim=0), atol=1e-6)
+
+
+def test_module_index_is_built_once_per_model(model, monkeypatch):
+    module_index = index_modules(model)
+    assert module_index["block.linear"] is model.block.linear
+
+    def named_modules(*args, **kwargs):
+        raise AssertionError("the module tree is walked per request")
+
+    monkeypatch.setattr(model, "named_modules", named_modules)
+    payload = ActivationPayload(module_names_activation_retrieval=("block.linear",))
+    _, captured = run(model, payload, torch.randn(1, 2, 4))
+    assert captured["block.linear"].shape == (1, 2, 4)
+
+    with pytest.raises(ValueError, match="not found"):
+        get_activation_capture_hook_dict(
+            model, ActivationPayload(module_names_activation_retrieval=("missing",)), total_len=2
+        )
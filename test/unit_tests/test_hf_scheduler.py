@@ -0,0 +1,111 @@
+"""Unit tests for the length bucket scheduler of the HuggingFace models"""
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from models.hf_scheduler import LengthBucketScheduler, length_bucket
+from models.sampling import split_rows
+
+
+def fake_generate(inputs):
+    """
+    Builds its outputs like the falcon and gpt2 models do: every row stops at
+    its own max_tokens, so token and logprob rows are ragged
+    """
+    max_tokens = inputs["max_tokens"].reshape(-1)
+    prompts = [p.decode("utf-8") for p in inputs["prompts"].reshape(-1)]
+    tokens = [f"{prompt}{idx}" for prompt, n in zip(prompts, max_tokens) for idx in range(n)]
+    logprobs = [-0.5 * idx for n in max_tokens for idx in range(n)]
+    return {
+        "sequences": np.array(prompts, dtype=object),
+        "tokens": split_rows(tokens, max_tokens),
+        "logprobs": split_rows(logprobs, max_tokens),
+        "batch_size": np.full(len(prompts), len(prompts)),
+    }
+
+
+def make_scheduler(**kwargs):
+    kwargs.setdefault("timeout", 0.2)
+    return LengthBucketScheduler(
+        run_batch=fake_generate,
+        batch_memory=lambda batch_size, prompt_len, gen_len: 0,
+        devices=[torch.device("cpu")],
+        **kwargs,
+    )
+
+
+def submit_rows(scheduler, prompts, max_tokens):
+    inputs = {
+        "prompts": np.array([[p.encode("utf-8")] for p in prompts]),
+        "max_tokens": np.array([[n] for n in max_tokens], dtype=np.int64),
+    }
+    return scheduler.submit(inputs, [8] * len(prompts), max_tokens)
+
+
+def test_length_bucket():
+    assert length_bucket(1) == 16
+    assert length_bucket(16) == 16
+    assert length_bucket(17) == 32
+    assert length_bucket(300) == length_bucket(500) == 512
+
+
+def test_two_rows_with_different_max_tokens():
+    outputs = submit_rows(make_scheduler(), ["a", "b"], [3, 5])
+
+    # Both rows share a bucket, so they were generated in one batch
+    assert outputs["batch_size"].tolist() == [2, 2]
+    assert outputs["sequences"].tolist() == ["a", "b"]
+    assert outputs["tokens"].shape == (2,)
+    assert outputs["tokens"].tolist() == [["a0", "a1", "a2"], ["b0", "b1", "b2", "b3", "b4"]]
+    assert outputs["logprobs"].shape == (2,)
+    assert [len(row) for row in outputs["logprobs"]] == [3, 5]
+
+
+def test_rows_of_the_same_length_stay_one_per_row():
+    outputs = submit_rows(make_scheduler(), ["a", "b"], [4, 4])
+    assert outputs["logprobs"].shape == (2,)
+    assert outputs["logprobs"].tolist() == [[0.0, -0.5, -1.0, -1.5]] * 2
+
+
+def test_rows_of_different_buckets_run_in_separate_batches():
+    outputs = submit_rows(make_scheduler(), ["a", "b", "c"], [2, 2, 40])
+    assert outputs["batch_size"].tolist() == [2, 2, 1]
+    assert [len(row) for row in outputs["tokens"]] == [2, 2, 40]
+
+
+def test_batches_are_bounded_by_size_and_tokens():
+    scheduler = make_scheduler(max_batch_size=2)
+    assert submit_rows(scheduler, ["a", "b", "c"], [4, 4, 4])["batch_size"].tolist() == [2, 2, 1]
+
+    # Rows are 8 prompt tokens plus 4 generated ones
+    scheduler = make_scheduler(max_batch_tokens=24)
+    assert submit_rows(scheduler, ["a", "b", "c"], [4, 4, 4])["batch_size"].tolist() == [2, 2, 1]
+
+
+def test_concurrent_requests_get_their_own_rows():
+    scheduler = make_scheduler()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        first = pool.submit(submit_rows, scheduler, ["x"], [2])
+        second = pool.submit(submit_rows, scheduler, ["y", "z"], [3, 1])
+        assert first.result()["tokens"].tolist() == [["x0", "x1"]]
+        assert second.result()["tokens"].tolist() == [["y0", "y1", "y2"], ["z0"]]
+
+
+def test_memory_budget_is_read_once_work_is_queued():
+    scheduler = make_scheduler()
+    reads = []
+    scheduler.memory_budget = lambda: reads.append(len(scheduler.queue)) or 1
+    scheduler.batch_memory = lambda batch_size, prompt_len, gen_len: batch_size
+
+    # Nothing is read while the loop blocks on an empty queue
+    time.sleep(0.3)
+    assert reads == []
+
+    # A budget of one row's memory splits the rows into single-row batches
+    outputs = submit_rows(scheduler, ["a", "b"], [2, 2])
+    assert outputs["batch_size"].tolist() == [1, 1]
+    assert len(reads) == 1
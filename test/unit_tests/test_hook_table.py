@@ -0,0 +1,62 @@
+"""Unit tests for forward hooks which requests switch on and off"""
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.hook_table import ForwardHookTable
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 4)
+
+    def forward(self, x):
+        return self.linear(x)
+
+
+def make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(Block(), Block())
+
+
+def double(module, inputs, outputs):
+    return outputs * 2
+
+
+def test_hooks_are_registered_once_on_the_hooked_types():
+    model = make_model()
+    table = ForwardHookTable(model, (Block,))
+    assert list(table.handles) == ["0", "1"]
+    assert table.module_index["1.linear"] is model[1].linear
+    # The persistent hooks do nothing until a request switches them on
+    x = torch.randn(2, 4)
+    assert torch.equal(model(x), make_model()(x))
+
+
+def test_requests_switch_hooks_on_and_off():
+    model = make_model()
+    table = ForwardHookTable(model, (Block,))
+    x = torch.randn(2, 4)
+    expected = model(x)
+
+    handle = table.enable("1", double)
+    assert torch.allclose(model(x), expected * 2)
+    handle.remove()
+    assert torch.equal(model(x), expected)
+    # Removing a handle again is harmless
+    handle.remove()
+    assert not table.active_hooks
+
+
+def test_removing_the_table_removes_its_hooks():
+    model = make_model()
+    table = ForwardHookTable(model, (Block,))
+    x = torch.randn(2, 4)
+    expected = model(x)
+
+    table.enable("0", lambda module, inputs, outputs: torch.zeros_like(outputs))
+    table.remove()
+    assert not table.handles and not table.active_hooks
+    assert all(not block._forward_hooks for block in model)
+    assert torch.equal(model(x), expected)
@@ -0,0 +1,86 @@
+"""Unit tests for sizing the batches of a model parallel Llama from its checkpoint"""
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+
+from models.llama2.sizing_utils import (
+    checkpoint_files,
+    llama_batch_memory,
+    read_model_dims,
+    shard_weight_bytes,
+)
+from models.memory_profiler import size_batch_limits
+
+PARAMS = {"dim": 64, "n_layers": 2, "n_heads": 4, "multiple_of": 32, "norm_eps": 1e-5}
+VOCAB_SIZE = 100
+
+
+def write_checkpoint(ckpt_dir, suffix, sizes):
+    for i, size in enumerate(sizes):
+        (ckpt_dir / f"consolidated.{i:02d}{suffix}").write_bytes(b"\0" * size)
+
+
+@pytest.fixture
+def ckpt_dir(tmp_path):
+    (tmp_path / "params.json").write_text(json.dumps(PARAMS))
+    return tmp_path
+
+
+@pytest.mark.parametrize("suffix", [".pth", ".safetensors", ".bin"])
+def test_every_checkpoint_format_is_sized(ckpt_dir, suffix):
+    write_checkpoint(ckpt_dir, suffix, [1000, 1000])
+    assert [f.suffix for f in checkpoint_files(ckpt_dir)] == [suffix, suffix]
+    assert shard_weight_bytes(ckpt_dir, world_size=2, vocab_size=VOCAB_SIZE) == 1000
+
+
+def test_conversions_next_to_the_shards_are_not_counted(ckpt_dir):
+    write_checkpoint(ckpt_dir, ".pth", [1000, 1000])
+    write_checkpoint(ckpt_dir, ".safetensors", [1100, 1100])
+    assert shard_weight_bytes(ckpt_dir, world_size=2, vocab_size=VOCAB_SIZE) == 1000
+
+
+def test_weights_are_split_over_the_ranks(ckpt_dir):
+    # eg. a single file converted from the per-rank shards
+    write_checkpoint(ckpt_dir, ".safetensors", [4000])
+    assert shard_weight_bytes(ckpt_dir, world_size=4, vocab_size=VOCAB_SIZE) == 1000
+
+
+def test_int8_weights_keep_room_for_the_dequantized_head(ckpt_dir):
+    write_checkpoint(ckpt_dir, ".pth", [100000])
+    weight_bytes = shard_weight_bytes(ckpt_dir, 1, VOCAB_SIZE, quantization="int8")
+    assert weight_bytes == 100000 // 2 + VOCAB_SIZE * PARAMS["dim"] * 2
+
+
+def test_missing_checkpoint(ckpt_dir):
+    with pytest.raises(FileNotFoundError, match="No checkpoint files"):
+        shard_weight_bytes(ckpt_dir, world_size=1, vocab_size=VOCAB_SIZE)
+
+
+def test_dims_of_converted_checkpoints(tmp_path):
+    (tmp_path / "config.json").write_text(
+        json.dumps(
+            {
+                "hidden_size": 64,
+                "num_hidden_layers": 2,
+                "num_attention_heads": 4,
+                "num_key_value_heads": 2,
+            }
+        )
+    )
+    assert read_model_dims(tmp_path) == {"dim": 64, "n_layers": 2, "n_heads": 4, "n_kv_heads": 2}
+
+
+def test_batch_memory_sizes_the_batch_limits(ckpt_dir):
+    batch_memory = llama_batch_memory(ckpt_dir, world_size=1, vocab_size=VOCAB_SIZE)
+    head_dim = PARAMS["dim"] // PARAMS["n_heads"]
+    token_bytes = 2 * 2 * 4 * head_dim * 2 + 16 * 64 * 2 + VOCAB_SIZE * 8
+    assert batch_memory(1, 10) == 10 * token_bytes + 4 * 10 * 10 * 4
+    assert batch_memory(4, 10) == 4 * batch_memory(1, 10)
+
+    # Room for exactly 8 rows of 512 tokens
+    free_bytes = int(batch_memory(8, 512) / 0.85) + 1
+    limits = size_batch_limits(batch_memory, free_bytes, 512)
+    assert (limits.max_batch_size, limits.max_seq_len) == (8, 512)
+    assert limits.max_batch_tokens == 8 * 512
@@ -0,0 +1,102 @@
+"""Unit tests for the generation parameter schema of the model services"""
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+MODELS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../model_service/models"))
+from models.parameter_schema import ParameterSchema
+
+PARAMETERS = {
+    "temperature": {"type": "float", "default": {"generate": 0.6, "activations": 1}},
+    "max_tokens": {"type": "int", "default": {"generate": "32", "activations": 16}},
+    "min_tokens": {"type": "int", "default": {"generate": None, "activations": None}},
+    "echo": {"type": "bool", "default": {"generate": False, "activations": "true"}},
+    "stop": {"type": "str", "default": {"generate": None}},
+}
+
+
+def write_config(tmp_path, parameters):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"parameters": parameters}))
+    return str(config_path)
+
+
+@pytest.fixture
+def schema(tmp_path):
+    return ParameterSchema.from_config(write_config(tmp_path, PARAMETERS))
+
+
+def test_defaults_are_coerced_and_leave_out_unset_parameters(schema):
+    assert dict(schema.defaults("generate")) == {
+        "temperature": 0.6,
+        "max_tokens": 32,
+        "echo": False,
+    }
+    activations = schema.defaults("activations")
+    assert activations["echo"] is True
+    assert isinstance(activations["temperature"], float)
+    assert dict(schema.defaults("unknown")) == {}
+
+
+def test_defaults_are_frozen(schema):
+    with pytest.raises(TypeError):
+        schema.defaults("generate")["temperature"] = 1.0
+    with pytest.raises(TypeError):
+        schema.resolve("generate")["temperature"] = 1.0
+
+
+def test_resolve_coerces_input_tensors(schema):
+    inputs = {
+        "max_tokens": np.array([[b"8"]]),
+        "temperature": np.array([[0.25]]),
+        "echo": np.array([[b"1"]]),
+        "stop": np.array([[b"\n"]]),
+        "prompts": np.array([[b"ignored"]]),
+    }
+    params = schema.resolve("generate", inputs)
+    assert params == {"temperature": 0.25, "max_tokens": 8, "echo": True, "stop": "\n"}
+    assert isinstance(params["max_tokens"], int)
+
+
+def test_overrides_win_over_inputs_and_defaults(schema):
+    inputs = {"echo": np.array([[True]])}
+    params = schema.resolve("activations", inputs, echo=False, extra="as is")
+    assert params["echo"] is False
+    assert params["extra"] == "as is"
+    assert params["max_tokens"] == 16
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("max_tokens", b"1.5"),
+        ("max_tokens", "many"),
+        ("echo", b"maybe"),
+        ("stop", 3),
+    ],
+)
+def test_invalid_inputs_raise(schema, name, value):
+    with pytest.raises(ValueError, match=f"parameter {name}"):
+        schema.resolve("generate", {name: np.array([[value]], dtype=object)})
+
+
+def test_config_errors(tmp_path):
+    with pytest.raises(ValueError, match="unknown type"):
+        ParameterSchema.from_config(
+            write_config(tmp_path, {"n": {"type": "complex", "default": {"generate": 1}}})
+        )
+    with pytest.raises(ValueError, match="parameter n"):
+        ParameterSchema.from_config(
+            write_config(tmp_path, {"n": {"type": "int", "default": {"generate": "lots"}}})
+        )
+
+
+# The model services which parse their config.json into a schema
+@pytest.mark.parametrize("model_name", ["falcon", "llama2", "opt"])
+def test_model_configs_parse(model_name):
+    schema = ParameterSchema.from_config(os.path.join(MODELS_DIR, model_name, "config.json"))
+    assert "max_tokens" in schema.specs
+    assert schema.defaults("generate")
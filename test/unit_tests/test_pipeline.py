@@ -0,0 +1,97 @@
+"""Unit tests for the micro-batch pipeline, with a toy two stage model on CPU"""
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from models.pipeline import MicroBatchPipeline
+
+# Long enough per stage that micro-batches visibly overlap
+STAGE_SECONDS = 0.05
+
+
+class SlowLinear(torch.nn.Linear):
+    def forward(self, x):
+        time.sleep(STAGE_SECONDS)
+        return super().forward(x)
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.first = SlowLinear(4, 8)
+        self.second = SlowLinear(8, 3)
+
+    def forward(self, x):
+        return self.second(torch.relu(self.first(x)))
+
+
+# Both stages are on CPU, the pipeline only tells stages apart by device
+DEVICE_MAP = {"first": 0, "second": 1}
+
+
+def make_pipeline(num_micro_batches, trace=None):
+    torch.manual_seed(0)
+    model = ToyModel().eval()
+    pipeline = MicroBatchPipeline(model, DEVICE_MAP, num_micro_batches, trace)
+
+    def forward(inputs):
+        with torch.no_grad():
+            logits = model(torch.from_numpy(inputs["x"]))
+        # Ragged rows, like the tokens of rows with different max_tokens
+        lengths = inputs["length"].reshape(-1)
+        rows = np.empty(len(lengths), dtype=object)
+        for idx, length in enumerate(lengths):
+            rows[idx] = list(range(length))
+        return {"logits": logits.numpy(), "tokens": rows}
+
+    return model, pipeline, forward
+
+
+def test_outputs_match_an_unpipelined_forward_pass():
+    model, pipeline, forward = make_pipeline(num_micro_batches=3)
+    inputs = {
+        "x": np.random.default_rng(0).standard_normal((7, 4)).astype(np.float32),
+        "length": np.array([[2], [2], [1], [3], [3], [2], [2]]),
+    }
+    outputs = pipeline.run(forward, inputs)
+    pipeline.remove()
+
+    expected = forward(inputs)
+    assert np.allclose(outputs["logits"], expected["logits"])
+    assert outputs["tokens"].shape == (7,)
+    assert outputs["tokens"].tolist() == expected["tokens"].tolist()
+
+
+def test_stages_interleave_micro_batches():
+    trace = []
+    _, pipeline, forward = make_pipeline(num_micro_batches=2, trace=trace)
+    inputs = {
+        "x": np.ones((4, 4), dtype=np.float32),
+        "length": np.ones((4, 1), dtype=np.int64),
+    }
+    pipeline.run(forward, inputs)
+    pipeline.remove()
+
+    intervals = {}
+    for micro_batch, stage, event, timestamp in trace:
+        intervals.setdefault((micro_batch, stage), {})[event] = timestamp
+    assert sorted(intervals) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+    # Every micro-batch goes through the stages in order
+    for micro_batch in (0, 1):
+        assert intervals[(micro_batch, 0)]["leave"] <= intervals[(micro_batch, 1)]["enter"]
+
+    def overlap(a, b):
+        return a["enter"] < b["leave"] and b["enter"] < a["leave"]
+
+    # A stage serves one micro-batch at a time
+    for stage in (0, 1):
+        assert not overlap(intervals[(0, stage)], intervals[(1, stage)])
+
+    # While one micro-batch is in the second stage, the other is in the first
+    assert overlap(intervals[(0, 1)], intervals[(1, 0)]) or overlap(
+        intervals[(1, 1)], intervals[(0, 0)]
+    )
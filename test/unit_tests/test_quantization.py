@@ -0,0 +1,169 @@
+"""Unit tests for serving models with weight-only int8 quantized linear layers"""
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import models.quantization
+from models.quantization import (
+    DequantizedWeightCache,
+    DynamicInt8Linear,
+    Int8WeightMixin,
+    get_quantization,
+    quantize_model,
+    quantize_per_channel,
+)
+
+requires_int8_kernels = pytest.mark.skipif(
+    not [engine for engine in torch.backends.quantized.supported_engines if engine != "none"],
+    reason="no native int8 CPU kernels",
+)
+
+
+class Conv1D(torch.nn.Module):
+    """Like transformers' Conv1D, which stores its weight transposed"""
+
+    def __init__(self, nf, nx):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.randn(nx, nf))
+        self.bias = torch.nn.Parameter(torch.zeros(nf))
+
+    def forward(self, x):
+        return x @ self.weight + self.bias
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(10, 16)
+        self.up = torch.nn.Linear(16, 32)
+        self.conv = Conv1D(16, 32)
+        # Tied to the input embedding, like many output heads
+        self.head = torch.nn.Linear(16, 10, bias=False)
+        self.head.weight = self.embed.weight
+
+    def forward(self, x):
+        return self.head(self.conv(torch.relu(self.up(x))))
+
+
+def make_model():
+    torch.manual_seed(0)
+    return ToyModel().eval()
+
+
+@pytest.mark.parametrize("channel_dim", [0, 1])
+def test_dequantized_weights_are_within_half_a_step(channel_dim):
+    weight = torch.randn(24, 40)
+    weight_int8, scale = quantize_per_channel(weight, channel_dim)
+    assert weight_int8.dtype == torch.int8
+    assert scale.shape[channel_dim] == weight.shape[channel_dim]
+    assert scale.shape[1 - channel_dim] == 1
+
+    # Every output channel uses its whole int8 range
+    absmax = weight.abs().amax(dim=1 - channel_dim, keepdim=True)
+    assert torch.allclose(scale, absmax / 127)
+    assert (weight - weight_int8.float() * scale).abs().le(scale / 2 + 1e-6).all()
+
+
+def test_int8_weights_are_dequantized_as_they_are_used():
+    model = make_model()
+    x = torch.randn(3, 16)
+    expected = model(x)
+    tied_weight = model.head.weight
+
+    with torch.no_grad():
+        quantize_model(model, torch.device("cuda"))
+
+    # Layers keep their names, tied weights are left as is
+    assert isinstance(model.up, Int8WeightMixin) and isinstance(model.up, torch.nn.Linear)
+    assert isinstance(model.conv, Int8WeightMixin)
+    assert model.head.weight is tied_weight
+    assert "weight" not in dict(model.up.named_parameters())
+    assert model.up.weight_int8.dtype == torch.int8
+    assert model.conv.weight.shape == (32, 16)
+    assert torch.allclose(model(x), expected, atol=0.05 * expected.abs().max().item())
+
+
+@requires_int8_kernels
+def test_dynamic_int8_linear_matches_the_float_layer():
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(64, 32)
+    quantized = DynamicInt8Linear(linear.weight, linear.bias)
+    x = torch.randn(8, 64, dtype=torch.bfloat16)
+
+    out = quantized(x)
+    expected = linear(x.float())
+    assert out.dtype == torch.bfloat16
+    assert (out.float() - expected).abs().max() < 0.05 * expected.abs().max()
+
+
+@requires_int8_kernels
+def test_cpu_layers_are_swapped_for_int8_kernels():
+    model = make_model()
+    x = torch.randn(3, 16)
+    expected = model(x)
+
+    with torch.no_grad():
+        quantize_model(model, torch.device("cpu"))
+    assert isinstance(model.up, DynamicInt8Linear)
+    assert isinstance(model.conv, DynamicInt8Linear)
+    assert isinstance(model.head, torch.nn.Linear)
+    assert torch.allclose(model(x), expected, atol=0.05 * expected.abs().max().item())
+
+
+class ColumnParallelLinear(torch.nn.Linear):
+    """Stands in for fairscale's, whose forward gathers the output shards"""
+
+
+@requires_int8_kernels
+def test_tensor_parallel_layers_keep_their_forward_when_sharded(monkeypatch):
+    model = make_model()
+    model.up.__class__ = ColumnParallelLinear
+    monkeypatch.setattr(models.quantization, "model_parallel_world_size", lambda: 2)
+
+    with torch.no_grad():
+        quantize_model(model, torch.device("cpu"))
+    # Swapping it for an int8 kernel would drop its collectives
+    assert isinstance(model.up, ColumnParallelLinear) and isinstance(model.up, Int8WeightMixin)
+    assert isinstance(model.conv, DynamicInt8Linear)
+
+
+def test_dequantized_weights_are_cached_within_the_budget(monkeypatch):
+    model = make_model()
+    with torch.no_grad():
+        quantize_model(model, torch.device("cuda"))
+    up_bytes = 32 * 16 * 4
+
+    # Without a budget, every read dequantizes the weight again
+    assert model.up.weight is not model.up.weight
+
+    cache = DequantizedWeightCache(max_bytes=up_bytes)
+    monkeypatch.setattr(models.quantization, "DEQUANTIZED_CACHE", cache)
+    weight = model.up.weight
+    assert model.up.weight is weight
+    assert torch.equal(weight, model.up.dequantize_weight())
+
+    # Only the most recently used weight fits
+    conv_weight = model.conv.weight
+    assert model.conv.weight is conv_weight
+    assert model.up.weight is not weight
+    assert cache.num_bytes == up_bytes
+
+
+def test_get_quantization(tmp_path):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(
+        json.dumps(
+            {
+                "variants": {"7b": {"quantization": "int8"}, "13b": {}},
+            }
+        )
+    )
+    assert get_quantization(str(config_path), "7b") == "int8"
+    assert get_quantization(str(config_path), "13b") is None
+    assert get_quantization(str(config_path), "70b") is None
+
+    config_path.write_text(json.dumps({"quantization": "int4"}))
+    with pytest.raises(ValueError, match="Unsupported quantization int4"):
+        get_quantization(str(config_path), "base")
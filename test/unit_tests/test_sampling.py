@@ -0,0 +1,167 @@
+"""Unit tests for per-row sampling in the model service"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from models.sampling import (
+    RowSamplingLogitsProcessor,
+    decode_generations,
+    get_row_params,
+    mask_logits_per_row,
+    split_rows,
+    truncate_at_eos,
+)
+
+EOS = 0
+
+
+def test_get_row_params_broadcasts_and_defaults():
+    inputs = {"top_k": np.array([[5]]), "temperature": np.array([[0.5], [1.0]])}
+    assert get_row_params(inputs, "top_k", 0, 3, np.int64).tolist() == [5, 5, 5]
+    assert get_row_params(inputs, "temperature", 1.0, 2).tolist() == [0.5, 1.0]
+    assert get_row_params(inputs, "top_p", 0.9, 2).tolist() == [0.9, 0.9]
+
+
+def test_mask_logits_per_row():
+    logits = torch.tensor([[4.0, 3.0, 2.0, 1.0]] * 4)
+    masked = mask_logits_per_row(
+        logits,
+        temperature=torch.tensor([0.0, 1.0, 1.0, 2.0]),
+        top_p=torch.tensor([1.0, 1.0, 0.5, 1.0]),
+        top_k=torch.tensor([0, 2, 0, 0]),
+    )
+    kept = torch.isfinite(masked)
+    # Greedy row keeps its argmax, top-k keeps k tokens, top-p the head of the mass
+    assert kept[0].tolist() == [True, False, False, False]
+    assert kept[1].tolist() == [True, True, False, False]
+    assert kept[2].tolist() == [True, False, False, False]
+    # Temperature only scales the logits
+    assert kept[3].all()
+    assert torch.allclose(masked[3], logits[3] / 2)
+
+
+def test_row_sampling_processor_forces_eos_at_each_row_limit():
+    processor = RowSamplingLogitsProcessor(
+        input_len=2,
+        eos_token_id=EOS,
+        max_new_tokens=np.array([1, 3]),
+        min_new_tokens=np.array([0, 2]),
+    )
+    scores = torch.zeros(2, 5)
+
+    # One token generated: the first row is at its limit, the second row
+    # can't stop yet
+    out = processor(torch.ones(2, 3, dtype=torch.long), scores.clone())
+    assert out[0].argmax().item() == EOS
+    assert torch.isinf(out[0, 1:]).all()
+    assert out[1, EOS].item() == float("-inf")
+    assert torch.isfinite(out[1, 1:]).all()
+
+    # Three tokens generated: both rows are at or past their limits
+    out = processor(torch.ones(2, 5, dtype=torch.long), scores.clone())
+    for row in out:
+        assert row[EOS].item() == 0.0
+        assert torch.isinf(row[1:]).all()
+
+
+def test_split_rows_is_ragged_and_one_dimensional():
+    rows = split_rows(np.array([-0.1, -0.2, -0.3]), [1, 2])
+    assert rows.shape == (2,)
+    assert rows.tolist() == [[-0.1], [-0.2, -0.3]]
+
+    # Rows of the same length still give one list per row
+    rows = split_rows(["a", "b", "c", "d"], np.array([2, 2]))
+    assert rows.shape == (2,)
+    assert rows[1] == ["c", "d"]
+
+    # A row with every token masked is an empty list
+    assert split_rows([], [0, 0]).tolist() == [[], []]
+
+
+def test_truncate_at_eos_keeps_the_logprobs_of_kept_tokens():
+    generated_ids = torch.tensor([[5, 6, EOS, EOS], [7, 8, 9, 4], [EOS, EOS, EOS, EOS]])
+    scores = -torch.arange(12, dtype=torch.float32).reshape(3, 4)
+    sequences, logprobs = truncate_at_eos(generated_ids, scores, EOS)
+    assert sequences == [[5, 6], [7, 8, 9, 4], []]
+    assert logprobs == [[-0.0, -1.0], [-4.0, -5.0, -6.0, -7.0], []]
+
+
+def test_one_padded_batch_stops_every_row_at_its_own_length():
+    # A greedy generate loop over a left padded batch, like the one gpt2 runs
+    # for all rows of a batch at once
+    vocab_size = 6
+    input_ids = torch.tensor([[EOS, 3, 4], [2, 3, 4]])
+    processor = RowSamplingLogitsProcessor(
+        input_len=input_ids.shape[1],
+        eos_token_id=EOS,
+        max_new_tokens=np.array([2, 4]),
+        min_new_tokens=np.array([0, 0]),
+    )
+    generator = torch.Generator().manual_seed(0)
+    step_scores = []
+    for _ in range(4):
+        logits = torch.randn(2, vocab_size, generator=generator)
+        logits[:, EOS] = float("-inf")
+        scores = processor(input_ids, logits)
+        step_scores.append(scores)
+        input_ids = torch.cat([input_ids, scores.argmax(dim=-1, keepdim=True)], dim=-1)
+
+    # Logprobs of the chosen tokens, as compute_transition_scores gives them
+    generated_ids = input_ids[:, 3:]
+    transition_scores = torch.stack(
+        [
+            torch.log_softmax(scores, dim=-1).gather(-1, token.unsqueeze(-1)).squeeze(-1)
+            for scores, token in zip(step_scores, generated_ids.T)
+        ],
+        dim=1,
+    )
+    sequences, logprobs = truncate_at_eos(generated_ids, transition_scores, EOS)
+
+    assert [len(row) for row in sequences] == [2, 4]
+    assert [len(row) for row in logprobs] == [2, 4]
+    assert all(EOS not in row for row in sequences)
+    assert all(p < 0 for row in logprobs for p in row)
+
+
+class FakeTokenizer:
+    """Decodes ids like HuggingFace tokenizers do, and counts its calls"""
+
+    vocab = ["<eos>", "<pad>", " the", " fox", "es", " ☃"]
+    all_special_ids = [0, 1]
+
+    def __init__(self):
+        self.calls = 0
+
+    def decode(self, ids, skip_special_tokens=False):
+        ids = [ids] if isinstance(ids, int) else ids
+        return "".join(
+            self.vocab[i] for i in ids if not (skip_special_tokens and i in self.all_special_ids)
+        )
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        self.calls += 1
+        return [self.decode(list(seq), skip_special_tokens) for seq in sequences]
+
+
+def test_decode_generations_matches_decoding_token_by_token():
+    tokenizer = FakeTokenizer()
+    generated_ids = torch.tensor([[2, 3, 4, 0, 0], [1, 5, 2, 3, 0], [0, 0, 0, 0, 0]])
+    transition_scores = -torch.rand(3, 5).to(torch.bfloat16)
+    generations, tokens, logprobs = decode_generations(tokenizer, generated_ids, transition_scores)
+
+    # The loop decoding every kept token on its own, which this replaces
+    expected_tokens, expected_logprobs = [], []
+    for sequence, scores in zip(generated_ids.tolist(), transition_scores.float().tolist()):
+        kept = [(t, p) for t, p in zip(sequence, scores) if t not in tokenizer.all_special_ids]
+        expected_tokens.append([tokenizer.decode(t) for t, _ in kept])
+        expected_logprobs.append([p for _, p in kept])
+
+    assert generations == [" the foxes", " ☃ the fox", ""]
+    assert tokens.shape == logprobs.shape == (3,)
+    assert tokens.tolist() == expected_tokens
+    assert np.allclose(np.concatenate(logprobs[:2]), np.concatenate(expected_logprobs[:2]))
+    assert logprobs[2] == []
+    # Once for the texts, once for the tokens of every row
+    assert tokenizer.calls == 2
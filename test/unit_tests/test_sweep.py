@@ -0,0 +1,51 @@
+"""Unit tests for packing the variants of an activation patching sweep"""
+import ast
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from models.sweep import run_sweep
+
+
+def fake_run_variants(calls):
+    """Generates one row per variant, like the llama2 batching loop does"""
+
+    def run_variants(variants):
+        calls.append(len(variants))
+        return {
+            "sequences": np.array([f"seq{v['id']}" for v in variants], dtype=object),
+            "tokens": np.array([[f"tok{v['id']}"] for v in variants], dtype=object),
+            "logprobs": np.array([[-0.5 * v["id"]] for v in variants], dtype=object),
+            "activations": np.array(
+                [str({"layer": f"act{v['id']}"}).encode("utf-8") for v in variants],
+                dtype=np.bytes_,
+            ),
+        }
+
+    return run_variants
+
+
+def test_every_variant_comes_back_in_one_row():
+    calls = []
+    variants = [{"id": idx} for idx in range(5)]
+    row = run_sweep(fake_run_variants(calls), variants, max_batch_size=2)
+
+    # The variants were generated in chunks of the max batch size
+    assert calls == [2, 2, 1]
+
+    assert json.loads(row["sequences"]) == [f"seq{idx}" for idx in range(5)]
+    assert json.loads(row["tokens"]) == [[f"tok{idx}"] for idx in range(5)]
+    assert len(json.loads(row["logprobs"])) == 5
+    activations = ast.literal_eval(row["activations"])
+    assert sorted(activations) == [0, 1, 2, 3, 4]
+    assert activations[3] == {"layer": "act3"}
+
+
+def test_a_single_variant_sweep():
+    calls = []
+    row = run_sweep(fake_run_variants(calls), [{"id": 7}], max_batch_size=4)
+    assert calls == [1]
+    assert json.loads(row["sequences"]) == ["seq7"]
+    assert ast.literal_eval(row["activations"]) == {0: {"layer": "act7"}}
@@ -0,0 +1,106 @@
+"""Unit tests for encoding prompts ahead of the GPU batching loops"""
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from models.tokenization import ThreadLocalTokenizer, TokenCache, TokenizationStage
+
+
+def tokens(n):
+    return np.arange(n, dtype=np.int32)
+
+
+def test_cache_is_bounded_by_its_total_tokens():
+    cache = TokenCache(max_tokens=10)
+    cache.put("a", tokens(4))
+    cache.put("b", tokens(4))
+    assert cache.num_tokens == 8
+
+    # Using "a" makes "b" the least recently used prompt
+    assert cache.get("a") is not None
+    cache.put("c", tokens(4))
+    assert cache.num_tokens == 8
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_one_long_prompt_evicts_several_short_ones():
+    cache = TokenCache(max_tokens=10)
+    for prompt in "abcde":
+        cache.put(prompt, tokens(2))
+    cache.put("long", tokens(9))
+    assert list(cache.entries) == ["long"]
+    assert cache.num_tokens == 9
+
+
+def test_prompts_longer_than_the_cache_are_not_cached():
+    cache = TokenCache(max_tokens=10)
+    cache.put("a", tokens(4))
+    cache.put("huge", tokens(11))
+    assert cache.get("huge") is None
+    assert cache.num_tokens == 4
+
+
+def test_repeated_puts_are_counted_once():
+    cache = TokenCache(max_tokens=10)
+    cache.put("a", tokens(4))
+    cache.put("a", tokens(4))
+    assert cache.num_tokens == 4
+
+
+def test_stage_encodes_in_order_and_serves_repeats_from_the_cache():
+    calls = []
+    lock = threading.Lock()
+
+    def encode_fn(prompt):
+        with lock:
+            calls.append(prompt)
+        return [len(word) for word in prompt.split()]
+
+    stage = TokenizationStage(encode_fn, num_threads=4, cache_tokens=100)
+    prompts = ["a bb ccc", "dddd", "ee f"]
+    assert stage.encode(prompts) == [[1, 2, 3], [4], [2, 1]]
+    assert sorted(calls) == sorted(prompts)
+
+    assert stage.encode(["dddd", "ee f"]) == [[4], [2, 1]]
+    assert len(calls) == 3
+    assert stage.cache.num_tokens == 6
+
+
+class PaddingTokenizer:
+    """Mutated by padding, like the fast tokenizers of HuggingFace"""
+
+    def __init__(self):
+        self.padding = None
+
+    def __call__(self, prompts, padding=None):
+        self.padding = padding
+        return [len(prompt) for prompt in prompts]
+
+
+def test_every_thread_pads_its_own_tokenizer_copy():
+    tokenizer = PaddingTokenizer()
+    thread_tokenizers = ThreadLocalTokenizer(tokenizer)
+    assert thread_tokenizers.get() is thread_tokenizers.get()
+
+    barrier = threading.Barrier(2)
+    copies = {}
+
+    def encode(padding):
+        copy = thread_tokenizers.get()
+        copy(["a"], padding=padding)
+        # Both threads have padded before either checks its own copy
+        barrier.wait()
+        copies[padding] = copy
+
+    threads = [threading.Thread(target=encode, args=(padding,)) for padding in ("longest", "max")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert copies["longest"] is not copies["max"]
+    assert copies["longest"].padding == "longest" and copies["max"].padding == "max"
+    assert tokenizer.padding is None
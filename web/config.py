@@ -43,3 +43,6 @@ class Config:
     MODEL_INSTANCE_TIMEOUT = datetime.timedelta(minutes=int(os.environ["MODEL_INSTANCE_TIMEOUT"]))
     TRITON_INFERENCE_TIMEOUT = float(os.environ["TRITON_INFERENCE_TIMEOUT"])
     BATCH_REQUEST_LIMIT = os.environ["BATCH_REQUEST_LIMIT"]
+
+    ACTIVATION_SPILL_DIR = os.getenv("ACTIVATION_SPILL_DIR", "")
+    ACTIVATION_SPILL_TTL = datetime.timedelta(minutes=int(os.getenv("ACTIVATION_SPILL_TTL", "60")))
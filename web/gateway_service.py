@@ -51,6 +51,10 @@ def make_celery(app):
         "verify_active": {
             "task": "tasks.verify_model_instance_active",
             "schedule": 30.0,
+        },
+        "cleanup_spilled_activations": {
+            "task": "tasks.cleanup_spilled_activations",
+            "schedule": 300.0,
         }
     }
 
@@ -1,5 +1,7 @@
 """Module to represent model instance API routes"""
-from flask import Blueprint, request, current_app, jsonify
+import json
+
+from flask import Blueprint, Response, request, current_app, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
 from config import Config
@@ -7,6 +9,7 @@ from db import db
 import tasks
 from models import ModelInstance, AVAIALBLE_MODELS
 from errors import InvalidStateError
+from utils.activation_files import read_activation_file
 
 
 model_instances_bp = Blueprint("models", __name__)
@@ -125,6 +128,19 @@ async def get_module_names(model_instance_id: str):
     return jsonify(module_names), 200
 
 
+@model_instances_bp.route("instances/<model_instance_id>/metrics", methods=["GET"])
+@jwt_required()
+async def get_batching_metrics(model_instance_id: str):
+    """Retrieve the batching metrics of a model instance"""
+    model_instance = ModelInstance.find_by_id(model_instance_id)
+    try:
+        metrics = model_instance.get_batching_metrics()
+    except InvalidStateError as err:
+        return jsonify(msg=f"Metrics retrieval failed: {err}"), 400
+
+    return jsonify(metrics), 200
+
+
 @model_instances_bp.route("/instances/<model_instance_id>/get_activations", methods=["POST"])
 @jwt_required()
 async def get_activations(model_instance_id: str):
@@ -203,3 +219,57 @@ async def edit_activations(model_instance_id: str):
         return jsonify(msg=f"Activations editing failed: {activations}"), 500
     
     return jsonify(activations), 200
+
+
+@model_instances_bp.route(
+    "/instances/<model_instance_id>/sweep_activations", methods=["POST"]
+)
+@jwt_required()
+async def sweep_activations(model_instance_id: str):
+    """
+    Run a patching sweep: one prompt, with each variant of declarative edits
+    applied to its own row of a batched generation
+    """
+    username = get_jwt_identity()
+    prompt = request.json["prompt"]
+    variants = request.json["variants"]
+    generation_config = request.json.get("generation_config", {})
+
+    if len(variants) == 0:
+        return jsonify(msg="Sweep requires at least one edit variant"), 400
+
+    model_instance = ModelInstance.find_by_id(model_instance_id)
+    inputs = {
+        "prompts": [prompt],
+        "variants": json.dumps(variants),
+        **generation_config
+    }
+    if "modules" in request.json:
+        inputs["modules"] = request.json["modules"]
+
+    try:
+        activations = model_instance.sweep_activations(username, inputs)
+    except InvalidStateError as err:
+        return jsonify(msg=f"Generation failed: {err}"), 400
+
+    if isinstance(activations, tuple):
+        err, input = activations
+        return jsonify(msg=f"Activations sweep failed: {err}, Error Source: {input}"), 400
+    if isinstance(activations, Exception):
+        return jsonify(msg=f"Activations sweep failed: {activations}"), 500
+
+    return jsonify(activations), 200
+
+
+@model_instances_bp.route("/activation_files/<file_name>", methods=["GET"])
+@jwt_required()
+async def get_activation_file(file_name: str):
+    """Serve a byte range of an activation spilled to the shared scratch directory"""
+    offset = request.args.get("offset", default=0, type=int)
+    length = request.args.get("length", default=None, type=int)
+    try:
+        data = read_activation_file(file_name, offset=offset, length=length)
+    except FileNotFoundError:
+        return jsonify(msg=f"Activation file {file_name} not found"), 404
+
+    return Response(data, mimetype="application/octet-stream"), 200
@@ -43,10 +43,18 @@ class ModelInstanceState(ABC):
         """Retrieve intermediate activations from a model"""
         raise InvalidStateError(self)
 
+    def sweep_activations(self, username, inputs):
+        """Run a batched activation patching sweep on a model"""
+        raise InvalidStateError(self)
+
     def get_module_names(self):
         """Get names of layer modules"""
         raise InvalidStateError(self)
 
+    def get_batching_metrics(self):
+        """Get the queue and batch metrics of a model's batching loop"""
+        raise InvalidStateError(self)
+
     def shutdown(self):
         """Shutdown a model"""
         model_service_client.shutdown(self._model_instance.id)
@@ -139,6 +147,11 @@ class ActiveState(ModelInstanceState):
     def get_module_names(self):
         return model_service_client.get_module_names(self._model_instance.name)
 
+    def get_batching_metrics(self):
+        return model_service_client.get_batching_metrics(
+            self._model_instance.host, self._model_instance.name
+        )
+
     def get_activations(self, username, inputs):
 
         model_instance_generation = ModelInstanceGeneration.create(
@@ -168,6 +181,21 @@ class ActiveState(ModelInstanceState):
 
         return activations_response
 
+    def sweep_activations(self, username, inputs):
+
+        model_instance_generation = ModelInstanceGeneration.create(
+            model_instance_id=self._model_instance.id,
+            username=username,
+        )
+
+        activations_response = model_service_client.sweep_activations(
+            self._model_instance.host,
+            self._model_instance.name,
+            inputs
+        )
+
+        return activations_response
+
     def is_healthy(self):
         return model_service_client.verify_model_health(self._model_instance.host, self._model_instance.name)
     
@@ -315,6 +343,10 @@ class ModelInstance(BaseMixin, db.Model):
         """Retrieve module names"""
         return self._state.get_module_names()
 
+    def get_batching_metrics(self) -> Dict:
+        """Retrieve batching metrics"""
+        return self._state.get_batching_metrics()
+
     def get_activations(
         self,
         username: str,
@@ -330,6 +362,14 @@ class ModelInstance(BaseMixin, db.Model):
     ) -> Dict:
         return self._state.edit_activations(username, inputs)
 
+    def sweep_activations(
+        self,
+        username: str,
+        inputs: Dict = {},
+    ) -> Dict:
+        """Run a batched patching sweep of edit variants on one prompt"""
+        return self._state.sweep_activations(username, inputs)
+
     def is_healthy(self) -> bool:
         """Retrieve health status"""
         return self._state.is_healthy()
@@ -103,6 +103,15 @@ def verify_model_health(host: str, model_name: str) -> bool:
         current_app.logger.error(f"Model health failed check: {err}")
         return False
 
+def get_batching_metrics(host: str, model_name: str) -> Dict:
+    try:
+        triton_client = TritonClient(host)
+        return triton_client.get_metrics(model_name)
+
+    except Exception as err:
+        current_app.logger.error(f"Batching metrics retrieval failed: {err}")
+        return {}
+
 def shutdown(model_instance_id: str) -> None:
     try:
         ssh_command = f"ssh {Config.JOB_SCHEDULER_USER}@{Config.JOB_SCHEDULER_HOST} python3 {Config.JOB_SCHEDULER_BIN} --action shutdown --model_instance_id {model_instance_id}"
@@ -147,3 +156,8 @@ def edit_activations(host: str, model_name: str, inputs: Dict) -> Dict:
 
     triton_client = TritonClient(host)
     return triton_client.infer(model_name, inputs, task=Task.EDIT_ACTIVATIONS)
+
+def sweep_activations(host: str, model_name: str, inputs: Dict) -> Dict:
+
+    triton_client = TritonClient(host)
+    return triton_client.infer(model_name, inputs, task=Task.SWEEP_ACTIVATIONS)
@@ -3,6 +3,7 @@ from celery import shared_task
 
 from models import ModelInstance
 from config import Config
+from utils.activation_files import cleanup_activation_files
 
 
 @shared_task
@@ -31,3 +32,9 @@ def shutdown_model_instance(model_instance_id):
     """Shutdown a model instance by id"""
     model_instance = ModelInstance.find_by_id(model_instance_id)
     model_instance.shutdown()
+
+
+@shared_task
+def cleanup_spilled_activations():
+    """Remove spilled activation files past their TTL"""
+    cleanup_activation_files()
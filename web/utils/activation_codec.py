@@ -0,0 +1,105 @@
+"""Module for decoding activations returned by the model services"""
+import codecs
+import json
+import pickle
+from typing import Dict, Union
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Must match the prefixes used by the model service activation encoder
+ENVELOPE_PREFIX = "kscope-activation"
+HANDLE_PREFIX = "kscope-activation-handle"
+PACK_PREFIX = "kscope-activation-pack"
+
+
+def dequantize(envelope: dict) -> np.ndarray:
+    """Convert the data of a decoded envelope back to a float array"""
+    data = envelope["data"]
+    if envelope["scales"] is not None:
+        return data.astype(np.float32) * envelope["scales"]
+    elif envelope["dtype"] == "bfloat16":
+        # bfloat16 is the upper half of a float32
+        return (data.view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+    return data
+
+
+def decode_activation(encoded_activation: str) -> Union[str, dict]:
+    """
+    Decode an activation envelope into a base64 encoded pickled numpy array,
+    or a spilled activation handle into a dict. Any other activation is
+    returned unchanged.
+    """
+    if encoded_activation.startswith(f"{HANDLE_PREFIX}:"):
+        return json.loads(encoded_activation[len(HANDLE_PREFIX) + 1 :])
+
+    if not encoded_activation.startswith(f"{ENVELOPE_PREFIX}:"):
+        return encoded_activation
+
+    _, compression, encoded_payload = encoded_activation.split(":", 2)
+    payload = codecs.decode(encoded_payload.encode("utf-8"), "base64")
+
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd activation compression requires the zstandard package")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+
+    activation = dequantize(pickle.loads(payload))
+    return codecs.encode(pickle.dumps(activation), "base64").decode("utf-8")
+
+
+def decode_activation_pack(encoded_pack: str) -> Dict[str, str]:
+    """
+    Decode an envelope packing the activations of several modules into one
+    base64 encoded pickled numpy array per module.
+    """
+    _, compression, encoded_payload = encoded_pack.split(":", 2)
+    payload = codecs.decode(encoded_payload.encode("utf-8"), "base64")
+
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd activation compression requires the zstandard package")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+
+    header_len = int.from_bytes(payload[:8], "little")
+    table = json.loads(payload[8 : 8 + header_len])
+    data_start = 8 + header_len
+
+    def read_chunk(entry):
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        array = np.frombuffer(
+            payload, dtype=dtype, count=count, offset=data_start + entry["offset"]
+        )
+        return array.reshape(entry["shape"])
+
+    activations = {}
+    for module_name, entry in table.items():
+        activation = dequantize(
+            {
+                "dtype": entry["dtype"],
+                "data": read_chunk(entry["data"]),
+                "scales": None if entry["scales"] is None else read_chunk(entry["scales"]),
+            }
+        )
+        activations[module_name] = codecs.encode(pickle.dumps(activation), "base64").decode("utf-8")
+    return activations
+
+
+def decode_activations(encoded_activations: Dict[str, str]) -> Dict[str, Union[str, dict]]:
+    """
+    Decode the activations of one prompt, expanding packed envelopes into
+    their modules.
+    """
+    activations = {}
+    for module_name, encoded_activation in encoded_activations.items():
+        if encoded_activation.startswith(f"{PACK_PREFIX}:"):
+            activations.update(decode_activation_pack(encoded_activation))
+        else:
+            activations[module_name] = decode_activation(encoded_activation)
+    return activations
@@ -0,0 +1,38 @@
+"""Module for serving activations spilled to the shared scratch directory"""
+import mmap
+import os
+import time
+from typing import Optional
+
+from config import Config
+
+
+def get_activation_file_path(file_name: str) -> str:
+    """Resolve a spilled activation file name inside the scratch directory"""
+    if not Config.ACTIVATION_SPILL_DIR:
+        raise FileNotFoundError("ACTIVATION_SPILL_DIR is not configured")
+    # Handles only ever carry bare file names, reject anything else
+    if os.path.basename(file_name) != file_name or not file_name.endswith(".npy"):
+        raise FileNotFoundError(f"Invalid activation file name {file_name}")
+    return os.path.join(Config.ACTIVATION_SPILL_DIR, file_name)
+
+
+def read_activation_file(file_name: str, offset: int = 0, length: Optional[int] = None) -> bytes:
+    """Read a byte range of a spilled activation file through a memory map"""
+    path = get_activation_file_path(file_name)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        end = len(mapped) if length is None else min(offset + length, len(mapped))
+        return mapped[offset:end]
+
+
+def cleanup_activation_files():
+    """Delete spilled activation files older than the configured TTL"""
+    if not Config.ACTIVATION_SPILL_DIR or not os.path.isdir(Config.ACTIVATION_SPILL_DIR):
+        return
+    expiry = time.time() - Config.ACTIVATION_SPILL_TTL.total_seconds()
+    for entry in os.scandir(Config.ACTIVATION_SPILL_DIR):
+        if entry.is_file() and entry.stat().st_mtime < expiry:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
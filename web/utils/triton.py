@@ -4,8 +4,10 @@ import tritonclient.http as httpclient
 from tritonclient.utils import np_to_triton_dtype, triton_to_np_dtype
 import typing
 import ast
+import json
 from enum import Enum
 from config import Config
+from utils.activation_codec import decode_activations
 
 
 class Task(Enum):
@@ -13,6 +15,7 @@ class Task(Enum):
     GENERATE = 0
     GET_ACTIVATIONS = 1
     EDIT_ACTIVATIONS = 2
+    SWEEP_ACTIVATIONS = 3
 
 def _param(dtype, value, batch_size):
     if bool(value):
@@ -74,6 +77,13 @@ class TritonClient():
     def __init__(self, host):
         self._client = httpclient.InferenceServerClient(host, concurrency=1, verbose=True, network_timeout=Config.TRITON_INFERENCE_TIMEOUT)
 
+    def get_metrics(self, model_name):
+        """Batching metrics of a model, served as its `<model_name>-metrics` model"""
+        task = httpclient.InferInput("task", [1, 1], "INT64")
+        task.set_data_from_numpy(np.zeros((1, 1), dtype=np.int64))
+        response = self._client.infer(f"{model_name}-metrics", [task])
+        return json.loads(response.as_numpy("metrics")[0][0].decode("utf-8"))
+
     def infer(self, model_name, inputs, task=Task.GENERATE):
         task_config = self._client.get_model_config(model_name)
         
@@ -100,6 +110,21 @@ class TritonClient():
         except Exception as err:
             pass
         
+        # Sweeps pack all of the variants of a prompt into its row, as JSON
+        # lists with one entry per variant and activations keyed by variant
+        if task == Task.SWEEP_ACTIVATIONS:
+            activations = np.char.decode(response.as_numpy("activations").astype("bytes"), "utf-8").tolist()
+            return {
+                "sequences": [json.loads(row) for row in sequences],
+                "tokens": [json.loads(row) for row in tokens],
+                "logprobs": [json.loads(row) for row in logprobs],
+                "activations": [
+                    {variant: decode_activations(row_activations)
+                     for variant, row_activations in ast.literal_eval(row).items()}
+                    for row in activations
+                ],
+            }
+
         # Logprobs need special treatment because they are encoded as bytes
         # Regular np float arrays don't work, each element has a different number of items
         for i in range(len(logprobs)):
@@ -119,9 +144,19 @@ class TritonClient():
         if task in [Task.GET_ACTIVATIONS, Task.EDIT_ACTIVATIONS]:
             activations = np.char.decode(response.as_numpy("activations").astype("bytes"), "utf-8").tolist()
             for idx in range(len(activations)):
-                activations[idx] = ast.literal_eval(activations[idx])
+                activations[idx] = decode_activations(ast.literal_eval(activations[idx]))
             result.update({"activations": activations})
 
+            # Only present when the model service cached the activations
+            try:
+                activation_cache_handle = np.char.decode(
+                    response.as_numpy("activation_cache_handle").astype("bytes"), "utf-8"
+                ).tolist()
+                if activation_cache_handle:
+                    result.update({"activation_cache_handle": activation_cache_handle})
+            except Exception as err:
+                pass
+
         return result
 
     def is_model_ready(self, model_name):